@@ -1,21 +1,417 @@
-from flask import Flask, render_template, request, Response
-from flask.json import jsonify
+from flask import Flask, render_template, request, Response, g
 from marshmallow import ValidationError
-from utils.validation_utils import DeviceReadingsSchema
-from utils.dates_parameters import getDefaultDatesParams
-from utils.summary_list_utils import sort_summary_by_key
-from pandas import DataFrame
+from utils.validation_utils import AlertRuleSchema, DeviceReadingsSchema, StatsQuerySchema, SummaryJobSchema
+from utils.dates_parameters import getDefaultDatesParams, InvalidTimeRange
+from utils.summary_list_utils import SUMMARY_SORT_KEYS, top_summary_by_key
+from utils.db_utils import CLUSTERED, HEAP, INSERT_READING, LAYOUTS, REPLAY_READINGS, REPLAY_TYPE_READINGS, connect, fetch_columns, get_database_path, init_db, range_readings_query, readings_layout
+from utils.sketch_store import add_reading_to_sketch, device_sketch, devices_sketches, rebuild_sketches
+from utils.quantile_sketch import MIN_K
+from utils.histogram_utils import histogram_stats, histogram_metrics, parse_metrics
+from utils.hyperloglog import HyperLogLog
+from utils.summary_state import summary_from_state, rebuild_summary_state
+from utils.retention import DEFAULT_RETENTION_POLICIES, RetentionCompactor, run_retention
+from utils.jobs import InProcessJobQueue, SQLiteJobQueue, FINISHED
+from utils.event_bus import EventBus
+from utils.alerts import ALERTS_TOPIC, RULE_FIELDS, create_rule, record_alerts, select_alerts
+from utils.storage import Storage
+from utils.dictionary import TYPE_IDS, TYPE_NAMES, UNKNOWN_ID, encode_type
+from utils.logging_utils import AccessLogger, LogPipeline
+from utils.serializer import get_serializer
+from utils.compression import compress, compress_chunks, negotiate_encoding
+from utils.admission import LoadShedder, TokenBuckets
+from utils.idempotency import RecentKeys, claim_ingest_key, natural_key, purge_ingest_keys
+from utils.metrics import REGISTRY, REQUESTS_TOTAL, REQUEST_SECONDS, DATAFRAME_BUILD_SECONDS, INGEST_QUEUE_DEPTH, INGEST_REJECTED, INGEST_DUPLICATES
+import click
 import json
-import sqlite3
+import logging
+import math
+import os
+import queue
+import threading
 import time
-import sys, traceback
+
+# pandas and numpy are imported inside the metric handlers that need them, they are by far
+# the heaviest dependencies and workers that only ingest readings never load them
 
 app = Flask(__name__)
+app.config.from_mapping(
+    # Parameter of the quantile sketches stored on ingest, the most accurate
+    # the approximate metrics can be
+    SKETCH_K=200,
+    # Width of the time buckets the sketches are kept for
+    SKETCH_BUCKET_SECONDS=3600,
+    # Per type raw retention and downsampling, see utils/retention.py. Nothing is deleted
+    # by default, EXAMPLE_RETENTION_POLICIES there keeps 30 days raw and then hourly aggregates
+    RETENTION_POLICIES=DEFAULT_RETENTION_POLICIES,
+    # Readings folded per transaction and how often the background compactor runs
+    RETENTION_CHUNK_SIZE=500,
+    RETENTION_INTERVAL_SECONDS=3600,
+    # Background summary jobs: 'sqlite' keeps them in the jobs table shared by every process,
+    # 'inprocess' in memory for a single process API. Worker threads per process (0 with sqlite
+    # to leave the jobs to `flask run-jobs`), how long results are kept and how often idle
+    # workers look for new jobs
+    JOB_BACKEND='sqlite',
+    JOB_WORKERS=2,
+    JOB_RESULT_TTL_SECONDS=3600,
+    JOB_POLL_SECONDS=0.5,
+    # Summaries over a date range: worker processes (None for one per core, 0 or 1 to stay in the
+    # web process), devices per shard, the readings under which no worker is used and the rows
+    # read from the cursor at a time. Ranges covering less than this fraction of the stored dates
+    # are read through the date index and sorted rather than walked in device order
+    SUMMARY_WORKERS=None,
+    SUMMARY_CHUNK_SIZE=256,
+    SUMMARY_PARALLEL_MIN_READINGS=100000,
+    SUMMARY_BATCH_SIZE=10000,
+    SUMMARY_SORTED_RANGE_FRACTION=0.1,
+    # Statements slower than this are logged with their parameters and query plan, None disables it
+    SLOW_QUERY_THRESHOLD_MS=100,
+    # Request log, formatted and written by a background thread
+    ACCESS_LOG_ENABLED=True,
+    # Fraction of the requests logged per '<endpoint>:<method>', 1.0 for the rest
+    ACCESS_LOG_SAMPLE_RATES={'request_device_readings:POST': 0.01},
+    LOG_QUEUE_SIZE=10000,
+    # Read-only connections per database file, the writes go through a single connection
+    READ_POOL_SIZE=8,
+    # Responses are compressed when the client accepts it (zstd, br or gzip) and the
+    # buffered body has at least COMPRESSION_MIN_SIZE bytes, streamed ones always are
+    COMPRESSION_MIN_SIZE=1024,
+    # Level per endpoint, COMPRESSION_LEVEL for the rest, 0 turns compression off
+    COMPRESSION_LEVEL=6,
+    COMPRESSION_LEVELS={'request_metrics': 1},
+    # JSON encoder of the responses: auto (orjson when installed), orjson or json
+    JSON_SERIALIZER='auto',
+    # Ingest admission: token bucket per device (readings per second, None disables it, and burst),
+    # buckets idle this long are forgotten and at most INGEST_MAX_TRACKED_DEVICES are kept
+    INGEST_RATE_PER_DEVICE=10,
+    INGEST_BURST_PER_DEVICE=20,
+    INGEST_DEVICE_IDLE_SECONDS=300,
+    INGEST_MAX_TRACKED_DEVICES=100000,
+    # Every POST is shed with a 503 over this many waiting writes or this write latency, None disables them
+    INGEST_MAX_BACKLOG=64,
+    INGEST_MAX_LATENCY_SECONDS=0.5,
+    # Duplicate suppression: key stores a reading once per Idempotency-Key header, natural also
+    # treats a repeated type, value and date_created of a device as a retry, None stores every POST.
+    # The keys are kept INGEST_KEY_TTL_SECONDS and the last INGEST_RECENT_KEYS are checked in memory
+    INGEST_IDEMPOTENCY='key',
+    INGEST_KEY_TTL_SECONDS=86400,
+    INGEST_RECENT_KEYS=100000,
+    # Readings streams: events queued per subscriber before it is dropped as too slow,
+    # and the seconds between keepalive comments
+    STREAM_QUEUE_SIZE=100,
+    STREAM_KEEPALIVE_SECONDS=15,
+    # Stored events read per query when a stream resumes, each page in its own short read
+    STREAM_REPLAY_PAGE_SIZE=500,
+)
+
+# Storage per database file, see get_storage()
+storages = {}
+# Started by start_retention_compactor() when the API is served
+retention_compactor = None
+# Created on the first summary job, see get_job_queue()
+job_queue = None
+# Started on the first summary big enough for it, see get_summary_pool()
+summary_pool = None
+# Started on the first request, see get_access_logger()
+log_pipeline = None
+access_logger = None
+# Created on the first JSON response, see get_json_serializer()
+json_serializer = None
+# New readings are published here for the streams, see get_event_bus()
+event_bus = None
+# Ingest admission control, see admit_reading()
+device_rate_limiter = None
+load_shedder = None
+# Ingest keys committed lately, see get_recent_ingest_keys()
+recent_ingest_keys = None
+# Held while any of the globals above is created, so two first requests of a threaded
+# server never both create one (a second log handler, bus, pool or set of job workers)
+globals_lock = threading.RLock()
+
+def get_slow_query_threshold():
+    threshold_ms = app.config['SLOW_QUERY_THRESHOLD_MS']
+    return None if threshold_ms is None else threshold_ms / 1000.0
+
+def get_db_connection():
+    # Set the db that we want and open the connection, used by the maintenance commands
+    return connect(get_database_path(app.config['TESTING']), get_slow_query_threshold())
+
+def get_storage():
+    # One writer and one pool of readers per database file
+    database_path = get_database_path(app.config['TESTING'])
+    storage = storages.get(database_path)
+    if storage is None:
+        with globals_lock:
+            storage = storages.get(database_path)
+            if storage is None:
+                storage = storages[database_path] = Storage(database_path, app.config['READ_POOL_SIZE'], get_slow_query_threshold())
+    return storage
+
+def get_read_connection():
+    """
+    Read-only connection for the current request, given back to the pool on teardown
+    """
+    if 'read_conn' not in g:
+        g.read_storage = get_storage()
+        g.read_conn = g.read_storage.acquire_reader()
+    return g.read_conn
+
+def get_device_id(conn, device_uuid):
+    """
+    Id of a device in reading_rows from the in-process cache, UNKNOWN_ID for
+    a device that was never stored so the queries simply match nothing
+    """
+    device_id = get_storage().devices.device_id(conn, device_uuid)
+    return UNKNOWN_ID if device_id is None else device_id
+
+@app.teardown_appcontext
+def release_read_connection(exception):
+    conn = g.pop('read_conn', None)
+    if conn is not None:
+        g.pop('read_storage').release_reader(conn)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def get_access_logger():
+    global log_pipeline, access_logger
+    if access_logger is None:
+        with globals_lock:
+            if access_logger is None:
+                log_pipeline = LogPipeline(max_queue=app.config['LOG_QUEUE_SIZE'])
+                # Every sensor_api.* logger (access, slow queries) goes through the pipeline
+                log_pipeline.attach('sensor_api')
+                log_pipeline.start()
+                access_logger = AccessLogger(logging.getLogger('sensor_api.access'), app.config['ACCESS_LOG_SAMPLE_RATES'])
+    return access_logger
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    duration = time.perf_counter() - g.request_started
+    REQUESTS_TOTAL.inc((endpoint, request.method, response.status_code))
+    REQUEST_SECONDS.observe(duration, (endpoint, request.method))
+    if app.config['ACCESS_LOG_ENABLED']:
+        get_access_logger().log(endpoint, request.method, response.status_code, duration, request.path)
+    return response
+
+def get_json_serializer():
+    global json_serializer
+    if json_serializer is None:
+        with globals_lock:
+            if json_serializer is None:
+                json_serializer = get_serializer(app.config['JSON_SERIALIZER'])
+    return json_serializer
+
+def json_response(data):
+    """
+    Replaces jsonify: rows, tuples and NumPy values are encoded directly by the
+    configured serializer
+    """
+    return Response(get_json_serializer().dumps(data), mimetype='application/json')
+
+def get_device_rate_limiter():
+    global device_rate_limiter
+    if device_rate_limiter is None:
+        with globals_lock:
+            if device_rate_limiter is None:
+                device_rate_limiter = TokenBuckets(app.config['INGEST_RATE_PER_DEVICE'], app.config['INGEST_BURST_PER_DEVICE'],
+                                                   app.config['INGEST_DEVICE_IDLE_SECONDS'], app.config['INGEST_MAX_TRACKED_DEVICES'])
+    return device_rate_limiter
+
+def get_load_shedder():
+    global load_shedder
+    if load_shedder is None:
+        with globals_lock:
+            if load_shedder is None:
+                load_shedder = LoadShedder(app.config['INGEST_MAX_BACKLOG'], app.config['INGEST_MAX_LATENCY_SECONDS'])
+    return load_shedder
+
+def get_recent_ingest_keys():
+    global recent_ingest_keys
+    if recent_ingest_keys is None:
+        with globals_lock:
+            if recent_ingest_keys is None:
+                recent_ingest_keys = RecentKeys(app.config['INGEST_RECENT_KEYS'], app.config['INGEST_KEY_TTL_SECONDS'])
+    return recent_ingest_keys
+
+def get_ingest_key(post_data=None):
+    """
+    The key a POST is deduplicated on: the Idempotency-Key header or, in the
+    natural mode, the type, value and date_created sent by the device. None
+    when the reading is always stored.
+    """
+    mode = app.config['INGEST_IDEMPOTENCY']
+    if mode is None:
+        return None
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        return 'key:' + key
+    # Without a date_created the reading is dated on arrival, a retry can't be told apart
+    if mode == 'natural' and post_data is not None and 'date_created' in post_data:
+        return natural_key(post_data.get('type'), post_data['date_created'], post_data.get('value'))
+    return None
+
+def admit_reading(device_uuid):
+    """
+    None when a reading of the device can be stored, otherwise the 429
+    (device over its rate) or 503 (database overloaded) response
+    """
+    wait = 0 if app.config['INGEST_RATE_PER_DEVICE'] is None else get_device_rate_limiter().acquire(device_uuid)
+    if wait:
+        INGEST_REJECTED.inc(('rate_limited',))
+        return 'Too many readings for this device', 429, {'Retry-After': str(math.ceil(wait))}
+
+    shed = get_load_shedder().admit()
+    if shed is not None:
+        reason, retry_after = shed
+        INGEST_REJECTED.inc((reason,))
+        return 'The database is overloaded, retry later', 503, {'Retry-After': str(retry_after)}
+    return None
+
+def get_event_bus():
+    global event_bus
+    if event_bus is None:
+        with globals_lock:
+            if event_bus is None:
+                event_bus = EventBus(app.config['STREAM_QUEUE_SIZE'])
+    return event_bus
+
+def is_compressible(response):
+    return response.mimetype.startswith('text/') or response.mimetype == 'application/json'
+
+@app.after_request
+def compress_response(response):
+    level = app.config['COMPRESSION_LEVELS'].get(request.endpoint, app.config['COMPRESSION_LEVEL'])
+    if not level or response.direct_passthrough or 'Content-Encoding' in response.headers or not is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # Compressed chunk by chunk as the body is generated
+        response.response = compress_chunks(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
-# Setup the SQLite DB
-conn = sqlite3.connect('database.db')
-conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
-conn.close()
+@app.cli.command('init-db')
+@click.option('--layout', type=click.Choice(LAYOUTS), default='heap', help='Layout of the readings of a new database')
+def init_db_command(layout):
+    """Create the database schema."""
+    init_db(get_database_path(app.config['TESTING']), layout)
+    click.echo('Initialized the database')
+
+@app.cli.command('migrate-layout')
+@click.option('--chunk-size', type=int, default=5000, help='Readings copied per transaction')
+@click.option('--time-budget', type=float, default=None, help='Stop after this many seconds')
+def migrate_layout_command(chunk_size, time_budget):
+    """Move the readings to the clustered layout while the API is serving."""
+    from utils.clustered_layout import migrate_to_clustered
+    conn = get_db_connection()
+    report = migrate_to_clustered(conn, chunk_size, time_budget, pause=0.01,
+                                  progress=lambda progress: click.echo('Copied {}'.format(progress['copied'])))
+    click.echo('Finished' if report['finished'] else 'Stopped on the time budget, run it again to continue')
+
+@app.cli.command('rebuild-sketches')
+def rebuild_sketches_command():
+    """Recompute the quantile sketches from the stored readings."""
+    conn = get_db_connection()
+    rebuild_sketches(conn, app.config['SKETCH_K'], app.config['SKETCH_BUCKET_SECONDS'])
+    click.echo('Rebuilt the quantile sketches')
+
+@app.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """Recompute the per device summary state from the stored readings."""
+    conn = get_db_connection()
+    rebuild_summary_state(conn)
+    click.echo('Rebuilt the device summaries')
+
+@app.cli.command('apply-retention')
+@click.option('--time-budget', type=float, default=None, help='Stop after this many seconds')
+def apply_retention_command(time_budget):
+    """Delete or downsample the readings past their retention and expire the old ingest keys."""
+    conn = get_db_connection()
+    report = run_retention(conn, app.config['RETENTION_POLICIES'], chunk_size=app.config['RETENTION_CHUNK_SIZE'],
+                           time_budget=time_budget, progress=lambda progress: click.echo('Removed {}'.format(progress['removed'])),
+                           sketch_k=app.config['SKETCH_K'], sketch_bucket_seconds=app.config['SKETCH_BUCKET_SECONDS'])
+    click.echo('Finished' if report['finished'] else 'Stopped on the time budget, run it again to continue')
+    if app.config['INGEST_IDEMPOTENCY'] is not None:
+        click.echo('Removed {} ingest keys'.format(purge_ingest_keys(conn, app.config['INGEST_KEY_TTL_SECONDS'])))
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=int, default=1, help='Jobs run at the same time')
+@click.option('--burst', is_flag=True, help='Stop once no job is left')
+def run_jobs_command(workers, burst):
+    """Run the background summary jobs queued by the API processes."""
+    jobs = SQLiteJobQueue(get_database_path(app.config['TESTING']), 0, app.config['JOB_RESULT_TTL_SECONDS'], app.config['JOB_POLL_SECONDS'])
+    jobs.register('summary', run_summary_job)
+    threads = [threading.Thread(target=jobs.work, args=(burst,), daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    click.echo('No job left')
+
+def start_retention_compactor():
+    global retention_compactor
+    retention_compactor = RetentionCompactor(get_database_path(app.config['TESTING']), app.config['RETENTION_POLICIES'],
+                                             interval=app.config['RETENTION_INTERVAL_SECONDS'],
+                                             chunk_size=app.config['RETENTION_CHUNK_SIZE'],
+                                             ingest_key_ttl=None if app.config['INGEST_IDEMPOTENCY'] is None else app.config['INGEST_KEY_TTL_SECONDS'],
+                                             sketch_k=app.config['SKETCH_K'], sketch_bucket_seconds=app.config['SKETCH_BUCKET_SECONDS'])
+    retention_compactor.start()
+
+def get_approximate_accuracy(params):
+    """
+    Read the approximate mode parameters: ?approx=true&accuracy=<k>.
+    Returns None for the exact mode, otherwise the sketch parameter to use,
+    a bigger accuracy means a smaller error bound.
+    """
+    if str(params.get('approx', '')).lower() not in ('1', 'true', 'yes'):
+        return None
+    accuracy = int(params.get('accuracy', app.config['SKETCH_K']))
+    if accuracy < MIN_K or accuracy > app.config['SKETCH_K']:
+        raise ValueError('accuracy must be between {} and {}'.format(MIN_K, app.config['SKETCH_K']))
+    return accuracy
+
+def get_summary_page(params):
+    """
+    Read the paging parameters of the summary: ?sort_by=<key>&order=<asc|desc>&limit=<n>&offset=<n>.
+    Defaults to every device sorted by number of readings, descending.
+    """
+    sort_key = params.get('sort_by', 'number_of_readings')
+    if sort_key not in SUMMARY_SORT_KEYS:
+        raise ValueError('sort_by must be one of: {}'.format(', '.join(SUMMARY_SORT_KEYS)))
+    order = str(params.get('order', 'desc')).lower()
+    if order not in ('asc', 'desc'):
+        raise ValueError('order must be asc or desc')
+    limit = None if params.get('limit') is None else int(params['limit'])
+    offset = int(params.get('offset', 0))
+    if (limit is not None and limit < 0) or offset < 0:
+        raise ValueError('limit and offset must be positive integers')
+    return sort_key, order == 'desc', limit, offset
+
+@app.cli.command('benchmark-json')
+@click.option('--readings', type=int, default=100000, help='Readings in the encoded payloads')
+def benchmark_json_command(readings):
+    """Compare the JSON serializers on readings payloads."""
+    from utils.json_benchmark import benchmark_serializers, format_results
+    click.echo(format_results(benchmark_serializers(readings)))
+
+@app.cli.command('profile-startup')
+@click.option('--module', default='app', help='Module to import in a fresh interpreter')
+def profile_startup_command(module):
+    """Report the cold import time of the API."""
+    from utils.startup_profile import profile_import, format_report
+    click.echo(format_report(profile_import(module)))
 
 # Optional parameters
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'], defaults={'device_type':None, 'start':None, 'end':None})
@@ -32,21 +428,33 @@ def request_device_readings(device_uuid, device_type, start, end):
     * date_created -> The epoch date of the sensor reading.
         If none provided, we set to now.
 
+    POST Headers:
+    * Idempotency-Key -> Optional, a retried reading with the same key is
+        answered with 200 duplicate instead of being stored again
+
     Optional Query Parameters:
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * format -> objects (default), a list with one object per reading, or
+        columnar, device_uuid and type once plus parallel date_created and
+        value arrays. Without a type the columnar types array has the type of
+        every reading.
     """
 
-    # Set the db that we want and open the connection
-    if app.config['TESTING']:
-        conn = sqlite3.connect('test_database.db')
-    else:
-        conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-   
     if request.method == 'POST':
+        # A retry already stored is answered first, it must not use up the device rate
+        recent_keys = get_recent_ingest_keys()
+        ingest_key = get_ingest_key()
+        if ingest_key is not None and recent_keys.seen((device_uuid, ingest_key)):
+            INGEST_DUPLICATES.inc(('memory',))
+            return 'duplicate', 200
+
+        # Rejected before any parsing, a flooding device must cost as little as possible
+        rejection = admit_reading(device_uuid)
+        if rejection is not None:
+            return rejection
+
         # Grab the post parameters
         post_data = json.loads(request.data)
 
@@ -56,30 +464,194 @@ def request_device_readings(device_uuid, device_type, start, end):
         except ValidationError as error:
             return error.messages, 400
 
+        if ingest_key is None:
+            ingest_key = get_ingest_key(post_data)
+            if ingest_key is not None and recent_keys.seen((device_uuid, ingest_key)):
+                INGEST_DUPLICATES.inc(('memory',))
+                return 'duplicate', 200
+
         sensor_type = post_data.get('type')
         value = post_data.get('value')
         date_created = post_data.get('date_created', int(time.time()))
 
-        # Insert data into db
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (device_uuid, sensor_type, value, date_created))
-        
-        conn.commit()
+        # Insert data into db, the gauge counts the inserts waiting for or holding the writer
+        bus = get_event_bus()
+        shedder = get_load_shedder()
+        INGEST_QUEUE_DEPTH.inc()
+        shedder.start()
+        write_started = time.perf_counter()
+        try:
+            storage = get_storage()
+            with storage.writer() as conn:
+                cur = conn.cursor()
+                device_id = storage.devices.register_device(conn, device_uuid)
+                # The primary key of ingest_keys settles the duplicates the memory filter missed
+                stored = ingest_key is None or claim_ingest_key(conn, device_id, ingest_key)
+                if stored:
+                    cur.execute(INSERT_READING, (device_id, TYPE_IDS[sensor_type], value, date_created))
+                    reading_id = cur.lastrowid
+                    # The clustered layout has no rowid for the streams to resume from
+                    if bus.has_subscribers(device_uuid) and readings_layout(conn) == CLUSTERED:
+                        reading_id = None
+                    add_reading_to_sketch(cur, device_id, sensor_type, value, date_created,
+                                          app.config['SKETCH_K'], app.config['SKETCH_BUCKET_SECONDS'])
+                    # Only the rules of this device and type are looked at
+                    rules = storage.alert_rules.matching(conn, device_uuid, sensor_type, value)
+                    alerts = record_alerts(conn, rules, device_id, device_uuid, sensor_type, value, date_created) if rules else []
+        finally:
+            shedder.finish(time.perf_counter() - write_started)
+            INGEST_QUEUE_DEPTH.dec()
+
+        if ingest_key is not None:
+            recent_keys.add((device_uuid, ingest_key))
+        if not stored:
+            INGEST_DUPLICATES.inc(('database',))
+            return 'duplicate', 200
+
+        # Published once committed, a stream never sees a reading that was rolled back
+        if bus.has_subscribers(device_uuid):
+            bus.publish(device_uuid, {'id': reading_id, 'data': {'device_uuid': device_uuid, 'type': sensor_type,
+                                                                  'value': value, 'date_created': date_created}})
+        for alert in alerts:
+            bus.publish(ALERTS_TOPIC, {'id': alert['id'], 'data': alert})
 
         # Return success
         return 'success', 201
     else:
+        response_format = request.args.get('format', 'objects')
+        if response_format not in ('objects', 'columnar'):
+            return 'format must be objects or columnar', 400
+
         # Check for dates parameters
-        start_date, end_date = getDefaultDatesParams(start, end)
+        try:
+            start_date, end_date = getDefaultDatesParams(start, end)
+        except InvalidTimeRange as error:
+            return str(error), 400
+
+        conn = get_read_connection()
+        cur = conn.cursor()
         
         # Append optional parameters
-        selectQuery = 'select * from readings where device_uuid=?1 AND (?2 IS NULL OR type=?2) AND date_created BETWEEN ?3 AND ?4'
+        selectQuery = 'select type_id, value, date_created from reading_rows where device_id=?1 AND (?2 IS NULL OR type_id=?2) AND date_created BETWEEN ?3 AND ?4'
+
+        if response_format == 'columnar':
+            # Plain tuples, the arrays are filled straight from the fetched batches
+            cur.row_factory = None
+            cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
+            type_ids, values, dates = fetch_columns(cur, 3)
+            response = {'device_uuid': device_uuid, 'type': device_type, 'date_created': dates, 'value': values}
+            if device_type is None:
+                response['types'] = [TYPE_NAMES[type_id] for type_id in type_ids]
+            return json_response(response), 200
+
         # Execute the query
-        cur.execute(selectQuery, [device_uuid, device_type, start_date, end_date])        
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
         rows = cur.fetchall()
 
         # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
+        return json_response([{'device_uuid': device_uuid, 'type': TYPE_NAMES[type_id], 'value': value, 'date_created': date_created}
+                        for type_id, value, date_created in rows]), 200
+
+def format_event(data, event='reading', event_id=None):
+    """
+    One Server-Sent Event, data is sent as JSON
+    """
+    lines = [] if event_id is None else ['id: {}'.format(event_id)]
+    lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(get_json_serializer().dumps(data).decode('utf-8')))
+    return '\n'.join(lines) + '\n\n'
+
+def get_last_event_id():
+    """
+    Id a stream resumes after, from Last-Event-ID or ?last_id=. Raises ValueError.
+    """
+    last_id = request.headers.get('Last-Event-ID', request.args.get('last_id'))
+    return None if last_id is None else int(last_id)
+
+def event_stream(topic, event, last_id=None, replay=None, accept=None):
+    """
+    Server-Sent Events of a topic of the event bus, published as {'id', 'data'}.
+    replay(last_id, limit) gives the first limit (id, data) stored after last_id,
+    it is called page by page until the stored events run out, before the live
+    events. A client too slow to keep up gets an overflow event and the stream
+    ends, reconnecting resumes it.
+    """
+    bus = get_event_bus()
+    keepalive = app.config['STREAM_KEEPALIVE_SECONDS']
+    page_size = app.config['STREAM_REPLAY_PAGE_SIZE']
+    # Subscribed before the replay so nothing stored meanwhile is missed,
+    # the live events already replayed are skipped
+    subscription = bus.subscribe(topic)
+
+    def generate():
+        try:
+            # Servers send the headers along with the first chunk, so one is sent right away
+            yield ': connected\n\n'
+            replayed_id = last_id
+            if last_id is not None and replay is not None:
+                # A page at a time, an old last id never loads the whole history
+                while True:
+                    page = replay(replayed_id, page_size)
+                    for event_id, data in page:
+                        yield format_event(data, event, event_id)
+                        replayed_id = event_id
+                    if len(page) < page_size:
+                        break
+
+            while True:
+                if subscription.overflowed:
+                    yield format_event({'reason': 'slow consumer'}, event='overflow')
+                    return
+                try:
+                    published = subscription.get(keepalive)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if accept is not None and not accept(published['data']):
+                    continue
+                if replayed_id is not None and published['id'] is not None and published['id'] <= replayed_id:
+                    continue
+                yield format_event(published['data'], event, published['id'])
+        finally:
+            bus.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Also when the body was never read
+    response.call_on_close(lambda: bus.unsubscribe(subscription))
+    return response
+
+@app.route('/devices/<string:device_uuid>/readings/stream/', methods = ['GET'], defaults={'device_type':None})
+@app.route('/devices/<string:device_uuid>/<string:device_type>/readings/stream/', methods = ['GET'])
+def request_device_readings_stream(device_uuid, device_type):
+    """
+    This endpoint allows clients to follow the new readings of a device with
+    Server-Sent Events instead of polling. Each event id is the reading id, a
+    client that reconnects with Last-Event-ID first gets the readings stored
+    since then.
+
+    Optional Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * last_id -> Replay the readings after this id, like Last-Event-ID
+    """
+    try:
+        last_id = get_last_event_id()
+    except ValueError:
+        return 'last_id must be an integer', 400
+
+    storage = get_storage()
+
+    def replay(after_id, limit):
+        with storage.reader() as conn:
+            # Only the heap layout has rowids
+            if readings_layout(conn) != HEAP:
+                return []
+            selectQuery = REPLAY_READINGS if device_type is None else REPLAY_TYPE_READINGS
+            rows = conn.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), after_id, limit]).fetchall()
+        return [(reading_id, {'device_uuid': device_uuid, 'type': TYPE_NAMES[type_id], 'value': value, 'date_created': date_created})
+                for reading_id, type_id, value, date_created in rows]
+
+    accept = None if device_type is None else lambda reading: reading['type'] == device_type
+    return event_stream(device_uuid, 'reading', last_id, replay, accept)
 
 @app.route('/devices/<string:device_uuid>/<string:device_type>/readings/max/', methods = ['GET'], defaults={'start':None, 'end':None})
 @app.route('/devices/<string:device_uuid>/<string:device_type>/<string:start>/readings/max/', methods = ['GET'], defaults={'end':None})
@@ -96,25 +668,22 @@ def request_device_readings_max(device_uuid, device_type, start, end):
     * end -> The epoch end time for a sensor being created
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_read_connection()
         cur = conn.cursor()
 
         # Check for dates parameters
         start_date, end_date = getDefaultDatesParams(start, end)
 
         # Append optional parameters
-        selectQuery = 'select MAX(value) from readings where device_uuid=?1 AND type=?2 AND date_created BETWEEN ?3 AND ?4'
+        selectQuery = 'select MAX(value) from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4'
         # Execute the query
-        cur.execute(selectQuery, [device_uuid, device_type, start_date, end_date])        
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
         max = cur.fetchone()[0]
 
         # Return the JSON
-        return jsonify({'value': max}), 200
+        return json_response({'value': max}), 200
+    except InvalidTimeRange as error:
+        return str(error), 400
     except:
         return 'An unexpected error happened', 500
 
@@ -132,32 +701,43 @@ def request_device_readings_median(device_uuid, device_type, start, end):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> Use the quantile sketches instead of reading every value
+    * accuracy -> The sketch parameter for the approximate mode
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        accuracy = get_approximate_accuracy(request.args)
+    except ValueError as error:
+        return str(error), 400
+
+    try:
+        conn = get_read_connection()
         cur = conn.cursor()
 
         # Check for dates parameters
         start_date, end_date = getDefaultDatesParams(start, end)
 
+        if accuracy is not None:
+            sketch = device_sketch(cur, get_device_id(conn, device_uuid), device_type, start_date, end_date,
+                                   accuracy, app.config['SKETCH_BUCKET_SECONDS'])
+            return json_response({'value': sketch.quantile(0.5), 'error_bound': sketch.error_bound}), 200
+
         # Append optional parameters
-        selectQuery = 'select value from readings where device_uuid=?1 AND type=?2 AND date_created BETWEEN ?3 AND ?4'
+        selectQuery = 'select value from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4'
         # Execute the query
-        cur.execute(selectQuery, [device_uuid, device_type, start_date, end_date])        
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
         values = cur.fetchall()
 
         #Calculate the median
-        dataFrame = DataFrame(values)
+        from pandas import DataFrame
+        with DATAFRAME_BUILD_SECONDS.time():
+            dataFrame = DataFrame(values)
         median_series = dataFrame.median()
         median = median_series[0]
 
         # Return the JSON
-        return jsonify({'value': median}), 200
+        return json_response({'value': median}), 200
+    except InvalidTimeRange as error:
+        return str(error), 400
     except:
         return 'An unexpected error happened', 500
 
@@ -176,31 +756,30 @@ def request_device_readings_mean(device_uuid, device_type, start, end):
     * end -> The epoch end time for a sensor being created
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        conn = get_read_connection()
         cur = conn.cursor()
 
         # Check for dates parameters
         start_date, end_date = getDefaultDatesParams(start, end)
 
         # Append optional parameters
-        selectQuery = 'select value from readings where device_uuid=?1 AND type=?2 AND date_created BETWEEN ?3 AND ?4'
+        selectQuery = 'select value from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4'
         # Execute the query
-        cur.execute(selectQuery, [device_uuid, device_type, start_date, end_date])        
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
         values = cur.fetchall()
 
         #Calculate the mean
-        dataFrame = DataFrame(values)
+        from pandas import DataFrame
+        with DATAFRAME_BUILD_SECONDS.time():
+            dataFrame = DataFrame(values)
         mean_series = dataFrame.mean()
         mean = mean_series[0]
 
         # Return the JSON
-        return jsonify({'value': mean}), 200
+        return json_response({'value': mean}), 200
 
+    except InvalidTimeRange as error:
+        return str(error), 400
     except:
         return 'An unexpected error happened', 500
 
@@ -215,38 +794,240 @@ def request_device_readings_quartiles(device_uuid, device_type, start, end):
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    Optional Query Parameters
+    * approx -> Use the quantile sketches instead of reading every value
+    * accuracy -> The sketch parameter for the approximate mode
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        accuracy = get_approximate_accuracy(request.args)
+    except ValueError as error:
+        return str(error), 400
+
+    try:
+        conn = get_read_connection()
         cur = conn.cursor()
 
         # Check for dates parameters
         start_date, end_date = getDefaultDatesParams(start, end)
 
+        if accuracy is not None:
+            sketch = device_sketch(cur, get_device_id(conn, device_uuid), device_type, start_date, end_date,
+                                   accuracy, app.config['SKETCH_BUCKET_SECONDS'])
+            response = {'quartile_1': sketch.quantile(0.25), 'quartile_3': sketch.quantile(0.75),
+                        'error_bound': sketch.error_bound}
+            return json_response(response), 200
+
         # Append optional parameters
-        selectQuery = 'select value from readings where device_uuid=?1 AND type=?2 AND date_created BETWEEN ?3 AND ?4'
+        selectQuery = 'select value from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4'
         # Execute the query
-        cur.execute(selectQuery, [device_uuid, device_type, start_date, end_date])        
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
         values = cur.fetchall()
 
-        #Calculate the mean
-        dataFrame = DataFrame(values)
+        #Calculate the quartiles
+        from pandas import DataFrame
+        with DATAFRAME_BUILD_SECONDS.time():
+            dataFrame = DataFrame(values)
         quantile_series = dataFrame.quantile([0.25, 0.75])
         response = {'quartile_1': quantile_series.values[0][0], 'quartile_3': quantile_series.values[1][0]}
         
         # Return the JSON
-        return jsonify(response), 200
+        return json_response(response), 200
 
+    except InvalidTimeRange as error:
+        return str(error), 400
     except:
         return 'An unexpected error happened', 500
 
     return 'Endpoint is not implemented', 501
 
+@app.route('/devices/<string:device_uuid>/<string:device_type>/readings/stats/', methods = ['GET'], defaults={'start':None, 'end':None})
+@app.route('/devices/<string:device_uuid>/<string:device_type>/<string:start>/readings/stats/', methods = ['GET'], defaults={'end':None})
+@app.route('/devices/<string:device_uuid>/<string:device_type>/<string:start>/<string:end>/readings/stats/', methods = ['GET'])
+def request_device_readings_stats(device_uuid, device_type, start, end):
+    """
+    This endpoint allows clients to GET several metrics of a device at once,
+    the range is read a single time and every metric comes from its histogram.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * metrics -> Comma separated list of count, min, max, mean, median
+        and quartiles. All of them by default.
+    """
+    try:
+        metrics = parse_metrics(request.args.get('metrics'))
+    except ValueError as error:
+        return str(error), 400
+
+    try:
+        conn = get_read_connection()
+        cur = conn.cursor()
+
+        # Check for dates parameters
+        start_date, end_date = getDefaultDatesParams(start, end)
+
+        # Values are bounded to 0-100 so the histogram has at most 101 rows
+        selectQuery = 'select value, count(*) from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4 group by value order by value'
+        # Execute the query
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
+        histogram = [(row[0], row[1]) for row in cur.fetchall()]
+
+        # Return the JSON
+        return json_response(histogram_metrics(histogram, metrics)), 200
+
+    except InvalidTimeRange as error:
+        return str(error), 400
+    except:
+        return 'An unexpected error happened', 500
+
+@app.route('/devices/<string:device_uuid>/<string:device_type>/readings/aggregates/', methods = ['GET'], defaults={'start':None, 'end':None})
+@app.route('/devices/<string:device_uuid>/<string:device_type>/<string:start>/readings/aggregates/', methods = ['GET'], defaults={'end':None})
+@app.route('/devices/<string:device_uuid>/<string:device_type>/<string:start>/<string:end>/readings/aggregates/', methods = ['GET'])
+def request_device_readings_aggregates(device_uuid, device_type, start, end):
+    """
+    This endpoint allows clients to GET the aggregates the retention left
+    of the readings past their raw retention, one per bucket.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time of the first bucket
+    * end -> The epoch start time of the last bucket
+    """
+    try:
+        conn = get_read_connection()
+        cur = conn.cursor()
+
+        # Check for dates parameters
+        start_date, end_date = getDefaultDatesParams(start, end)
+
+        selectQuery = '''select bucket_start, bucket_seconds, count, sum, min, max from readings_aggregates
+                         where device_id=?1 AND type_id=?2 AND bucket_start BETWEEN ?3 AND ?4 order by bucket_start'''
+        # Execute the query
+        cur.execute(selectQuery, [get_device_id(conn, device_uuid), encode_type(device_type), start_date, end_date])
+        aggregates = []
+        for bucket_start, bucket_seconds, count, total, minimum, maximum in cur:
+            aggregates.append({'bucket_start': bucket_start, 'bucket_seconds': bucket_seconds, 'count': count,
+                               'mean': total / count, 'min': minimum, 'max': maximum})
+
+        # Return the JSON
+        return json_response(aggregates), 200
+
+    except InvalidTimeRange as error:
+        return str(error), 400
+    except:
+        return 'An unexpected error happened', 500
+
+@app.route('/readings/stats/query/', methods = ['POST'])
+def request_readings_stats_query():
+    """
+    This endpoint allows clients to get the metrics of many devices with a
+    single request and a single grouped query. The response is keyed by device.
+
+    POST Parameters:
+    * device_uuids -> The list of devices, up to 1000
+    * type -> The type of sensor (temperature or humidity)
+    * start -> The epoch start time for a sensor being created (optional)
+    * end -> The epoch end time for a sensor being created (optional)
+    * metrics -> List of count, min, max, mean, median and quartiles (optional)
+    """
+    # Grab the post parameters
+    post_data = json.loads(request.data)
+
+    # Validate parameters
+    try:
+        StatsQuerySchema().load(post_data)
+        metrics = parse_metrics(post_data.get('metrics'))
+    except ValidationError as error:
+        return error.messages, 400
+
+    try:
+        conn = get_read_connection()
+        cur = conn.cursor()
+
+        # Check for dates parameters
+        start_date, end_date = getDefaultDatesParams(post_data.get('start'), post_data.get('end'))
+
+        # The device list is bound as a single JSON parameter, so its size is not capped by the SQLite variables limit
+        device_uuids = list(dict.fromkeys(post_data['device_uuids']))
+        device_ids = get_storage().devices.device_ids(conn, device_uuids)
+        selectQuery = 'select device_id, value, count(*) from reading_rows where device_id IN (select value from json_each(?1)) AND type_id=?2 AND date_created BETWEEN ?3 AND ?4 group by device_id, value order by device_id, value'
+        cur.execute(selectQuery, [json.dumps(list(device_ids.values())), encode_type(post_data['type']), start_date, end_date])
+
+        histograms = {device_uuid: [] for device_uuid in device_uuids}
+        uuids_by_id = {device_id: device_uuid for device_uuid, device_id in device_ids.items()}
+        for device_id, value, count in cur:
+            histograms[uuids_by_id[device_id]].append((value, count))
+
+        # Return the JSON
+        return json_response({device_uuid: histogram_metrics(histogram, metrics) for device_uuid, histogram in histograms.items()}), 200
+
+    except InvalidTimeRange as error:
+        return str(error), 400
+    except:
+        return 'An unexpected error happened', 500
+
+def compute_readings_summary(conn, device_type, start, end, sort_key='number_of_readings', reverse=True, limit=None, offset=0, accuracy=None):
+    """
+    Per device summary shared by the summary endpoint and the summary jobs.
+    The approximate mode merges the sketches, without a date range the summary
+    state answers it and otherwise the readings in range are described per device,
+    in parallel across the summary pool when there are enough of them.
+    """
+    cur = conn.cursor()
+
+    # Check for dates parameters
+    start_date, end_date = getDefaultDatesParams(start, end)
+
+    if accuracy is not None:
+        sketches = devices_sketches(cur, device_type, start_date, end_date,
+                                    accuracy, app.config['SKETCH_BUCKET_SECONDS'])
+        device_uuids = get_storage().devices.device_uuids(conn, list(sketches))
+        summary = []
+        for device_id, sketch in sketches.items():
+            summary.append({
+                'device_uuid': device_uuids[device_id],
+                'number_of_readings': sketch.count,
+                'max_reading_value': sketch.max,
+                'median_reading_value': sketch.quantile(0.5),
+                'mean_reading_value': sketch.sum / sketch.count,
+                'quartile_1_value': sketch.quantile(0.25),
+                'quartile_3_value': sketch.quantile(0.75),
+                'error_bound': sketch.error_bound
+            })
+        return top_summary_by_key(summary, sort_key, reverse, limit, offset)
+
+    # Without a date range the summary state kept on ingest has the answer
+    if start is None and end is None:
+        return summary_from_state(cur, get_storage().devices, device_type, sort_key, reverse, limit, offset)
+
+    # Append optional parameters
+    # Read in device order, sorted only for a narrow range, see range_readings_query()
+    type_id = encode_type(device_type)
+    selectQuery = range_readings_query(conn, type_id, start_date, end_date, app.config['SUMMARY_SORTED_RANGE_FRACTION'])
+    # Execute the query
+    cur.execute(selectQuery, [type_id, start_date, end_date])
+
+    # Each device is described once its run of values ends, in shards across the summary pool,
+    # so only the values of the device being read (and the shards in flight) are in memory
+    from utils.parallel_summary import describe_devices, device_runs
+    described = describe_devices(device_runs(cur, app.config['SUMMARY_BATCH_SIZE']), get_summary_pool(),
+                                 app.config['SUMMARY_CHUNK_SIZE'], app.config['SUMMARY_PARALLEL_MIN_READINGS'])
+    device_uuids = get_storage().devices.device_uuids(conn, list(described))
+
+    summary = []
+    for device_id, device_stats in described.items():
+        device_summary = {'device_uuid': device_uuids[device_id]}
+        device_summary.update(device_stats)
+        summary.append(device_summary)
+
+    return top_summary_by_key(summary, sort_key, reverse, limit, offset)
+
 @app.route('/devices/readings/summary/', methods = ['GET'], defaults={'device_type':None, 'start':None, 'end':None})
 @app.route('/devices/<string:device_type>/readings/summary/', methods = ['GET'], defaults={'start':None, 'end':None})
 @app.route('/devices/<string:device_type>/<string:start>/readings/summary/', methods = ['GET'], defaults={'end':None})
@@ -255,56 +1036,295 @@ def request_readings_summary(device_type, start, end):
     """
     This endpoint allows clients to GET a full summary
     of all sensor data in the database per device.
+    Without start and end it is served from the summary state
+    that is updated on every insert.
 
     Optional Query Parameters
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> Use the quantile sketches instead of reading every value
+    * accuracy -> The sketch parameter for the approximate mode
+    * sort_by -> The summary key to sort by, number_of_readings by default
+    * order -> asc or desc (default)
+    * limit -> Only return the top limit devices
+    * offset -> The number of devices to skip
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        accuracy = get_approximate_accuracy(request.args)
+        sort_key, reverse, limit, offset = get_summary_page(request.args)
+    except ValueError as error:
+        return str(error), 400
+
+    try:
+        conn = get_read_connection()
+        summary = compute_readings_summary(conn, device_type, start, end, sort_key, reverse, limit, offset, accuracy)
+        return json_response(summary), 200
+
+    except InvalidTimeRange as error:
+        return str(error), 400
+    except:
+        return 'An unexpected error happened', 500
+    
+
+def get_summary_pool():
+    """
+    The worker processes of the summaries, None when they run in the web process
+    """
+    global summary_pool
+    workers = app.config['SUMMARY_WORKERS']
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    if summary_pool is None:
+        with globals_lock:
+            if summary_pool is None:
+                from utils.parallel_summary import create_summary_pool
+                summary_pool = create_summary_pool(workers)
+    return summary_pool
+
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        with globals_lock:
+            if job_queue is None:
+                if app.config['JOB_BACKEND'] == 'inprocess':
+                    jobs = InProcessJobQueue(app.config['JOB_WORKERS'], app.config['JOB_RESULT_TTL_SECONDS'])
+                else:
+                    jobs = SQLiteJobQueue(get_database_path(app.config['TESTING']), app.config['JOB_WORKERS'],
+                                          app.config['JOB_RESULT_TTL_SECONDS'], app.config['JOB_POLL_SECONDS'])
+                # Registered before it is published, the other threads read it without the lock
+                jobs.register('summary', run_summary_job)
+                job_queue = jobs
+    return job_queue
+
+def run_summary_job(device_type, start, end, sort_key, reverse, limit, offset, accuracy):
+    with get_storage().reader() as conn:
+        return compute_readings_summary(conn, device_type, start, end, sort_key, reverse, limit, offset, accuracy)
+
+def job_response(job):
+    response = {'job_id': job['id'], 'status': job['status']}
+    if job['status'] == FINISHED:
+        response['result'] = job['result']
+    if job['error'] is not None:
+        response['error'] = job['error']
+    return response
+
+@app.route('/devices/readings/summary/jobs/', methods = ['POST'])
+def request_readings_summary_job():
+    """
+    This endpoint allows clients to compute a summary in the background,
+    it returns a job id to poll. Identical jobs that are still running are shared.
+
+    POST Parameters (all optional):
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * sort_by, order, limit, offset, approx, accuracy -> Same as the summary endpoint
+    """
+    # Grab the post parameters
+    post_data = json.loads(request.data or '{}')
+
+    # Validate parameters
+    try:
+        SummaryJobSchema().load(post_data)
+        accuracy = get_approximate_accuracy(post_data)
+        sort_key, reverse, limit, offset = get_summary_page(post_data)
+        getDefaultDatesParams(post_data.get('start'), post_data.get('end'))
+    except ValidationError as error:
+        return error.messages, 400
+    except ValueError as error:
+        return str(error), 400
+
+    args = (post_data.get('type'), post_data.get('start'), post_data.get('end'), sort_key, reverse, limit, offset, accuracy)
+    job = get_job_queue().enqueue(json.dumps(args), run_summary_job, *args)
+
+    return json_response(job_response(job)), 202, {'Location': '/devices/readings/summary/jobs/{}/'.format(job['id'])}
+
+@app.route('/devices/readings/summary/jobs/<string:job_id>/', methods = ['GET'])
+def request_readings_summary_job_status(job_id):
+    """
+    This endpoint allows clients to GET the status of a summary job,
+    and its result once it is finished.
+    """
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return 'Job not found', 404
+    return json_response(job_response(job)), 200
+
+@app.route('/readings/fleet/', methods = ['GET'], defaults={'device_type':None, 'start':None, 'end':None})
+@app.route('/readings/fleet/<string:device_type>/', methods = ['GET'], defaults={'start':None, 'end':None})
+@app.route('/readings/fleet/<string:device_type>/<string:start>/', methods = ['GET'], defaults={'end':None})
+@app.route('/readings/fleet/<string:device_type>/<string:start>/<string:end>/', methods = ['GET'])
+def request_fleet_readings(device_type, start, end):
+    """
+    This endpoint allows clients to GET fleet wide metrics: total readings,
+    active devices and min, max, mean, median and quartiles over every device.
+    It never builds the per device list, the values are folded into a
+    histogram (values are bounded to 0-100) so memory stays constant.
+
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * approx_devices -> Count the active devices with a HyperLogLog
+    * precision -> The HyperLogLog precision, between 4 and 16
+    """
+    approximate_devices = request.args.get('approx_devices', '').lower() in ('1', 'true', 'yes')
+    try:
+        device_counter = HyperLogLog(request.args.get('precision', 14, type=int)) if approximate_devices else None
+    except ValueError as error:
+        return str(error), 400
+
+    try:
+        conn = get_read_connection()
         cur = conn.cursor()
 
         # Check for dates parameters
         start_date, end_date = getDefaultDatesParams(start, end)
 
-        # Append optional parameters
-        selectQuery = 'select device_uuid, value from readings where (?1 IS NULL OR type=?1) AND date_created BETWEEN ?2 AND ?3'
-        # Execute the query
-        cur.execute(selectQuery, [device_type, start_date, end_date])        
-        values = cur.fetchall()
+        if device_counter is None:
+            # Let SQLite aggregate, only the histogram rows come back
+            selectQuery = 'select value, count(*) from reading_rows where (?1 IS NULL OR type_id=?1) AND date_created BETWEEN ?2 AND ?3 group by value order by value'
+            cur.execute(selectQuery, [encode_type(device_type), start_date, end_date])
+            histogram = [(row[0], row[1]) for row in cur.fetchall()]
 
-        # Add columns so we can compute for every single device
-        data_frame = DataFrame(values, columns=['device_uuid', 'value'])
-        data_grouped = data_frame.groupby('device_uuid')        
-                
-        summary = []
-        for group in data_grouped:
-            device_uuid = group[0]
-            device_data_frame = data_frame.loc[data_frame['device_uuid'] == device_uuid]
-            device_data = device_data_frame.describe()
-            summary.append({
-                'device_uuid':device_uuid,
-                'number_of_readings': device_data.loc['count'].value,
-                'max_reading_value': device_data.loc['max'].value,
-                'median_reading_value': device_data_frame.median()[0],
-                'mean_reading_value': device_data.loc['mean'].value,
-                'quartile_1_value': device_data.loc['25%'].value,
-                'quartile_3_value': device_data.loc['75%'].value
-            })
+            selectQuery = 'select count(distinct device_id) from reading_rows where (?1 IS NULL OR type_id=?1) AND date_created BETWEEN ?2 AND ?3'
+            cur.execute(selectQuery, [encode_type(device_type), start_date, end_date])
+            active_devices = cur.fetchone()[0]
+        else:
+            # A single streaming pass feeds both the histogram and the HyperLogLog
+            selectQuery = 'select device_id, value from reading_rows where (?1 IS NULL OR type_id=?1) AND date_created BETWEEN ?2 AND ?3'
+            cur.execute(selectQuery, [encode_type(device_type), start_date, end_date])
+            counts = {}
+            for device_id, value in cur:
+                counts[value] = counts.get(value, 0) + 1
+                device_counter.add(device_id)
+            histogram = sorted(counts.items())
+            active_devices = device_counter.count()
 
-        sorted_summary = sort_summary_by_key(summary, 'number_of_readings', True)
-         
-        return jsonify(sorted_summary), 200
+        response = histogram_stats(histogram)
+        response['active_devices'] = active_devices
+        if device_counter is not None:
+            response['active_devices_error'] = device_counter.relative_error
 
+        return json_response(response), 200
+
+    except InvalidTimeRange as error:
+        return str(error), 400
     except:
         return 'An unexpected error happened', 500
-    
+
+
+@app.route('/alerts/rules/', methods = ['POST', 'GET'])
+def request_alert_rules():
+    """
+    This endpoint allows clients to POST a threshold rule checked on every
+    reading posted, or to GET the rules.
+
+    POST Parameters:
+    * device_uuid -> The device of the rule, every device when missing or null
+    * type -> The type of sensor (temperature or humidity)
+    * operator -> >, >=, <, <= or ==
+    * threshold -> The integer the reading values are compared with
+    """
+    if request.method == 'POST':
+        # Grab the post parameters
+        post_data = json.loads(request.data)
+
+        # Validate parameters
+        try:
+            AlertRuleSchema().load(post_data)
+        except ValidationError as error:
+            return error.messages, 400
+
+        with get_storage().writer() as conn:
+            rule = create_rule(conn, post_data.get('device_uuid'), post_data['type'], post_data['operator'], post_data['threshold'])
+        return json_response(rule), 201
+
+    conn = get_read_connection()
+    rows = conn.execute('select {} from alert_rules order by id'.format(', '.join(RULE_FIELDS))).fetchall()
+    return json_response([dict(zip(RULE_FIELDS, row)) for row in rows]), 200
+
+@app.route('/alerts/rules/<int:rule_id>/', methods = ['DELETE'])
+def request_alert_rule_delete(rule_id):
+    """
+    This endpoint allows clients to DELETE an alert rule, its alerts are kept.
+    """
+    with get_storage().writer() as conn:
+        deleted = conn.execute('delete from alert_rules where id=?1', [rule_id]).rowcount
+    if not deleted:
+        return 'Rule not found', 404
+    return '', 204
+
+@app.route('/alerts/', methods = ['GET'])
+def request_alerts():
+    """
+    This endpoint allows clients to GET the alerts fired by the rules, oldest first.
+
+    Optional Query Parameters:
+    * device_uuid -> Only the alerts of this device
+    * after_id -> Only the alerts after this id
+    * limit -> The number of alerts, 100 by default
+    """
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+
+    device_uuid = request.args.get('device_uuid')
+
+    conn = get_read_connection()
+    device_id = None if device_uuid is None else get_device_id(conn, device_uuid)
+    return json_response(select_alerts(conn, get_storage().devices, device_id, after_id, limit)), 200
+
+@app.route('/alerts/stream/', methods = ['GET'])
+def request_alerts_stream():
+    """
+    This endpoint allows clients to follow the alerts as they fire with
+    Server-Sent Events. Reconnecting with Last-Event-ID first replays the
+    alerts fired since then.
+
+    Optional Query Parameters:
+    * device_uuid -> Only the alerts of this device
+    * last_id -> Replay the alerts after this id, like Last-Event-ID
+    """
+    try:
+        last_id = get_last_event_id()
+    except ValueError:
+        return 'last_id must be an integer', 400
+
+    device_uuid = request.args.get('device_uuid')
+    storage = get_storage()
+
+    def replay(after_id, limit):
+        with storage.reader() as conn:
+            device_id = None if device_uuid is None else get_device_id(conn, device_uuid)
+            alerts = select_alerts(conn, storage.devices, device_id, after_id, limit)
+        return [(alert['id'], alert) for alert in alerts]
+
+    accept = None if device_uuid is None else lambda alert: alert['device_uuid'] == device_uuid
+    return event_stream(ALERTS_TOPIC, 'alert', last_id, replay, accept)
+
+@app.route('/metrics', methods = ['GET'])
+def request_metrics():
+    """
+    This endpoint exposes the request, database and ingest metrics
+    in the Prometheus text format.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/retention/status/', methods = ['GET'])
+def request_retention_status():
+    """
+    This endpoint allows clients to GET the progress of the background
+    retention compactor.
+    """
+    if retention_compactor is None:
+        return json_response({'running': False, 'last_run': None, 'report': None}), 200
+    return json_response(retention_compactor.status), 200
+
 
 if __name__ == '__main__':
+    init_db(get_database_path(app.config['TESTING']))
+    start_retention_compactor()
     app.run()
@@ -0,0 +1,35 @@
+import unittest
+
+from utils.admission import LoadShedder, TokenBuckets
+
+class AdmissionTestCases(unittest.TestCase):
+
+    def test_token_bucket_refills_at_the_rate(self):
+        buckets = TokenBuckets(rate=2, burst=2)
+
+        self.assertEqual([buckets.acquire('device', now=0) for _ in range(3)], [0, 0, 0.5])
+        # Half a second later one token is back
+        self.assertEqual(buckets.acquire('device', now=0.5), 0)
+        self.assertEqual(buckets.acquire('other', now=0.5), 0)
+
+    def test_idle_and_extra_buckets_are_evicted(self):
+        buckets = TokenBuckets(rate=1, burst=1, idle_seconds=10, max_keys=2)
+        buckets.acquire('first', now=0)
+        buckets.acquire('second', now=5)
+        buckets.acquire('third', now=6)
+        self.assertEqual(len(buckets), 2)
+
+        buckets.acquire('third', now=20)
+        self.assertEqual(len(buckets), 1)
+
+    def test_shedding_on_backlog_and_latency(self):
+        shedder = LoadShedder(max_backlog=2, max_latency=0.5, smoothing=1.0, stale_seconds=1.0)
+        shedder.start()
+        shedder.start()
+        self.assertEqual(shedder.admit(now=0), ('backlog', 1))
+
+        shedder.finish(0.1, now=0)
+        shedder.finish(2.0, now=0)
+        self.assertEqual(shedder.admit(now=0.5), ('latency', 2))
+        # Without fresh writes the latency is stale and a probe goes through
+        self.assertIsNone(shedder.admit(now=1.5))
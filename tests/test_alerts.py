@@ -0,0 +1,39 @@
+import sqlite3
+import unittest
+
+from utils.alerts import AlertRuleIndex, create_rule
+from utils.db_utils import reset_db
+
+class AlertRuleIndexTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        # One connection and one index per web worker process
+        self.first = sqlite3.connect('test_database.db')
+        self.second = sqlite3.connect('test_database.db')
+        self.addCleanup(self.first.close)
+        self.addCleanup(self.second.close)
+
+    def test_rules_changed_by_another_process_are_seen(self):
+        index = AlertRuleIndex()
+        self.assertEqual(index.matching(self.second, 'device', 'temperature', 90), [])
+
+        # Created through the first process, matched by the index of the second
+        rule = create_rule(self.first, 'device', 'temperature', '>', 80)
+        self.first.commit()
+        self.assertEqual(index.matching(self.second, 'device', 'temperature', 90), [rule])
+
+        # And no longer matched once deleted
+        self.first.execute('delete from alert_rules where id=?', [rule['id']])
+        self.first.commit()
+        self.assertEqual(index.matching(self.second, 'device', 'temperature', 90), [])
+
+    def test_rules_apply_to_their_device_and_type(self):
+        create_rule(self.first, None, 'temperature', '>=', 50)
+        create_rule(self.first, 'other', 'temperature', '>', 0)
+        create_rule(self.first, 'device', 'humidity', '>', 0)
+        self.first.commit()
+
+        index = AlertRuleIndex()
+        self.assertEqual([rule['threshold'] for rule in index.matching(self.second, 'device', 'temperature', 50)], [50])
+        self.assertEqual(index.matching(self.second, 'device', 'temperature', 49), [])
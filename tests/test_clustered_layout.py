@@ -0,0 +1,65 @@
+import sqlite3
+import unittest
+
+from utils.clustered_layout import copy_chunk, migrate_to_clustered, start_migration
+from utils.db_utils import CLUSTERED, HEAP, readings_layout, reset_db
+from utils.query_log import explain_query_plan
+from utils.retention import run_retention, DAY_SECONDS
+
+class ClusteredLayoutTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        self.conn = sqlite3.connect('test_database.db')
+        self.insert([('device', 'temperature', 10, 100), ('other', 'temperature', 20, 100),
+                     ('device', 'temperature', 30, 100), ('device', 'humidity', 40, 200)])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def insert(self, readings):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', readings)
+        self.conn.commit()
+
+    def readings(self):
+        return sorted(self.conn.execute('select * from readings').fetchall())
+
+    def test_migration_keeps_every_reading(self):
+        expected = self.readings()
+
+        report = migrate_to_clustered(self.conn, chunk_size=1)
+
+        self.assertTrue(report['finished'])
+        self.assertEqual(readings_layout(self.conn), CLUSTERED)
+        self.assertEqual(self.readings(), expected)
+        # Readings of the same second are told apart by seq
+        self.assertEqual(self.conn.execute('select seq from reading_rows where value IN (10, 30) order by seq').fetchall(), [(0,), (1,)])
+
+    def test_writes_during_the_migration_are_kept(self):
+        start_migration(self.conn)
+        copy_chunk(self.conn, 2)
+        self.conn.commit()
+
+        # Both the new reading and the delete of a copied one reach the clustered table
+        self.insert([('device', 'temperature', 50, 300 * DAY_SECONDS)])
+        run_retention(self.conn, {'temperature': {'raw_seconds': DAY_SECONDS, 'aggregate_seconds': None}}, now=300 * DAY_SECONDS)
+        expected = self.readings()
+
+        migrate_to_clustered(self.conn, chunk_size=2)
+
+        self.assertEqual(self.readings(), expected)
+        # The state only counts the readings the retention left, and the copy doesn't count them again
+        self.assertEqual(self.conn.execute("select count, sum from device_summaries JOIN devices ON devices.id = device_id where device_uuid='device' AND type_id=1").fetchone(), (1, 50))
+
+    def test_device_ranges_search_the_primary_key(self):
+        reset_db('test_database.db', CLUSTERED)
+        self.insert([('device', 'temperature', 10, 100)])
+
+        plan, access = explain_query_plan(self.conn, 'select value from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4', [1, 1, 0, 200])
+
+        self.assertEqual(access, 'SEARCH')
+        self.assertTrue(any('PRIMARY KEY' in detail for detail in plan))
+        self.assertEqual(self.readings(), [('device', 'temperature', 10, 100)])
+
+    def test_heap_is_the_default_layout(self):
+        self.assertEqual(readings_layout(self.conn), HEAP)
@@ -0,0 +1,30 @@
+import gzip
+import unittest
+import zlib
+
+from utils.compression import compress, compress_chunks, negotiate_encoding, parse_accept_encoding
+
+class CompressionTestCases(unittest.TestCase):
+
+    def test_accept_encoding_qualities(self):
+        self.assertEqual(parse_accept_encoding('gzip;q=0.5, br, *;q=0'), {'gzip': 0.5, 'br': 1.0, '*': 0.0})
+
+    def test_negotiation_prefers_quality_then_order(self):
+        self.assertEqual(negotiate_encoding('gzip, br', ['br', 'gzip']), 'br')
+        self.assertEqual(negotiate_encoding('gzip, br;q=0.5', ['br', 'gzip']), 'gzip')
+        self.assertEqual(negotiate_encoding('*', ['gzip']), 'gzip')
+        self.assertIsNone(negotiate_encoding('gzip;q=0, identity', ['gzip']))
+        self.assertIsNone(negotiate_encoding(None, ['gzip']))
+
+    def test_buffered_body_round_trip(self):
+        data = b'{"value": 22}' * 100
+        self.assertEqual(gzip.decompress(compress(data, 'gzip', 6)), data)
+
+    def test_streamed_chunks_decode_as_they_arrive(self):
+        decompressor = zlib.decompressobj(31)
+        chunks = compress_chunks(iter(['data: 1\n\n', b'data: 2\n\n']), 'gzip', 6)
+
+        # Every chunk is flushed, so it can be read before the stream ends
+        self.assertEqual(decompressor.decompress(next(chunks)), b'data: 1\n\n')
+        self.assertEqual(decompressor.decompress(next(chunks)), b'data: 2\n\n')
+        self.assertEqual(decompressor.decompress(b''.join(chunks)), b'')
@@ -0,0 +1,38 @@
+import unittest
+
+from utils.dates_parameters import getDefaultDatesParams, parse_time_value, InvalidTimeRange, DEFAULT_START
+
+class DatesParametersTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1600000000
+
+    def test_defaults(self):
+        self.assertEqual(getDefaultDatesParams(None, None, self.now), (DEFAULT_START, self.now))
+
+    def test_epoch_strings_become_integers(self):
+        time_range = getDefaultDatesParams('1599990000', '1600000000', self.now)
+
+        self.assertEqual(time_range, (1599990000, 1600000000))
+        self.assertIsInstance(time_range.start, int)
+        self.assertEqual(time_range.cache_key, '1599990000:1600000000')
+
+    def test_relative_times(self):
+        self.assertEqual(parse_time_value('now', self.now), self.now)
+        self.assertEqual(parse_time_value('-1h', self.now), self.now - 3600)
+        self.assertEqual(parse_time_value('-2d', self.now), self.now - 2 * 86400)
+        self.assertEqual(parse_time_value('+30m', self.now), self.now + 1800)
+
+    def test_iso_dates(self):
+        self.assertEqual(parse_time_value('2020-09-13T12:26:40Z', self.now), 1600000000)
+        self.assertEqual(parse_time_value('2020-09-13T14:26:40+02:00', self.now), 1600000000)
+        # Dates without a timezone are UTC
+        self.assertEqual(parse_time_value('2020-09-13T12:26:40', self.now), 1600000000)
+
+    def test_invalid_values(self):
+        with self.assertRaises(InvalidTimeRange):
+            parse_time_value('yesterday', self.now)
+
+    def test_inverted_range(self):
+        with self.assertRaises(InvalidTimeRange):
+            getDefaultDatesParams('-1h', '-2h', self.now)
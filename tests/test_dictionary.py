@@ -0,0 +1,72 @@
+import sqlite3
+import unittest
+
+from utils.db_utils import init_db, reset_db
+from utils.dictionary import DeviceRegistry, TYPE_IDS
+
+class DictionaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        self.conn = sqlite3.connect('test_database.db')
+        self.registry = DeviceRegistry()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_readings_store_integer_ids(self):
+        self.conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('device','humidity',10,100)")
+
+        device_id = self.registry.device_id(self.conn, 'device')
+        self.assertEqual(self.conn.execute('select device_id, type_id, value from reading_rows').fetchall(), [(device_id, TYPE_IDS['humidity'], 10)])
+        self.assertEqual(self.conn.execute('select * from readings').fetchall(), [('device', 'humidity', 10, 100)])
+
+    def test_registry_maps_both_ways(self):
+        device_id = self.registry.register_device(self.conn, 'device')
+        self.conn.commit()
+
+        self.assertEqual(self.registry.register_device(self.conn, 'device'), device_id)
+        self.assertIsNone(self.registry.device_id(self.conn, 'unknown'))
+        self.assertEqual(self.registry.device_ids(self.conn, ['device', 'unknown']), {'device': device_id})
+        self.assertEqual(self.registry.device_uuids(self.conn, [device_id]), {device_id: 'device'})
+
+    def test_uncommitted_devices_are_not_cached(self):
+        self.registry.register_device(self.conn, 'device')
+        self.conn.rollback()
+
+        self.assertIsNone(self.registry.device_id(self.conn, 'device'))
+
+    def test_plain_readings_table_is_migrated(self):
+        reset_db('test_database.db')
+        self.conn.execute('DROP VIEW readings')
+        self.conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device', 'temperature', 10, 100), ('device', 'temperature', 30, 200), ('other', 'humidity', 50, 100)])
+        self.conn.commit()
+
+        init_db('test_database.db')
+
+        self.assertEqual(self.conn.execute("select type from sqlite_master where name='readings'").fetchone(), ('view',))
+        self.assertEqual(self.conn.execute('select count(*) from reading_rows').fetchone()[0], 3)
+        self.assertEqual(self.conn.execute("select count, sum, max from device_summaries JOIN devices ON devices.id = device_id where device_uuid='device'").fetchone(), (2, 40, 30))
+
+    def test_text_keyed_tables_are_migrated(self):
+        self.conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('device','humidity',10,100)")
+        self.conn.execute('DROP TABLE device_summaries')
+        self.conn.execute('DROP TABLE alerts')
+        self.conn.execute('CREATE TABLE device_summaries (device_uuid TEXT, type TEXT, count INTEGER, sum INTEGER, max INTEGER, PRIMARY KEY (device_uuid, type))')
+        self.conn.execute('CREATE TABLE alerts (id INTEGER PRIMARY KEY, rule_id INTEGER NOT NULL, device_uuid TEXT NOT NULL, type TEXT NOT NULL, operator TEXT, threshold INTEGER, value INTEGER, date_created INTEGER, fired_at INTEGER)')
+        self.conn.execute("insert into device_summaries VALUES ('device', 'humidity', 1, 10, 10)")
+        self.conn.execute("insert into alerts VALUES (7, 1, 'gone', 'temperature', '>', 5, 10, 100, 101)")
+        self.conn.commit()
+
+        init_db('test_database.db')
+
+        device_ids = self.registry.device_ids(self.conn, ['device', 'gone'])
+        self.assertEqual(self.conn.execute('select * from device_summaries').fetchall(), [(device_ids['device'], TYPE_IDS['humidity'], 1, 10, 10)])
+        self.assertEqual(self.conn.execute('select id, device_id, type_id from alerts').fetchall(), [(7, device_ids['gone'], TYPE_IDS['temperature'])])
+        self.assertIsNone(self.conn.execute("select 1 from sqlite_master where name LIKE '%_text_keyed'").fetchone())
+
+        # The recreated trigger keeps the state by ids
+        self.conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('device','humidity',30,200)")
+        self.assertEqual(self.conn.execute('select count, sum, max from device_summaries').fetchone(), (2, 40, 30))
@@ -0,0 +1,34 @@
+import queue
+import unittest
+
+from utils.event_bus import EventBus
+
+class EventBusTestCases(unittest.TestCase):
+
+    def test_events_fan_out_to_the_topic_subscribers(self):
+        bus = EventBus()
+        first, second, other = bus.subscribe('device'), bus.subscribe('device'), bus.subscribe('other')
+
+        self.assertEqual(bus.publish('device', 1), 2)
+
+        self.assertEqual(first.get(0), 1)
+        self.assertEqual(second.get(0), 1)
+        with self.assertRaises(queue.Empty):
+            other.get(0)
+
+    def test_slow_consumers_overflow_without_blocking(self):
+        bus = EventBus(max_queue=2)
+        subscription = bus.subscribe('device')
+
+        delivered = [bus.publish('device', event) for event in range(3)]
+
+        self.assertEqual(delivered, [1, 1, 0])
+        self.assertTrue(subscription.overflowed)
+
+    def test_unsubscribe(self):
+        bus = EventBus()
+        subscription = bus.subscribe('device')
+        bus.unsubscribe(subscription)
+
+        self.assertFalse(bus.has_subscribers('device'))
+        self.assertEqual(bus.publish('device', 1), 0)
@@ -0,0 +1,31 @@
+import sqlite3
+import unittest
+
+from utils.db_utils import reset_db
+from utils.idempotency import RecentKeys, claim_ingest_key, purge_ingest_keys
+
+class IdempotencyTestCases(unittest.TestCase):
+
+    def test_recent_keys_expire_and_are_bounded(self):
+        keys = RecentKeys(max_keys=2, ttl=10)
+        keys.add('first', now=0)
+        keys.add('second', now=1)
+        self.assertTrue(keys.seen('first', now=5))
+        self.assertFalse(keys.seen('first', now=10))
+
+        # The oldest key is evicted over max_keys
+        keys.add('third', now=2)
+        self.assertFalse(keys.seen('first', now=2))
+        self.assertTrue(keys.seen('third', now=2))
+
+    def test_keys_are_claimed_once_and_purged(self):
+        reset_db('test_database.db')
+        conn = sqlite3.connect('test_database.db')
+        self.addCleanup(conn.close)
+
+        self.assertTrue(claim_ingest_key(conn, 1, 'retry', now=100))
+        self.assertFalse(claim_ingest_key(conn, 1, 'retry', now=101))
+        self.assertTrue(claim_ingest_key(conn, 2, 'retry', now=200))
+
+        self.assertEqual(purge_ingest_keys(conn, ttl=50, now=200, chunk_size=1), 1)
+        self.assertTrue(claim_ingest_key(conn, 1, 'retry', now=201))
@@ -0,0 +1,63 @@
+import sqlite3
+import unittest
+
+from utils.db_utils import reset_db
+from utils.jobs import SQLiteJobQueue
+
+def add(first, second):
+    return {'sum': first + second}
+
+def fail():
+    raise ValueError('no readings')
+
+class JobsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        # Two processes sharing the database, neither running worker threads
+        self.web = SQLiteJobQueue('test_database.db', workers=0)
+        self.worker = SQLiteJobQueue('test_database.db', workers=0)
+        for queue in (self.web, self.worker):
+            queue.register('add', add)
+            queue.register('fail', fail)
+
+    def test_jobs_are_shared_between_processes(self):
+        job = self.web.enqueue('add-1-2', add, 1, 2)
+        self.assertEqual(self.worker.get(job['id'])['status'], 'queued')
+
+        # The same key is deduplicated by the other process while the job is queued
+        self.assertEqual(self.worker.enqueue('add-1-2', add, 1, 2)['id'], job['id'])
+
+        self.worker.work(burst=True)
+        job = self.web.get(job['id'])
+        self.assertEqual(job['status'], 'finished')
+        self.assertEqual(job['result'], {'sum': 3})
+
+        # Once finished the key is free again
+        self.assertNotEqual(self.web.enqueue('add-1-2', add, 1, 2)['id'], job['id'])
+
+    def test_idle_polls_leave_the_writer_alone(self):
+        writer = sqlite3.connect('test_database.db', isolation_level=None)
+        self.addCleanup(writer.close)
+        writer.execute('BEGIN IMMEDIATE')
+
+        # With the write lock held elsewhere an empty queue is still polled at once
+        self.worker.busy_timeout_ms = 0
+        self.assertFalse(self.worker.run_next())
+        writer.execute('ROLLBACK')
+
+    def test_failed_and_abandoned_jobs(self):
+        failed = self.web.enqueue('fail', fail)
+        self.worker.work(burst=True)
+        failed = self.web.get(failed['id'])
+        self.assertEqual(failed['status'], 'failed')
+        self.assertEqual(failed['error'], 'ValueError: no readings')
+
+        # A job whose worker died is failed after the timeout and its key freed
+        self.web.timeout = -1
+        abandoned = self.web.enqueue('add-2-2', add, 2, 2)
+        conn = self.web._connect()
+        conn.execute("update jobs set status='started', started_at=0 where id=?", [abandoned['id']])
+        conn.close()
+        self.assertNotEqual(self.web.enqueue('add-2-2', add, 2, 2)['id'], abandoned['id'])
+        self.assertEqual(self.worker.get(abandoned['id'])['status'], 'failed')
@@ -0,0 +1,49 @@
+import io
+import json
+import logging
+import queue
+import unittest
+
+from utils.logging_utils import AccessLogger, LogPipeline, NonBlockingQueueHandler
+
+class LoggingUtilsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.pipeline = LogPipeline(stream=self.stream)
+        self.logger = self.pipeline.attach('sensor_api_test')
+        self.pipeline.start()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.pipeline.handler)
+
+    def records(self):
+        self.pipeline.stop()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_access_records_are_written_as_json(self):
+        AccessLogger(self.logger).log('request_device_readings', 'GET', 200, 0.0125, '/devices/test/readings/')
+
+        records = self.records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['endpoint'], 'request_device_readings')
+        self.assertEqual(records[0]['status'], 200)
+        self.assertEqual(records[0]['duration_ms'], 12.5)
+        self.assertEqual(records[0]['sample_rate'], 1.0)
+
+    def test_sampled_routes_still_log_errors(self):
+        access_logger = AccessLogger(self.logger, {'request_device_readings:POST': 0.0})
+        for _ in range(10):
+            access_logger.log('request_device_readings', 'POST', 201, 0.001, '/devices/test/readings/')
+        access_logger.log('request_device_readings', 'POST', 500, 0.001, '/devices/test/readings/')
+
+        records = self.records()
+        self.assertEqual([record['status'] for record in records], [500])
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord('sensor_api_test', logging.INFO, __file__, 1, 'message', None, None)
+        handler.handle(record)
+        handler.handle(record)
+
+        self.assertEqual(handler.queue.qsize(), 1)
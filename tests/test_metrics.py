@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+from utils.metrics import Counter, Histogram
+
+class MetricsTestCases(unittest.TestCase):
+
+    def test_counter_sums_every_thread(self):
+        counter = Counter('test_total', 'Test counter', ['route'])
+
+        def work():
+            for _ in range(1000):
+                counter.inc(('readings',))
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.value(('readings',)), 8000)
+        self.assertIn('test_total{route="readings"} 8000', counter.render())
+
+    def test_ended_threads_are_folded_into_the_total(self):
+        counter = Counter('test_total', 'Test counter')
+        histogram = Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+
+        def work():
+            counter.inc()
+            histogram.observe(0.5)
+
+        # One short lived thread per request, like the threaded server
+        for _ in range(200):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(len(counter._shards), 0)
+        self.assertEqual(len(histogram._shards), 0)
+        self.assertEqual(counter.value(), 200)
+        self.assertIn('test_seconds_count 200', histogram.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count 4', lines)
+        self.assertIn('test_seconds_sum 2.65', lines)
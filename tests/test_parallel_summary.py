@@ -0,0 +1,45 @@
+import sqlite3
+import unittest
+
+import numpy
+from pandas import Series
+
+from utils.parallel_summary import create_summary_pool, describe_devices, describe_values, device_runs
+
+class ParallelSummaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        self.conn.execute('CREATE TABLE rows (device_id INTEGER, value INTEGER)')
+        self.conn.executemany('insert into rows VALUES (?,?)', [(index % 7, (index * 37) % 101) for index in range(700)])
+
+    def runs(self, batch_size=50):
+        return device_runs(self.conn.execute('select device_id, value from rows order by device_id'), batch_size)
+
+    def test_runs_span_the_batches(self):
+        runs = [(device_id, values.size) for device_id, values in self.runs(batch_size=3)]
+        self.assertEqual(runs, [(device_id, 100) for device_id in range(7)])
+
+        cur = self.conn.execute('select device_id, value from rows where device_id < 0')
+        self.assertEqual(list(device_runs(cur)), [])
+
+    def test_describe_matches_pandas(self):
+        values = numpy.array([3, 1, 4, 1, 5, 9, 2, 6])
+        description = Series(values).describe()
+        stats = describe_values(values)
+        self.assertEqual(stats['number_of_readings'], 8)
+        self.assertEqual(stats['max_reading_value'], description['max'])
+        self.assertEqual(stats['median_reading_value'], description['50%'])
+        self.assertEqual(stats['quartile_1_value'], description['25%'])
+        self.assertEqual(stats['quartile_3_value'], description['75%'])
+
+    def test_pool_gives_the_serial_result(self):
+        serial = describe_devices(self.runs())
+        pool = create_summary_pool(2)
+        self.addCleanup(pool.shutdown)
+
+        # One device in this process, then shards of 2 with at most 2 in flight
+        parallel = describe_devices(self.runs(), pool, chunk_size=2, min_parallel_readings=1, max_pending=2)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(sorted(parallel), list(range(7)))
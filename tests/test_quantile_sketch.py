@@ -0,0 +1,79 @@
+import json
+import random
+import unittest
+
+from utils.quantile_sketch import KLLSketch
+from utils.sketch_store import load_sketch, split_range
+
+class QuantileSketchTestCases(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(7)
+        self.values = [random.randint(0, 100) for _ in range(20000)]
+        self.sorted_values = sorted(self.values)
+
+    def assertRankWithinBound(self, sketch, q):
+        # The rank of the estimated quantile must be within the reported error
+        estimate = sketch.quantile(q)
+        below = sum(1 for value in self.sorted_values if value < estimate)
+        at_or_below = sum(1 for value in self.sorted_values if value <= estimate)
+        target = q * len(self.values)
+        error = sketch.error_bound * len(self.values)
+        self.assertTrue(below - error <= target <= at_or_below + error)
+
+    def test_small_sketch_is_exact(self):
+        sketch = KLLSketch(50)
+        for value in [22, 50, 100]:
+            sketch.update(value)
+
+        self.assertEqual(sketch.error_bound, 0)
+        self.assertEqual(sketch.quantile(0.5), 50)
+        self.assertEqual(sketch.quantile(0.25), 36)
+        self.assertEqual(sketch.quantile(0.75), 75)
+
+    def test_quantiles_within_error_bound(self):
+        sketch = KLLSketch(100)
+        for value in self.values:
+            sketch.update(value)
+
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertEqual(sketch.max, max(self.values))
+        for q in [0.25, 0.5, 0.75]:
+            self.assertRankWithinBound(sketch, q)
+
+    def test_merged_sketches_within_error_bound(self):
+        merged = KLLSketch(64)
+        for chunk_start in range(0, len(self.values), 1000):
+            part = KLLSketch(200)
+            for value in self.values[chunk_start:chunk_start + 1000]:
+                part.update(value)
+            merged.merge(KLLSketch.from_dict(part.to_dict()))
+
+        self.assertEqual(merged.count, len(self.values))
+        self.assertEqual(merged.sum, sum(self.values))
+        for q in [0.25, 0.5, 0.75]:
+            self.assertRankWithinBound(merged, q)
+
+    def test_binary_encoding_round_trips(self):
+        sketch = KLLSketch(64)
+        for value in self.values:
+            sketch.update(value)
+        encoded = sketch.to_bytes()
+
+        # Readings of 0 to 100 take a byte each
+        self.assertLess(len(encoded), len(json.dumps(sketch.to_dict())) / 2)
+        self.assertEqual(load_sketch(encoded).to_dict(), sketch.to_dict())
+        # Sketches stored as JSON before still load
+        self.assertEqual(load_sketch(json.dumps(sketch.to_dict())).to_dict(), sketch.to_dict())
+
+        wide = KLLSketch(64)
+        for value in (-2 ** 40, 0, 2 ** 40):
+            wide.update(value)
+        self.assertEqual(KLLSketch.from_bytes(wide.to_bytes()).to_dict(), wide.to_dict())
+        self.assertEqual(KLLSketch.from_bytes(KLLSketch(64).to_bytes()).to_dict(), KLLSketch(64).to_dict())
+
+    def test_split_range_in_buckets(self):
+        # Whole buckets come from the sketches, the edges from raw readings
+        self.assertEqual(split_range(3500, 7300, 3600), ((3600, 7200), [(3500, 3599), (7200, 7300)]))
+        self.assertEqual(split_range(3600, 7199, 3600), ((3600, 7200), []))
+        self.assertEqual(split_range(3700, 3800, 3600), (None, [(3700, 3800)]))
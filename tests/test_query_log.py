@@ -0,0 +1,102 @@
+import unittest
+
+from utils.db_utils import CLUSTERED, DEVICE_ORDERED_READINGS, HEAP, REPLAY_READINGS, REPLAY_TYPE_READINGS, SORTED_RANGE_READINGS, connect, range_readings_query, reset_db
+from utils.metrics import DB_ROWS_RETURNED
+from utils.query_log import explain_query_plan
+
+class QueryLogTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        self.conn = connect('test_database.db', slow_query_threshold=0)
+        self.conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('device','temperature',10,100)")
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_explain_flags_full_scans(self):
+        plan, access = explain_query_plan(self.conn, 'select value from reading_rows where value=?1', [10])
+
+        self.assertEqual(access, 'SCAN')
+        self.assertTrue(any(detail.startswith('SCAN reading_rows') for detail in plan))
+
+    def test_explain_flags_index_searches(self):
+        _, access = explain_query_plan(self.conn, 'select value from reading_rows where type_id=?1 AND date_created BETWEEN ?2 AND ?3', [1, 0, 200])
+
+        self.assertEqual(access, 'SEARCH')
+
+    def test_slow_statements_are_logged_with_their_plan(self):
+        with self.assertLogs('sensor_api.slow_query', level='WARNING') as logs:
+            cur = self.conn.cursor()
+            cur.execute('select value from reading_rows where value=?1', [10])
+            self.assertEqual(len(cur.fetchall()), 1)
+
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0]
+        self.assertEqual(record.access, 'SCAN')
+        self.assertEqual(record.params, [10])
+        self.assertIn('SCAN reading_rows', record.getMessage())
+
+    def test_iterated_rows_are_counted_and_the_statement_finished(self):
+        self.conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('device','temperature',11,101)")
+        returned = DB_ROWS_RETURNED.value()
+        with self.assertLogs('sensor_api.slow_query', level='WARNING') as logs:
+            cur = self.conn.cursor()
+            cur.execute('select value from reading_rows where value >= ?1', [10])
+            self.assertEqual([row[0] for row in cur], [10, 11])
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(DB_ROWS_RETURNED.value() - returned, 2)
+
+    def test_connection_execute_is_timed_and_logged(self):
+        with self.assertLogs('sensor_api.slow_query', level='WARNING') as logs:
+            rows = self.conn.execute('select value from reading_rows where value=?1', [10]).fetchall()
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(logs.records[0].params, [10])
+
+    def test_single_row_reads_are_finished(self):
+        with self.assertLogs('sensor_api.slow_query', level='WARNING') as logs:
+            cur = self.conn.cursor()
+            cur.execute('select max(value) from reading_rows where value >= ?1', [0])
+            self.assertEqual(cur.fetchone()[0], 10)
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('max(value)', logs.records[0].getMessage())
+
+    def test_range_readings_query_follows_the_range_width(self):
+        for layout in (HEAP, CLUSTERED):
+            self.conn.close()
+            reset_db('test_database.db', layout)
+            self.conn = connect('test_database.db')
+            # No ANALYZE, like a database made by init_db
+            self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                                  ((str(index % 500), 'temperature', index % 100, index) for index in range(5000)))
+
+            for type_id in (1, None):
+                # A narrow range reads only its readings through the type and date index
+                selectQuery = range_readings_query(self.conn, type_id, 4900, 4950)
+                plan, _ = explain_query_plan(self.conn, selectQuery, [type_id, 4900, 4950])
+                self.assertTrue([detail for detail in plan if 'reading_rows_type_date_created' in detail], (layout, plan))
+
+                # A wide one is read in device order, without sorting it
+                selectQuery = range_readings_query(self.conn, type_id, 0, 4950)
+                plan, _ = explain_query_plan(self.conn, selectQuery, [type_id, 0, 4950])
+                self.assertFalse([detail for detail in plan if 'TEMP B-TREE' in detail], (layout, plan))
+                self.assertFalse([detail for detail in plan if 'reading_rows_type_date_created' in detail], (layout, plan))
+
+                # Both return the same rows
+                for start, end in ((4900, 4950), (0, 4950)):
+                    rows = [self.conn.execute(selectQuery, [type_id, start, end]).fetchall() for selectQuery in (SORTED_RANGE_READINGS, DEVICE_ORDERED_READINGS[layout])]
+                    self.assertEqual(sorted(map(tuple, rows[0])), sorted(map(tuple, rows[1])))
+
+    def test_replay_pages_are_never_sorted(self):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              ((str(index % 5), ('temperature', 'humidity')[index % 2], index % 100, index) for index in range(5000)))
+        for analyzed in (False, True):
+            if analyzed:
+                self.conn.execute('ANALYZE')
+            for selectQuery in (REPLAY_READINGS, REPLAY_TYPE_READINGS):
+                plan, _ = explain_query_plan(self.conn, selectQuery, [1, 1, 100, 500])
+                self.assertFalse([detail for detail in plan if 'TEMP B-TREE' in detail], (analyzed, plan))
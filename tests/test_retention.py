@@ -0,0 +1,93 @@
+import sqlite3
+import unittest
+
+from utils.db_utils import reset_db
+from utils.dictionary import TYPE_IDS
+from utils.retention import run_retention, DAY_SECONDS
+from utils.sketch_store import load_sketch, rebuild_sketches
+from utils.summary_state import rebuild_summary_state
+
+class RetentionTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        self.conn = sqlite3.connect('test_database.db')
+        self.now = 100 * DAY_SECONDS
+        self.policies = {
+            'temperature': {'raw_seconds': 30 * DAY_SECONDS, 'aggregate_seconds': 3600},
+            'humidity': {'raw_seconds': 30 * DAY_SECONDS, 'aggregate_seconds': None},
+        }
+
+        old = self.now - 40 * DAY_SECONDS
+        readings = [
+            ('device', 'temperature', 10, old),
+            ('device', 'temperature', 30, old + 60),
+            ('device', 'temperature', 20, old + 3600),
+            ('device', 'humidity', 50, old),
+            ('device', 'temperature', 70, self.now - DAY_SECONDS),
+        ]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', readings)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_old_readings_are_downsampled(self):
+        report = run_retention(self.conn, self.policies, now=self.now, chunk_size=2)
+
+        self.assertTrue(report['finished'])
+        self.assertEqual(report['removed'], {'temperature': 3, 'humidity': 1})
+
+        # Only the recent reading is kept raw
+        rows = self.conn.execute('select type, value from readings').fetchall()
+        self.assertEqual(rows, [('temperature', 70)])
+
+        # The old temperatures are left as hourly aggregates, humidity is just deleted
+        aggregates = self.conn.execute('select type_id, count, sum, min, max from readings_aggregates order by bucket_start').fetchall()
+        self.assertEqual(aggregates, [(TYPE_IDS['temperature'], 2, 40, 10, 30), (TYPE_IDS['temperature'], 1, 20, 20, 20)])
+
+    def test_time_budget_stops_early(self):
+        progress = []
+        report = run_retention(self.conn, self.policies, now=self.now, chunk_size=1, time_budget=0, progress=progress.append)
+
+        self.assertFalse(report['finished'])
+        self.assertEqual(progress, [])
+        self.assertEqual(self.conn.execute('select count(*) from readings').fetchone()[0], 5)
+
+    def test_summary_state_and_sketches_follow_the_deletes(self):
+        # Readings on both sides of the cutoff in the same sketch bucket
+        bucket_seconds = 7001
+        cutoff = self.now - 30 * DAY_SECONDS
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device', 'temperature', 90, cutoff + 10), ('device', 'temperature', 5, cutoff - 10)])
+        self.conn.commit()
+        rebuild_sketches(self.conn, 200, bucket_seconds)
+
+        run_retention(self.conn, self.policies, now=self.now, chunk_size=2, sketch_k=200, sketch_bucket_seconds=bucket_seconds)
+
+        state = self.conn.execute('select device_id, type_id, count, sum, max from device_summaries order by type_id').fetchall()
+        histograms = self.conn.execute('select * from device_summary_histograms order by type_id, value').fetchall()
+        self.assertEqual(state, [(1, TYPE_IDS['temperature'], 2, 160, 90)])
+        # The same state a rebuild from the raw readings gives
+        rebuild_summary_state(self.conn)
+        self.assertEqual(self.conn.execute('select device_id, type_id, count, sum, max from device_summaries order by type_id').fetchall(), state)
+        self.assertEqual(self.conn.execute('select * from device_summary_histograms order by type_id, value').fetchall(), histograms)
+
+        # Only the buckets of the kept readings are left, the cutoff one without the deleted reading
+        sketches = self.conn.execute('select bucket_start, sketch from reading_sketches order by bucket_start').fetchall()
+        self.assertEqual([bucket_start for bucket_start, _ in sketches],
+                         [cutoff // bucket_seconds * bucket_seconds, (self.now - DAY_SECONDS) // bucket_seconds * bucket_seconds])
+        cutoff_sketch = load_sketch(sketches[0][1])
+        self.assertEqual((cutoff_sketch.count, cutoff_sketch.max), (1, 90))
+
+    def test_chunks_never_scan_the_state_tables(self):
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        run_retention(self.conn, self.policies, now=self.now, chunk_size=2, sketch_k=200, sketch_bucket_seconds=3600)
+        self.conn.set_trace_callback(None)
+
+        writes = [statement for statement in statements if statement.lower().startswith(('delete', 'update'))]
+        self.assertTrue(writes)
+        for statement in writes:
+            plan = ' '.join(row[3] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + statement))
+            self.assertNotIn('SCAN', plan, statement)
@@ -1,18 +1,29 @@
+import gzip
 import json
+import os
 import pytest
 import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+from unittest import mock
 
-from app import app
+import app as app_module
+from app import app, get_device_rate_limiter, get_job_queue, get_recent_ingest_keys, get_storage
+from utils.db_utils import reset_db
+from utils.retention import DAY_SECONDS, EXAMPLE_RETENTION_POLICIES, run_retention
+from utils.sketch_store import rebuild_sketches
+from utils.summary_state import rebuild_summary_state
 
 class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
         # Setup the SQLite DB
+        reset_db('test_database.db')
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
         
         self.device_uuid = 'test_device'
         self.current_time = int(time.time())
@@ -33,6 +44,11 @@ class SensorRoutesTestCases(unittest.TestCase):
         conn.commit()
 
         app.config['TESTING'] = True
+        # The database was recreated, its device ids start over
+        get_storage().devices.clear()
+        get_storage().alert_rules.clear()
+        get_device_rate_limiter().clear()
+        get_recent_ingest_keys().clear()
 
         self.client = app.test_client
 
@@ -47,6 +63,167 @@ class SensorRoutesTestCases(unittest.TestCase):
         # And the response data should have three sensor readings
         self.assertTrue(len(json.loads(request.data)) == 3)
 
+    def test_device_readings_get_columnar(self):
+        # When we ask for the temperatures in the columnar format
+        request = self.client().get('/devices/{}/temperature/readings/?format=columnar'.format(self.device_uuid))
+
+        # Then the device and type come once, with one array per column
+        self.assertEqual(request.status_code, 200)
+        data = json.loads(request.data)
+        self.assertEqual(data['device_uuid'], self.device_uuid)
+        self.assertEqual(data['type'], 'temperature')
+        self.assertEqual(sorted(zip(data['date_created'], data['value'])),
+                         [(self.current_time - 100, 22), (self.current_time - 50, 50), (self.current_time, 100)])
+        self.assertNotIn('types', data)
+
+        # And without a type every reading has its type
+        data = json.loads(self.client().get('/devices/{}/readings/?format=columnar'.format(self.device_uuid)).data)
+        self.assertEqual(data['types'], ['temperature'] * 3)
+
+        self.assertEqual(self.client().get('/devices/{}/readings/?format=csv'.format(self.device_uuid)).status_code, 400)
+
+    def test_responses_are_compressed_when_accepted(self):
+        app.config['COMPRESSION_MIN_SIZE'] = 0
+        try:
+            request = self.client().get('/devices/{}/readings/'.format(self.device_uuid), headers={'Accept-Encoding': 'gzip'})
+            plain = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        finally:
+            app.config['COMPRESSION_MIN_SIZE'] = 1024
+
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', request.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(request.data)), json.loads(plain.data))
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_device_readings_stream(self):
+        # Given a client following the device from the start
+        response = self.client().get('/devices/{}/temperature/readings/stream/?last_id=0'.format(self.device_uuid), buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+
+        try:
+            self.assertEqual(next(events), b': connected\n\n')
+            # Then the stored readings are replayed first
+            replayed = [next(events) for _ in range(3)]
+            self.assertTrue(all(b'event: reading' in event for event in replayed))
+            self.assertIn(b'"value":100', replayed[2])
+
+            # And a new reading is pushed once it is posted
+            self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 61}))
+            event = next(events).decode('utf-8')
+            self.assertIn('id: 5', event)
+            self.assertEqual(json.loads(event.split('data: ')[1])['value'], 61)
+        finally:
+            response.close()
+
+    def test_device_readings_stream_replays_page_by_page(self):
+        app.config['STREAM_REPLAY_PAGE_SIZE'] = 2
+        try:
+            response = self.client().get('/devices/{}/readings/stream/?last_id=1'.format(self.device_uuid), buffered=False)
+            events = iter(response.response)
+            try:
+                self.assertEqual(next(events), b': connected\n\n')
+                # The readings after the first one come in two pages, in order
+                replayed = [next(events).decode('utf-8') for _ in range(2)]
+                self.assertEqual([json.loads(event.split('data: ')[1])['value'] for event in replayed], [50, 100])
+                self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 61}))
+                self.assertIn('id: 5', next(events).decode('utf-8'))
+            finally:
+                response.close()
+        finally:
+            app.config['STREAM_REPLAY_PAGE_SIZE'] = 500
+
+    def test_alert_rules_fire_on_ingest(self):
+        # Given a rule for this device and one for any device
+        request = self.client().post('/alerts/rules/', data=json.dumps({'device_uuid': self.device_uuid, 'type': 'temperature', 'operator': '>', 'threshold': 80}))
+        self.assertEqual(request.status_code, 201)
+        rule_id = json.loads(request.data)['id']
+        self.client().post('/alerts/rules/', data=json.dumps({'type': 'humidity', 'operator': '<', 'threshold': 10}))
+
+        # When readings are posted
+        readings = [(self.device_uuid, 'temperature', 90), (self.device_uuid, 'temperature', 70), ('other_uuid', 'temperature', 95), ('other_uuid', 'humidity', 5)]
+        for device_uuid, sensor_type, value in readings:
+            self.client().post('/devices/{}/readings/'.format(device_uuid), data=json.dumps({'type': sensor_type, 'value': value}))
+
+        # Then only the breaching readings of matching rules fired
+        alerts = json.loads(self.client().get('/alerts/').data)
+        self.assertEqual([(alert['device_uuid'], alert['type'], alert['value']) for alert in alerts],
+                         [(self.device_uuid, 'temperature', 90), ('other_uuid', 'humidity', 5)])
+        self.assertEqual(len(json.loads(self.client().get('/alerts/?device_uuid=other_uuid').data)), 1)
+
+        # And a deleted rule stops firing
+        self.assertEqual(self.client().delete('/alerts/rules/{}/'.format(rule_id)).status_code, 204)
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 99}))
+        self.assertEqual(len(json.loads(self.client().get('/alerts/').data)), 2)
+        self.assertEqual(len(json.loads(self.client().get('/alerts/rules/').data)), 1)
+
+        self.assertEqual(self.client().post('/alerts/rules/', data=json.dumps({'type': 'temperature', 'operator': '!=', 'threshold': 1})).status_code, 400)
+
+    def test_alerts_stream(self):
+        self.client().post('/alerts/rules/', data=json.dumps({'type': 'temperature', 'operator': '>=', 'threshold': 50}))
+        response = self.client().get('/alerts/stream/', buffered=False)
+        events = iter(response.response)
+
+        try:
+            next(events)
+            self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 75}))
+            event = next(events).decode('utf-8')
+            self.assertIn('event: alert', event)
+            self.assertEqual(json.loads(event.split('data: ')[1])['value'], 75)
+        finally:
+            response.close()
+
+    def test_flooding_device_is_rate_limited(self):
+        # Given a device that posts more than its burst
+        burst = app.config['INGEST_BURST_PER_DEVICE']
+        statuses = [self.client().post('/devices/flooding/readings/', data=json.dumps({'type': 'temperature', 'value': 1})).status_code
+                    for _ in range(burst + 1)]
+
+        # Then the readings over the burst are rejected with a Retry-After
+        self.assertEqual(statuses, [201] * burst + [429])
+        request = self.client().post('/devices/flooding/readings/', data=json.dumps({'type': 'temperature', 'value': 1}))
+        self.assertEqual(request.status_code, 429)
+        self.assertGreaterEqual(int(request.headers['Retry-After']), 1)
+
+        # And other devices are not affected
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps({'type': 'temperature', 'value': 1}))
+        self.assertEqual(request.status_code, 201)
+
+    def test_retried_reading_is_stored_once(self):
+        url = '/devices/{}/readings/'.format(self.device_uuid)
+        data = json.dumps({'type': 'temperature', 'value': 30})
+
+        # Given a reading posted with an idempotency key
+        request = self.client().post(url, data=data, headers={'Idempotency-Key': 'retry-1'})
+        self.assertEqual(request.status_code, 201)
+
+        # When it is retried, from memory and once the memory was lost
+        request = self.client().post(url, data=data, headers={'Idempotency-Key': 'retry-1'})
+        self.assertEqual(request.status_code, 200)
+        get_recent_ingest_keys().clear()
+        request = self.client().post(url, data=data, headers={'Idempotency-Key': 'retry-1'})
+        self.assertEqual(request.status_code, 200)
+
+        # Then only one reading was stored, a reading with a new key is stored again
+        self.assertEqual(self.client().post(url, data=data, headers={'Idempotency-Key': 'retry-2'}).status_code, 201)
+        conn = sqlite3.connect('test_database.db')
+        rows = conn.execute('select count(*) from readings where device_uuid=? AND value=30', (self.device_uuid,)).fetchone()
+        self.assertEqual(rows[0], 2)
+
+    def test_natural_key_deduplication(self):
+        app.config['INGEST_IDEMPOTENCY'] = 'natural'
+        try:
+            url = '/devices/{}/readings/'.format(self.device_uuid)
+            data = json.dumps({'type': 'temperature', 'value': 30, 'date_created': self.current_time})
+            statuses = [self.client().post(url, data=data).status_code for _ in range(2)]
+            # Readings dated on arrival are always stored
+            undated = [self.client().post(url, data=json.dumps({'type': 'temperature', 'value': 30})).status_code for _ in range(2)]
+        finally:
+            app.config['INGEST_IDEMPOTENCY'] = 'key'
+
+        self.assertEqual(statuses, [201, 200])
+        self.assertEqual(undated, [201, 201])
+
     def test_device_readings_post(self):
         # Given a device UUID
         # When we make a request with the given UUID to create a reading
@@ -353,7 +530,361 @@ class SensorRoutesTestCases(unittest.TestCase):
 
         self.assertDictEqual(expected_response, result)
 
+    def test_app_import_is_lazy(self):
+        """
+        Importing the app must not load pandas nor create the database,
+        both only happen on the first metric request / explicit init.
+        """
+        project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with tempfile.TemporaryDirectory() as work_dir:
+            env = dict(os.environ, PYTHONPATH=project_dir)
+            output = subprocess.check_output([sys.executable, '-c', "import sys, app; print('pandas' in sys.modules)"],
+                                             cwd=work_dir, env=env, universal_newlines=True)
+
+            self.assertEqual(output.strip(), 'False')
+            self.assertFalse(os.path.exists(os.path.join(work_dir, 'database.db')))
 
+    def test_device_readings_median_approximate(self):
+        """
+        The approximate median merges the stored sketches, with few readings
+        the sketch is still exact so the error bound is zero.
+        """
+        conn = sqlite3.connect('test_database.db')
+        rebuild_sketches(conn, app.config['SKETCH_K'], app.config['SKETCH_BUCKET_SECONDS'])
 
-        
-        
\ No newline at end of file
+        request = self.client().get('/devices/{}/{}/readings/median/?approx=true'.format(self.device_uuid, 'temperature'))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['value'], 50)
+        self.assertEqual(result['error_bound'], 0)
+
+    def test_device_readings_quartiles_approximate_after_post(self):
+        """
+        Readings created through the API are folded into the sketches on ingest
+        """
+        for value in [10, 20, 30, 40, 50]:
+            self.client().post('/devices/{}/readings/'.format('sketch_device'), data=json.dumps({'type': 'humidity', 'value': value}))
+
+        request = self.client().get('/devices/{}/{}/{}/{}/readings/quartiles/?approx=true&accuracy=50'.format(
+            'sketch_device', 'humidity', self.current_time - 100, int(time.time()) + 100))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['quartile_1'], 20)
+        self.assertEqual(result['quartile_3'], 40)
+
+    def test_device_readings_median_invalid_accuracy(self):
+        request = self.client().get('/devices/{}/{}/readings/median/?approx=true&accuracy=1'.format(self.device_uuid, 'temperature'))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_fleet_readings(self):
+        """
+        Fleet wide metrics are computed over every device at once
+        """
+        request = self.client().get('/readings/fleet/temperature/')
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+
+        # Four readings from two devices: 22, 50, 100 and 22
+        self.assertEqual(result['number_of_readings'], 4)
+        self.assertEqual(result['active_devices'], 2)
+        self.assertEqual(result['min_reading_value'], 22)
+        self.assertEqual(result['max_reading_value'], 100)
+        self.assertEqual(result['mean_reading_value'], (22 + 50 + 100 + 22) / 4)
+        self.assertEqual(result['median_reading_value'], 36)
+        self.assertEqual(result['quartile_1_value'], 22)
+        self.assertEqual(result['quartile_3_value'], 62.5)
+
+    def test_fleet_readings_approximate_devices(self):
+        request = self.client().get('/readings/fleet/?approx_devices=true&precision=10')
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['number_of_readings'], 4)
+        self.assertEqual(result['active_devices'], 2)
+        self.assertIn('active_devices_error', result)
+
+    def test_fleet_readings_empty_range(self):
+        request = self.client().get('/readings/fleet/humidity/')
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['number_of_readings'], 0)
+        self.assertEqual(result['active_devices'], 0)
+        self.assertIsNone(result['median_reading_value'])
+
+    def test_device_readings_summary_state_after_post(self):
+        """
+        The summary without dates comes from the state updated on every POST
+        """
+        self.client().post('/devices/{}/readings/'.format('other_uuid'), data=json.dumps({'type': 'humidity', 'value': 40}))
+
+        request = self.client().get('/devices/readings/summary/')
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+
+        other_device = [device for device in result if device['device_uuid'] == 'other_uuid'][0]
+        self.assertEqual(other_device['number_of_readings'], 2)
+        self.assertEqual(other_device['max_reading_value'], 40)
+        self.assertEqual(other_device['mean_reading_value'], 31)
+        self.assertEqual(other_device['median_reading_value'], 31)
+
+        # Filtering by type only merges the histograms of that type
+        request = self.client().get('/devices/{}/readings/summary/'.format('humidity'))
+        result = json.loads(request.data)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['number_of_readings'], 1)
+
+    def test_device_readings_summary_state_rebuild(self):
+        """
+        Rebuilding the state from the raw readings gives the same summary
+        """
+        expected = json.loads(self.client().get('/devices/readings/summary/').data)
+
+        conn = sqlite3.connect('test_database.db')
+        rebuild_summary_state(conn)
+
+        self.assertEqual(json.loads(self.client().get('/devices/readings/summary/').data), expected)
+
+    def test_expired_readings_leave_aggregates_and_the_summary(self):
+        """
+        Nothing is deleted by default, with a policy the readings past it leave
+        the summary and are served as aggregates
+        """
+        self.assertEqual(app.config['RETENTION_POLICIES'], {})
+
+        conn = sqlite3.connect('test_database.db')
+        run_retention(conn, {'temperature': EXAMPLE_RETENTION_POLICIES['temperature']}, now=self.current_time + 31 * DAY_SECONDS,
+                      sketch_k=app.config['SKETCH_K'], sketch_bucket_seconds=app.config['SKETCH_BUCKET_SECONDS'])
+
+        request = self.client().get('/devices/readings/summary/')
+        self.assertEqual(json.loads(request.data), [])
+
+        request = self.client().get('/devices/{}/temperature/readings/aggregates/'.format(self.device_uuid))
+        self.assertEqual(request.status_code, 200)
+        aggregates = json.loads(request.data)
+        self.assertEqual(sum(aggregate['count'] for aggregate in aggregates), 3)
+        self.assertEqual(max(aggregate['max'] for aggregate in aggregates), 100)
+        self.assertEqual(min(aggregate['min'] for aggregate in aggregates), 22)
+
+    def test_device_readings_summary_dates_range(self):
+        """
+        With a date range the summary is computed from the readings in range
+        """
+        request = self.client().get('/devices/{}/{}/readings/summary/'.format('temperature', self.current_time - 50))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result[0]['device_uuid'], self.device_uuid)
+        self.assertEqual(result[0]['number_of_readings'], 2)
+        self.assertEqual(result[0]['median_reading_value'], 75)
+        self.assertEqual(result[1]['number_of_readings'], 1)
+
+    def test_device_readings_summary_top_k(self):
+        """
+        The summary can be limited to the top devices and paginated
+        """
+        request = self.client().get('/devices/readings/summary/?limit=1')
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual([device['device_uuid'] for device in result], [self.device_uuid])
+
+        request = self.client().get('/devices/readings/summary/?limit=1&offset=1')
+        result = json.loads(request.data)
+        self.assertEqual([device['device_uuid'] for device in result], ['other_uuid'])
+
+        # Same page with a date range, selected in Python instead of SQL
+        request = self.client().get('/devices/{}/{}/readings/summary/?limit=1&offset=1'.format('temperature', self.current_time - 100))
+        result = json.loads(request.data)
+        self.assertEqual([device['device_uuid'] for device in result], ['other_uuid'])
+
+    def test_device_readings_summary_sort_by(self):
+        request = self.client().get('/devices/readings/summary/?sort_by=max_reading_value&order=asc')
+        result = json.loads(request.data)
+        self.assertEqual([device['device_uuid'] for device in result], ['other_uuid', self.device_uuid])
+
+        request = self.client().get('/devices/readings/summary/?sort_by=median_reading_value&limit=1')
+        result = json.loads(request.data)
+        self.assertEqual([device['device_uuid'] for device in result], [self.device_uuid])
+
+    def test_device_readings_summary_invalid_sort_by(self):
+        request = self.client().get('/devices/readings/summary/?sort_by=value')
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_stats(self):
+        """
+        Several metrics of a device are returned by a single request
+        """
+        request = self.client().get('/devices/{}/{}/readings/stats/?metrics=max,mean,median,quartiles'.format(self.device_uuid, 'temperature'))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertDictEqual(result, {
+            'max': 100,
+            'mean': (22 + 50 + 100) / 3,
+            'median': 50,
+            'quartile_1': 36,
+            'quartile_3': 75
+        })
+
+    def test_device_readings_stats_dates_range(self):
+        request = self.client().get('/devices/{}/{}/{}/{}/readings/stats/'.format(self.device_uuid, 'temperature', self.current_time - 100, self.current_time - 1))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['count'], 2)
+        self.assertEqual(result['min'], 22)
+        self.assertEqual(result['max'], 50)
+
+    def test_device_readings_stats_invalid_metric(self):
+        request = self.client().get('/devices/{}/{}/readings/stats/?metrics=max,mode'.format(self.device_uuid, 'temperature'))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_readings_stats_query(self):
+        """
+        The metrics of several devices are returned keyed by device
+        """
+        request = self.client().post('/readings/stats/query/', data=json.dumps({
+            'device_uuids': [self.device_uuid, 'other_uuid', 'missing_uuid'],
+            'type': 'temperature',
+            'metrics': ['count', 'max', 'median']
+        }))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertDictEqual(result, {
+            self.device_uuid: {'count': 3, 'max': 100, 'median': 50},
+            'other_uuid': {'count': 1, 'max': 22, 'median': 22},
+            'missing_uuid': {'count': 0, 'max': None, 'median': None}
+        })
+
+    def test_readings_stats_query_dates_range(self):
+        request = self.client().post('/readings/stats/query/', data=json.dumps({
+            'device_uuids': [self.device_uuid],
+            'type': 'temperature',
+            'start': self.current_time - 50,
+            'end': self.current_time - 1,
+            'metrics': ['count']
+        }))
+
+        self.assertEqual(json.loads(request.data), {self.device_uuid: {'count': 1}})
+
+    def test_readings_stats_query_invalid(self):
+        request = self.client().post('/readings/stats/query/', data=json.dumps({
+            'device_uuids': [],
+            'type': 'temperature',
+            'metrics': ['mode']
+        }))
+
+        self.assertEqual(request.status_code, 400)
+        result = json.loads(request.data)
+        self.assertIn('device_uuids', result)
+        self.assertIn('metrics', result)
+
+    def test_device_readings_summary_job(self):
+        """
+        A summary can run as a background job and be polled for its result
+        """
+        request = self.client().post('/devices/readings/summary/jobs/', data=json.dumps({'type': 'temperature', 'limit': 1}))
+
+        self.assertEqual(request.status_code, 202)
+        job = json.loads(request.data)
+        self.assertIn(job['status'], ['queued', 'started', 'finished'])
+
+        get_job_queue().wait(job['job_id'], timeout=10)
+        request = self.client().get('/devices/readings/summary/jobs/{}/'.format(job['job_id']))
+
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(result['status'], 'finished')
+        self.assertEqual([device['device_uuid'] for device in result['result']], [self.device_uuid])
+
+    def test_device_readings_summary_job_deduplicated(self):
+        """
+        Identical jobs enqueued while the first one runs share the same id
+        """
+        queue = get_job_queue()
+        release = threading.Event()
+        queue.register('release', release.wait)
+        first = queue.enqueue('same-key', release.wait, 10)
+        second = queue.enqueue('same-key', release.wait, 10)
+        release.set()
+
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(queue.wait(first['id'], timeout=10)['status'], 'finished')
+
+    def test_device_readings_summary_job_not_found(self):
+        request = self.client().get('/devices/readings/summary/jobs/{}/'.format('missing'))
+
+        self.assertEqual(request.status_code, 404)
+
+    def test_device_readings_summary_job_invalid(self):
+        request = self.client().post('/devices/readings/summary/jobs/', data=json.dumps({'type': 'pressure'}))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_globals_are_created_once_under_concurrent_first_requests(self):
+        created = []
+        def slow_event_bus(*args):
+            created.append(args)
+            time.sleep(0.05)
+            return object()
+
+        with mock.patch.object(app_module, 'event_bus', None), mock.patch.object(app_module, 'EventBus', slow_event_bus):
+            start = threading.Barrier(4)
+            buses = []
+            def first_request():
+                start.wait()
+                buses.append(app_module.get_event_bus())
+            threads = [threading.Thread(target=first_request) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(created), 1)
+        self.assertEqual(len({id(bus) for bus in buses}), 1)
+
+    def test_metrics(self):
+        """
+        The metrics endpoint exposes per route counters and latencies
+        """
+        self.client().get('/devices/{}/{}/readings/median/'.format(self.device_uuid, 'temperature'))
+
+        request = self.client().get('/metrics')
+
+        self.assertEqual(request.status_code, 200)
+        body = request.data.decode('utf-8')
+        self.assertIn('http_requests_total{endpoint="request_device_readings_median",method="GET",status="200"}', body)
+        self.assertIn('http_request_duration_seconds_count{endpoint="request_device_readings_median",method="GET"}', body)
+        self.assertIn('dataframe_build_duration_seconds_count', body)
+        self.assertIn('db_rows_returned_total', body)
+        self.assertIn('ingest_queue_depth', body)
+
+    def test_device_readings_inverted_dates_range(self):
+        request = self.client().get('/devices/{}/{}/{}/{}/readings/'.format(self.device_uuid, 'temperature', self.current_time, self.current_time - 100))
+
+        self.assertEqual(request.status_code, 400)
+
+        request = self.client().get('/devices/{}/{}/{}/{}/readings/max/'.format(self.device_uuid, 'temperature', self.current_time, self.current_time - 100))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_relative_and_iso_dates(self):
+        """
+        Dates can be relative to now or ISO-8601, not only epoch seconds
+        """
+        request = self.client().get('/devices/{}/{}/{}/{}/readings/'.format(self.device_uuid, 'temperature', '-1h', 'now'))
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(len(json.loads(request.data)), 3)
+
+        request = self.client().get('/devices/{}/{}/{}/readings/'.format(self.device_uuid, 'temperature', '2000-01-01T00:00:00Z'))
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(len(json.loads(request.data)), 3)
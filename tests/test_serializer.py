@@ -0,0 +1,30 @@
+import json
+import sqlite3
+import unittest
+from unittest import mock
+
+import numpy
+
+from utils import serializer
+from utils.serializer import available_serializers, get_serializer
+
+class SerializerTestCases(unittest.TestCase):
+
+    def test_rows_tuples_and_numpy_values(self):
+        conn = sqlite3.connect(':memory:')
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("select 'device' as device_uuid, 22 as value").fetchone()
+        data = {'row': row, 'pair': (1, 2), 'median': numpy.float64(36.0), 'count': numpy.int64(3), 'values': numpy.array([1, 2])}
+
+        for name in available_serializers():
+            self.assertEqual(json.loads(get_serializer(name).dumps(data)),
+                             {'row': {'device_uuid': 'device', 'value': 22}, 'pair': [1, 2], 'median': 36.0, 'count': 3, 'values': [1, 2]})
+
+    def test_missing_backend_falls_back_to_stdlib(self):
+        with mock.patch.object(serializer, 'orjson', None):
+            self.assertEqual(get_serializer('auto').name, 'json')
+            self.assertEqual(get_serializer('orjson').name, 'json')
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            get_serializer('yaml')
@@ -0,0 +1,53 @@
+import sqlite3
+import unittest
+
+from utils.db_utils import reset_db
+from utils.storage import Storage
+
+class StorageTestCases(unittest.TestCase):
+
+    def setUp(self):
+        reset_db('test_database.db')
+        self.storage = Storage('test_database.db', readers=2)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def insert_reading(self, value):
+        with self.storage.writer() as conn:
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', ('device', 'temperature', value, 100))
+
+    def count_readings(self, conn):
+        return conn.execute('select count(*) from readings').fetchone()[0]
+
+    def test_readers_are_read_only(self):
+        with self.storage.reader() as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', ('device', 'temperature', 1, 100))
+
+    def test_readers_keep_their_snapshot_while_writing(self):
+        self.insert_reading(10)
+
+        with self.storage.reader() as conn:
+            self.assertEqual(self.count_readings(conn), 1)
+            # The writer is not blocked by the open read transaction
+            self.insert_reading(20)
+            self.assertEqual(self.count_readings(conn), 1)
+
+        with self.storage.reader() as conn:
+            self.assertEqual(self.count_readings(conn), 2)
+
+    def test_writer_rolls_back_on_errors(self):
+        with self.assertRaises(ValueError):
+            with self.storage.writer() as conn:
+                conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', ('device', 'temperature', 10, 100))
+                raise ValueError('Invalid reading')
+
+        with self.storage.reader() as conn:
+            self.assertEqual(self.count_readings(conn), 0)
+
+    def test_reader_connections_are_reused(self):
+        with self.storage.reader() as first:
+            pass
+        with self.storage.reader() as second:
+            self.assertIs(first, second)
@@ -0,0 +1,94 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+class TokenBuckets:
+    """
+    Token bucket per key: rate tokens per second up to burst. Buckets are kept
+    in last use order, so the idle ones are evicted from the front and at most
+    max_keys are kept. A bucket idle for burst / rate seconds is full anyway,
+    so evicting it after idle_seconds (longer than that) changes nothing.
+    """
+
+    def __init__(self, rate, burst, idle_seconds=300, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.idle_seconds = idle_seconds
+        self.max_keys = max_keys
+        # key -> (tokens, last update)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now=None):
+        """
+        Take a token of key, returns 0 when there was one and otherwise
+        the seconds until there is
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+        return wait
+
+    def _evict(self, now):
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - updated <= self.idle_seconds:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+class LoadShedder:
+    """
+    Rejects writes while too many are waiting for or holding the writer, or
+    while the write latency (a moving average) is over max_latency. The latency
+    only counts for stale_seconds after the last write, so once writes stop
+    being admitted a probe gets through and can bring it down.
+    """
+
+    def __init__(self, max_backlog=None, max_latency=None, smoothing=0.2, stale_seconds=1.0):
+        self.max_backlog = max_backlog
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+        self.stale_seconds = stale_seconds
+        self.backlog = 0
+        self.latency = 0.0
+        self._observed_at = None
+        self._lock = threading.Lock()
+
+    def admit(self, now=None):
+        """
+        None when the write can go on, otherwise (reason, retry after seconds)
+        """
+        now = time.monotonic() if now is None else now
+        if self.max_backlog is not None and self.backlog >= self.max_backlog:
+            return 'backlog', 1
+        if (self.max_latency is not None and self.latency > self.max_latency
+                and self._observed_at is not None and now - self._observed_at < self.stale_seconds):
+            return 'latency', max(1, math.ceil(self.latency))
+        return None
+
+    def start(self):
+        with self._lock:
+            self.backlog += 1
+
+    def finish(self, latency, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.backlog -= 1
+            self.latency += self.smoothing * (latency - self.latency)
+            self._observed_at = now
@@ -0,0 +1,86 @@
+import operator
+import threading
+import time
+
+from utils.dictionary import TYPE_IDS, TYPE_NAMES
+
+# Comparisons a rule can use, the reading value on the left and the threshold on the right
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq}
+
+# Topic of the event bus the firings are published on, reading topics are device uuids
+ALERTS_TOPIC = ('alerts',)
+
+RULE_FIELDS = ('id', 'device_uuid', 'type', 'operator', 'threshold')
+ALERT_FIELDS = ('id', 'rule_id', 'device_uuid', 'type', 'operator', 'threshold', 'value', 'date_created', 'fired_at')
+# The same fields as stored in alerts, by device and type id
+ALERT_COLUMNS = ('id', 'rule_id', 'device_id', 'type_id', 'operator', 'threshold', 'value', 'date_created', 'fired_at')
+
+class AlertRuleIndex:
+    """
+    Alert rules indexed by (device, type), a rule without device applies to
+    every device. A reading is only compared with the rules of its device and
+    type plus the rules of its type for any device. Loaded from alert_rules and
+    reloaded whenever alert_rules_version moves, so the rules changed through
+    any process are seen by all of them.
+    """
+
+    def __init__(self):
+        # (version, rules) replaced as a whole, ingest reads it without the lock
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _index(self, conn):
+        version = conn.execute('select version from alert_rules_version').fetchone()[0]
+        state = self._state
+        if state is None or state[0] != version:
+            with self._lock:
+                rules = {}
+                for row in conn.execute('select {} from alert_rules'.format(', '.join(RULE_FIELDS))):
+                    self._insert(rules, dict(zip(RULE_FIELDS, row)))
+                state = self._state = (version, rules)
+        return state[1]
+
+    @staticmethod
+    def _insert(rules, rule):
+        rules.setdefault((rule['device_uuid'], rule['type']), []).append(rule)
+
+    def matching(self, conn, device_uuid, sensor_type, value):
+        """
+        The rules a reading breaches
+        """
+        rules = self._index(conn)
+        candidates = rules.get((device_uuid, sensor_type), []) + rules.get((None, sensor_type), [])
+        return [rule for rule in candidates if OPERATORS[rule['operator']](value, rule['threshold'])]
+
+    def clear(self):
+        # Reloaded on next use, needed when the database is recreated
+        with self._lock:
+            self._state = None
+
+def create_rule(conn, device_uuid, sensor_type, rule_operator, threshold):
+    cur = conn.execute('insert into alert_rules (device_uuid, type, operator, threshold) VALUES (?,?,?,?)',
+                       (device_uuid, sensor_type, rule_operator, threshold))
+    return dict(zip(RULE_FIELDS, (cur.lastrowid, device_uuid, sensor_type, rule_operator, threshold)))
+
+def record_alerts(conn, rules, device_id, device_uuid, sensor_type, value, date_created):
+    """
+    Store one alert per breached rule, returns them
+    """
+    fired_at = int(time.time())
+    alerts = []
+    for rule in rules:
+        values = (rule['operator'], rule['threshold'], value, date_created, fired_at)
+        cur = conn.execute('insert into alerts ({}) VALUES (?,?,?,?,?,?,?,?)'.format(', '.join(ALERT_COLUMNS[1:])),
+                           (rule['id'], device_id, TYPE_IDS[sensor_type]) + values)
+        alerts.append(dict(zip(ALERT_FIELDS, (cur.lastrowid, rule['id'], device_uuid, sensor_type) + values)))
+    return alerts
+
+def select_alerts(conn, devices, device_id, after_id, limit):
+    """
+    Up to limit alerts after after_id in id order, of one device unless device_id
+    is None, with the uuid of their device looked up in the devices registry
+    """
+    rows = conn.execute('select {} from alerts where (?1 IS NULL OR device_id=?1) AND id > ?2 order by id limit ?3'.format(', '.join(ALERT_COLUMNS)),
+                        [device_id, after_id, limit]).fetchall()
+    device_uuids = devices.device_uuids(conn, [row[2] for row in rows])
+    return [dict(zip(ALERT_FIELDS, row[:2] + (device_uuids[row[2]], TYPE_NAMES[row[3]]) + row[4:])) for row in rows]
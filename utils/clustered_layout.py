@@ -0,0 +1,114 @@
+import time
+
+from utils.db_utils import CLUSTERED, CLUSTERED_READING_ROWS, SCHEMA, readings_layout
+
+# Moves a heap reading_rows to the clustered layout while the API keeps serving:
+# the new table is filled chunk by chunk, triggers mirror the writes made in the
+# meantime, and a last short transaction swaps the tables.
+
+# Rows copied so far, by rowid of the heap table
+PROGRESS_TABLE = 'CREATE TABLE IF NOT EXISTS reading_rows_migration (last_rowid INTEGER NOT NULL)'
+
+MIRROR_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS reading_rows_mirror_insert AFTER INSERT ON reading_rows
+    BEGIN
+        INSERT OR IGNORE INTO reading_rows_clustered (device_id, type_id, date_created, seq, value)
+            VALUES (new.device_id, new.type_id, new.date_created, new.seq, new.value);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS reading_rows_mirror_delete AFTER DELETE ON reading_rows
+    BEGIN
+        DELETE FROM reading_rows_clustered WHERE device_id = old.device_id AND type_id = old.type_id
+            AND date_created = old.date_created AND seq = old.seq;
+    END''',
+]
+
+def start_migration(conn):
+    """
+    Create the clustered table, the progress and the mirror triggers, safe to run more than once
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(CLUSTERED_READING_ROWS.format('reading_rows_clustered'))
+        conn.execute(PROGRESS_TABLE)
+        if conn.execute('select count(*) from reading_rows_migration').fetchone()[0] == 0:
+            conn.execute('insert into reading_rows_migration (last_rowid) VALUES (0)')
+        for statement in MIRROR_TRIGGERS:
+            conn.execute(statement)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def copy_chunk(conn, chunk_size=None):
+    """
+    Copy the next chunk_size readings (all of them when None) into the
+    clustered table. Returns the number of readings read from the heap table,
+    some may be there already because of the mirror triggers.
+    """
+    last_rowid = conn.execute('select last_rowid from reading_rows_migration').fetchone()[0]
+    limit = -1 if chunk_size is None else chunk_size
+    end_rowid, count = conn.execute('select max(rowid), count(*) from (select rowid from reading_rows where rowid > ?1 order by rowid limit ?2)',
+                                    [last_rowid, limit]).fetchone()
+    if count == 0:
+        return 0
+    conn.execute('''INSERT OR IGNORE INTO reading_rows_clustered (device_id, type_id, date_created, seq, value)
+                    SELECT device_id, type_id, date_created, seq, value FROM reading_rows WHERE rowid > ?1 AND rowid <= ?2''',
+                 [last_rowid, end_rowid])
+    conn.execute('update reading_rows_migration set last_rowid = ?1', [end_rowid])
+    return count
+
+def finish_migration(conn):
+    """
+    Copy what is left and replace the heap table, in one transaction.
+    The view and triggers over reading_rows are recreated on the new table.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        copy_chunk(conn)
+        conn.execute('DROP VIEW readings')
+        # Its triggers, the mirror ones included, and its indexes go with it
+        conn.execute('DROP TABLE reading_rows')
+        conn.execute('DROP TABLE reading_rows_migration')
+        conn.execute('ALTER TABLE reading_rows_clustered RENAME TO reading_rows')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def migrate_to_clustered(conn, chunk_size=5000, time_budget=None, pause=0, progress=None):
+    """
+    Move reading_rows to the clustered layout, one committed chunk at a time so
+    writers only ever wait for a single chunk. Stops early once time_budget
+    seconds are spent, running it again resumes the copy. Calls progress(report)
+    after every chunk and returns the report.
+    """
+    started = time.monotonic()
+    report = {'copied': 0, 'finished': False}
+    if readings_layout(conn) == CLUSTERED:
+        report['finished'] = True
+        return report
+
+    start_migration(conn)
+    while True:
+        if time_budget is not None and time.monotonic() - started >= time_budget:
+            return report
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            copied = copy_chunk(conn, chunk_size)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if copied == 0:
+            break
+        report['copied'] += copied
+        if progress is not None:
+            progress(report)
+        if pause:
+            time.sleep(pause)
+
+    finish_migration(conn)
+    report['finished'] = True
+    return report
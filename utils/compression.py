@@ -0,0 +1,117 @@
+import zlib
+
+# brotli and zstandard are optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class GzipStream:
+
+    def __init__(self, level):
+        # wbits 31 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class BrotliStream:
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+class ZstdStream:
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+# Content codings by preference, the level is given to the codec as is so 1-9 is valid for all of them
+STREAMS = {'zstd': ZstdStream, 'br': BrotliStream, 'gzip': GzipStream}
+AVAILABLE_ENCODINGS = [encoding for encoding, installed in (('zstd', zstandard), ('br', brotli), ('gzip', zlib)) if installed is not None]
+
+def parse_accept_encoding(header):
+    """
+    Map of coding to quality from an Accept-Encoding header
+    """
+    qualities = {}
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+def negotiate_encoding(header, encodings=None):
+    """
+    The content coding to answer with, None to send the body as is.
+    The highest quality wins and ties go to the first of encodings.
+    """
+    qualities = parse_accept_encoding(header)
+    best = None
+    best_quality = 0.0
+    for encoding in AVAILABLE_ENCODINGS if encodings is None else encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(data, encoding, level):
+    stream = STREAMS[encoding](level)
+    return stream.compress(data) + stream.finish()
+
+def compress_chunks(chunks, encoding, level):
+    """
+    Compress a streamed body incrementally. Every chunk is flushed, so what a
+    client receives can be decoded right away (events are not held back).
+    """
+    stream = STREAMS[encoding](level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = stream.compress(chunk) + stream.flush()
+            if data:
+                yield data
+        yield stream.finish()
+    finally:
+        # The server closes this generator when the client goes away, pass it on
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -1,8 +1,67 @@
 import datetime
+import re
 import time
+from collections import namedtuple
 
-def getDefaultDatesParams(start, end):
-    start_date = 21600 if start is None else start 
-    end_date = int(time.time()) if end is None else end   
-      
-    return start_date, end_date
\ No newline at end of file
+# Start of the range when none is given
+DEFAULT_START = 21600
+
+# Relative expressions like -1h, +30m or -2d
+RELATIVE_TIME = re.compile(r'^([+-])(\d+)([smhdw])$')
+UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+class InvalidTimeRange(ValueError):
+    pass
+
+class TimeRange(namedtuple('TimeRange', ['start', 'end'])):
+    """
+    Inclusive range of integer epoch seconds, unpacks as (start, end)
+    """
+    __slots__ = ()
+
+    @property
+    def cache_key(self):
+        # Stable key of the normalized range for caching layers
+        return '{}:{}'.format(self.start, self.end)
+
+def parse_time_value(value, now):
+    """
+    Turn epoch seconds, 'now', a relative expression (-1h, +30m, -2d)
+    or an ISO-8601 date into integer epoch seconds.
+    """
+    if isinstance(value, bool):
+        raise InvalidTimeRange('Invalid time: {}'.format(value))
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+
+    text = str(value).strip()
+    if re.match(r'^-?\d+$', text):
+        return int(text)
+    if text.lower() == 'now':
+        return now
+
+    relative = RELATIVE_TIME.match(text)
+    if relative is not None:
+        sign, amount, unit = relative.groups()
+        offset = int(amount) * UNIT_SECONDS[unit]
+        return now - offset if sign == '-' else now + offset
+
+    try:
+        date = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        raise InvalidTimeRange('Invalid time: {}, use epoch seconds, ISO-8601, now or a relative time like -1h'.format(value))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+def getDefaultDatesParams(start, end, now=None):
+    now = int(time.time()) if now is None else now
+    start_date = DEFAULT_START if start is None else parse_time_value(start, now)
+    end_date = now if end is None else parse_time_value(end, now)
+
+    if start_date > end_date:
+        raise InvalidTimeRange('The start {} is after the end {}'.format(start_date, end_date))
+
+    return TimeRange(start_date, end_date)
@@ -0,0 +1,370 @@
+import sqlite3
+import time
+
+from utils.dictionary import TYPE_IDS
+from utils.metrics import DB_QUERY_SECONDS, DB_FETCH_SECONDS, DB_ROWS_RETURNED, DB_VM_STEPS
+from utils.query_log import log_slow_query
+
+DATABASE_PATH = 'database.db'
+TEST_DATABASE_PATH = 'test_database.db'
+
+# Statements needed to bring an empty database to the current schema,
+# every statement must be safe to run more than once
+SCHEMA = [
+    # Devices and sensor types are stored once, the readings only keep their integer ids
+    'CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, device_uuid TEXT NOT NULL UNIQUE)',
+    'CREATE TABLE IF NOT EXISTS sensor_types (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+    'INSERT OR IGNORE INTO sensor_types (id, name) VALUES ' + ', '.join("({}, '{}')".format(type_id, name) for name, type_id in TYPE_IDS.items()),
+    # seq tells apart the readings of a device and type stored in the same second,
+    # (device_id, type_id, date_created, seq) is unique in both layouts
+    'CREATE TABLE IF NOT EXISTS reading_rows (device_id INTEGER NOT NULL, type_id INTEGER NOT NULL, value INTEGER, date_created INTEGER NOT NULL, seq INTEGER NOT NULL DEFAULT 0)',
+    # readings keeps the original columns for the queries that filter by uuid and
+    # type names, inserting into it registers the device when it is new
+    '''CREATE VIEW IF NOT EXISTS readings AS
+    SELECT devices.device_uuid AS device_uuid, sensor_types.name AS type, reading_rows.value AS value, reading_rows.date_created AS date_created
+    FROM reading_rows JOIN devices ON devices.id = reading_rows.device_id JOIN sensor_types ON sensor_types.id = reading_rows.type_id''',
+    '''CREATE TRIGGER IF NOT EXISTS readings_insert INSTEAD OF INSERT ON readings
+    BEGIN
+        INSERT OR IGNORE INTO devices (device_uuid) VALUES (new.device_uuid);
+        INSERT INTO reading_rows (device_id, type_id, value, date_created, seq) VALUES (
+            (SELECT id FROM devices WHERE device_uuid = new.device_uuid), (SELECT id FROM sensor_types WHERE name = new.type), new.value, new.date_created,
+            (SELECT coalesce(max(seq) + 1, 0) FROM reading_rows WHERE device_id = (SELECT id FROM devices WHERE device_uuid = new.device_uuid)
+                AND type_id = (SELECT id FROM sensor_types WHERE name = new.type) AND date_created = new.date_created));
+    END''',
+    # The tables below are keyed by device and type ids like reading_rows, the
+    # uuids and names are looked up through the DeviceRegistry when read.
+    # Quantile sketches per (device, type, time bucket), merged at query time by the approximate metrics
+    'CREATE TABLE IF NOT EXISTS reading_sketches (device_id INTEGER, type_id INTEGER, bucket_start INTEGER, sketch TEXT, PRIMARY KEY (device_id, type_id, bucket_start))',
+    # Retention expires the sketches of a type by bucket, the primary key starts with the device
+    'CREATE INDEX IF NOT EXISTS reading_sketches_type_bucket ON reading_sketches (type_id, bucket_start)',
+    # Running summary per (device, type) and its 0-100 value histogram, the trigger
+    # keeps them in the same transaction as every insert into reading_rows
+    'CREATE TABLE IF NOT EXISTS device_summaries (device_id INTEGER, type_id INTEGER, count INTEGER, sum INTEGER, max INTEGER, PRIMARY KEY (device_id, type_id))',
+    'CREATE TABLE IF NOT EXISTS device_summary_histograms (device_id INTEGER, type_id INTEGER, value INTEGER, count INTEGER, PRIMARY KEY (device_id, type_id, value))',
+    '''CREATE TRIGGER IF NOT EXISTS reading_rows_update_summary AFTER INSERT ON reading_rows
+    BEGIN
+        INSERT INTO device_summaries (device_id, type_id, count, sum, max) VALUES (new.device_id, new.type_id, 1, new.value, new.value)
+            ON CONFLICT (device_id, type_id) DO UPDATE SET count = count + 1, sum = sum + excluded.sum, max = MAX(max, excluded.max);
+        INSERT INTO device_summary_histograms (device_id, type_id, value, count) VALUES (new.device_id, new.type_id, new.value, 1)
+            ON CONFLICT (device_id, type_id, value) DO UPDATE SET count = count + 1;
+    END''',
+    # Downsampled readings left by the retention compactor once the raw ones expire
+    'CREATE TABLE IF NOT EXISTS readings_aggregates (device_id INTEGER, type_id INTEGER, bucket_seconds INTEGER, bucket_start INTEGER, count INTEGER, sum INTEGER, min INTEGER, max INTEGER, PRIMARY KEY (device_id, type_id, bucket_seconds, bucket_start))',
+    'CREATE INDEX IF NOT EXISTS reading_rows_type_date_created ON reading_rows (type_id, date_created)',
+    # Threshold rules checked on ingest, a rule without device_uuid applies to every device, and what they fired
+    'CREATE TABLE IF NOT EXISTS alert_rules (id INTEGER PRIMARY KEY, device_uuid TEXT, type TEXT NOT NULL, operator TEXT NOT NULL, threshold INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY, rule_id INTEGER NOT NULL, device_id INTEGER NOT NULL, type_id INTEGER NOT NULL, operator TEXT, threshold INTEGER, value INTEGER, date_created INTEGER, fired_at INTEGER)',
+    'CREATE INDEX IF NOT EXISTS alerts_device_id ON alerts (device_id, id)',
+    # Bumped on every change of the rules, each process reloads its rule index when it moves
+    'CREATE TABLE IF NOT EXISTS alert_rules_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO alert_rules_version (id, version) VALUES (0, 0)',
+    'CREATE TRIGGER IF NOT EXISTS alert_rules_insert_version AFTER INSERT ON alert_rules BEGIN UPDATE alert_rules_version SET version = version + 1; END',
+    'CREATE TRIGGER IF NOT EXISTS alert_rules_update_version AFTER UPDATE ON alert_rules BEGIN UPDATE alert_rules_version SET version = version + 1; END',
+    'CREATE TRIGGER IF NOT EXISTS alert_rules_delete_version AFTER DELETE ON alert_rules BEGIN UPDATE alert_rules_version SET version = version + 1; END',
+    # Keys of the readings already stored, a retried POST with the same key is not stored again
+    'CREATE TABLE IF NOT EXISTS ingest_keys (device_id INTEGER NOT NULL, key TEXT NOT NULL, created_at INTEGER NOT NULL, PRIMARY KEY (device_id, key)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS ingest_keys_created_at ON ingest_keys (created_at)',
+    # Background jobs shared by every process, see utils/jobs.py SQLiteJobQueue
+    'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, key TEXT NOT NULL, function TEXT NOT NULL, args TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, started_at REAL, ended_at REAL)',
+    "CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_key ON jobs (key) WHERE status IN ('queued', 'started')",
+    'CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)',
+]
+
+# Tables that were keyed by the device uuid and type name text, with their other
+# columns, init_db moves them to device and type ids
+TEXT_KEYED_TABLES = {
+    'reading_sketches': ('bucket_start', 'sketch'),
+    'device_summaries': ('count', 'sum', 'max'),
+    'device_summary_histograms': ('value', 'count'),
+    'readings_aggregates': ('bucket_seconds', 'bucket_start', 'count', 'sum', 'min', 'max'),
+    'alerts': ('id', 'rule_id', 'operator', 'threshold', 'value', 'date_created', 'fired_at'),
+}
+
+# Readings layouts: heap keeps reading_rows in insertion order, clustered stores
+# them ordered by device, type and date so a device range reads contiguous pages
+HEAP = 'heap'
+CLUSTERED = 'clustered'
+LAYOUTS = (HEAP, CLUSTERED)
+
+CLUSTERED_READING_ROWS = '''CREATE TABLE IF NOT EXISTS {} (device_id INTEGER NOT NULL, type_id INTEGER NOT NULL, date_created INTEGER NOT NULL,
+    seq INTEGER NOT NULL, value INTEGER, PRIMARY KEY (device_id, type_id, date_created, seq)) WITHOUT ROWID'''
+
+# Only the heap layout needs them: the clustered primary key already is the first one and
+# the stream replay, which reads the others in rowid order, has no rowid to resume from there
+HEAP_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS reading_rows_device_type_date_created ON reading_rows (device_id, type_id, date_created)',
+    'CREATE INDEX IF NOT EXISTS reading_rows_device ON reading_rows (device_id)',
+    'CREATE INDEX IF NOT EXISTS reading_rows_device_type ON reading_rows (device_id, type_id)',
+]
+
+# Page of the heap readings of a device after a rowid, of any type or of type_id ?2. Both
+# indexes above end in rowid order, so a page reads its own rows only and is never sorted
+REPLAY_READINGS = 'select rowid, type_id, value, date_created from reading_rows where device_id=?1 AND rowid > ?3 order by rowid limit ?4'
+REPLAY_TYPE_READINGS = 'select rowid, type_id, value, date_created from reading_rows where device_id=?1 AND type_id=?2 AND rowid > ?3 order by rowid limit ?4'
+
+# Insert of one reading by ids, parameters are (device_id, type_id, value, date_created)
+INSERT_READING = '''insert into reading_rows (device_id, type_id, value, date_created, seq) VALUES (?1, ?2, ?3, ?4,
+    (select coalesce(max(seq) + 1, 0) from reading_rows where device_id=?1 AND type_id=?2 AND date_created=?4))'''
+
+# (device_id, value) of the readings of a type (any with NULL) in a date range, ordered by device.
+# Read through the device index on heap and the primary key on clustered: through the type and date
+# index SQLite would sort the whole range in a temp b-tree before returning the first row. Both
+# walk every reading of the type though, see range_readings_query() for the narrow ranges
+DEVICE_ORDERED_READINGS = {
+    HEAP: '''select device_id, value from reading_rows INDEXED BY reading_rows_device_type_date_created
+        where (?1 IS NULL OR type_id=?1) AND date_created BETWEEN ?2 AND ?3 AND value IS NOT NULL order by device_id''',
+    # NOT INDEXED doesn't apply to the secondary indexes of a WITHOUT ROWID table, the unary + keeps them out
+    CLUSTERED: '''select device_id, value from reading_rows
+        where (?1 IS NULL OR +type_id=?1) AND +date_created BETWEEN ?2 AND ?3 AND value IS NOT NULL order by device_id''',
+}
+
+# The same rows read through the type and date index, only the readings in range, then
+# sorted. The sorter spills to disk past its cache, so a wide range doesn't grow memory either
+SORTED_RANGE_READINGS = '''select device_id, value from reading_rows INDEXED BY reading_rows_type_date_created
+    where type_id IN (select id from sensor_types where ?1 IS NULL OR id=?1) AND date_created BETWEEN ?2 AND ?3 AND value IS NOT NULL order by device_id'''
+
+def range_readings_query(conn, type_id, start, end, sorted_fraction=0.1):
+    """
+    Query of the (device_id, value) readings in range ordered by device. A range
+    covering less than sorted_fraction of the dates stored for the type is read
+    through the type and date index and sorted, a wider one in device order. The
+    dates stored are the min and max of the type and date index, no statistics needed.
+    """
+    first = last = None
+    for stored_type_id in (TYPE_IDS.values() if type_id is None else [type_id]):
+        type_first, type_last = conn.execute('''select (select min(date_created) from reading_rows where type_id=?1),
+                                                     (select max(date_created) from reading_rows where type_id=?1)''', [stored_type_id]).fetchone()
+        if type_first is not None:
+            first = type_first if first is None else min(first, type_first)
+            last = type_last if last is None else max(last, type_last)
+    if first is None or min(end, last) - max(start, first) + 1 < sorted_fraction * (last - first + 1):
+        return SORTED_RANGE_READINGS
+    return DEVICE_ORDERED_READINGS[readings_layout(conn)]
+
+# The progress handler runs every this many SQLite virtual machine steps
+VM_STEPS_PER_CALLBACK = 1000
+
+# Rows fetched at a time when an instrumented cursor is iterated
+ITER_BATCH_SIZE = 1000
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor that records statement time, fetch time and rows returned in the
+    metrics. The time of a statement adds its execute and every fetch, when it
+    goes over the connection slow query threshold it is logged with its plan.
+    """
+    _statement = None
+
+    def _finish_statement(self):
+        statement = self._statement
+        self._statement = None
+        threshold = self.connection.slow_query_threshold
+        if statement is not None and threshold is not None and statement['elapsed'] >= threshold:
+            log_slow_query(self.connection, statement['sql'], statement['parameters'], statement['elapsed'])
+
+    def execute(self, sql, parameters=()):
+        self._finish_statement()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_SECONDS.observe(elapsed)
+            self._statement = {'sql': sql, 'parameters': parameters, 'elapsed': elapsed}
+            # Statements without rows to fetch are done once executed
+            if self.description is None:
+                self._finish_statement()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish_statement()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started)
+
+    def _fetched(self, started, rows, exhausted):
+        elapsed = time.perf_counter() - started
+        DB_FETCH_SECONDS.inc(amount=elapsed)
+        DB_ROWS_RETURNED.inc(amount=rows)
+        if self._statement is not None:
+            self._statement['elapsed'] += elapsed
+            if exhausted:
+                self._finish_statement()
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        # Mostly single row reads (an aggregate, a lookup) that are never read to the end,
+        # the statement is done with its first row
+        self._fetched(started, 0 if row is None else 1, True)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def __iter__(self):
+        # Rows are fetched in batches, timing every row would cost more than reading it
+        while True:
+            rows = self.fetchmany(ITER_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._finish_statement()
+        super().close()
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Statements slower than this many seconds are logged, None disables it
+    slow_query_threshold = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_progress_handler(count_vm_steps, VM_STEPS_PER_CALLBACK)
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute runs its statement on a plain cursor, these go through the instrumented one
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def count_vm_steps():
+    DB_VM_STEPS.inc()
+    # Returning a true value would abort the statement
+    return 0
+
+def connect(database_path, slow_query_threshold=None, **kwargs):
+    """
+    Open an instrumented connection, returning rows as sqlite3.Row.
+    Extra keyword arguments go to sqlite3.connect.
+    """
+    conn = sqlite3.connect(database_path, factory=InstrumentedConnection, **kwargs)
+    conn.row_factory = sqlite3.Row
+    conn.slow_query_threshold = slow_query_threshold
+    return conn
+
+def fetch_columns(cur, columns, batch_size=1000):
+    """
+    Read what is left of an executed cursor as one list per column, transposing
+    batches of rows instead of handling every row on its own
+    """
+    lists = [[] for _ in range(columns)]
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            return lists
+        for column, values in zip(lists, zip(*batch)):
+            column.extend(values)
+
+def get_database_path(testing=False):
+    return TEST_DATABASE_PATH if testing else DATABASE_PATH
+
+def readings_layout(conn):
+    """
+    Layout of reading_rows, heap or clustered
+    """
+    row = conn.execute("select sql from sqlite_master where type='table' AND name='reading_rows'").fetchone()
+    return CLUSTERED if row is not None and 'WITHOUT ROWID' in row[0].upper() else HEAP
+
+def init_db(database_path, layout=HEAP):
+    """
+    Create the tables the API needs. This is an explicit step (flask init-db or
+    python app.py) so importing the app never touches the database. The layout
+    only applies to a new database, see utils/clustered_layout.py to migrate one.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError('layout must be one of: {}'.format(', '.join(LAYOUTS)))
+    conn = sqlite3.connect(database_path)
+    try:
+        # Readers work on a snapshot and never block the writer
+        conn.execute('PRAGMA journal_mode = WAL')
+        # Databases from before the dictionary encoding have readings as a plain table
+        legacy = conn.execute("select 1 from sqlite_master where type='table' AND name='readings'").fetchone() is not None
+        if legacy:
+            conn.execute('ALTER TABLE readings RENAME TO readings_legacy')
+        new = conn.execute("select 1 from sqlite_master where name='reading_rows'").fetchone() is None
+        if new and layout == CLUSTERED:
+            conn.execute(CLUSTERED_READING_ROWS.format('reading_rows'))
+        # The summary trigger of these tables writes the text keys, it is recreated by SCHEMA
+        text_keyed = [name for name in TEXT_KEYED_TABLES if 'device_uuid' in [column[1] for column in conn.execute('PRAGMA table_info({})'.format(name))]]
+        if text_keyed:
+            conn.execute('DROP TRIGGER IF EXISTS reading_rows_update_summary')
+            for name in text_keyed:
+                conn.execute('ALTER TABLE {0} RENAME TO {0}_text_keyed'.format(name))
+        for statement in SCHEMA:
+            conn.execute(statement)
+        if readings_layout(conn) == HEAP:
+            # reading_rows from before seq was added
+            if 'seq' not in [column[1] for column in conn.execute('PRAGMA table_info(reading_rows)')]:
+                conn.execute('ALTER TABLE reading_rows ADD COLUMN seq INTEGER NOT NULL DEFAULT 0')
+                conn.execute('''UPDATE reading_rows SET seq = numbered.seq FROM (
+                                    SELECT rowid AS id, row_number() OVER (PARTITION BY device_id, type_id, date_created ORDER BY rowid) - 1 AS seq FROM reading_rows
+                                ) AS numbered WHERE reading_rows.rowid = numbered.id AND numbered.seq > 0''')
+            for statement in HEAP_INDEXES:
+                conn.execute(statement)
+        if text_keyed:
+            migrate_text_keys(conn, text_keyed)
+        if legacy:
+            migrate_legacy_readings(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+def migrate_legacy_readings(conn):
+    """
+    Move the readings of the plain readings table into reading_rows. The
+    summary state is emptied first, the trigger rebuilds it as rows are copied.
+    """
+    conn.execute('DELETE FROM device_summaries')
+    conn.execute('DELETE FROM device_summary_histograms')
+    conn.execute('INSERT OR IGNORE INTO devices (device_uuid) SELECT DISTINCT device_uuid FROM readings_legacy')
+    conn.execute('''INSERT INTO reading_rows (device_id, type_id, value, date_created, seq)
+                    SELECT devices.id, sensor_types.id, readings_legacy.value, readings_legacy.date_created,
+                        row_number() OVER (PARTITION BY devices.id, sensor_types.id, readings_legacy.date_created ORDER BY readings_legacy.rowid) - 1
+                    FROM readings_legacy JOIN devices ON devices.device_uuid = readings_legacy.device_uuid
+                    JOIN sensor_types ON sensor_types.name = readings_legacy.type ORDER BY readings_legacy.rowid''')
+    conn.execute('DROP TABLE readings_legacy')
+
+def migrate_text_keys(conn, tables):
+    """
+    Copy the rows of the tables renamed to <name>_text_keyed into their id keyed
+    version, registering the devices only found there.
+    """
+    for name in tables:
+        columns = TEXT_KEYED_TABLES[name]
+        conn.execute('INSERT OR IGNORE INTO devices (device_uuid) SELECT DISTINCT device_uuid FROM {}_text_keyed'.format(name))
+        conn.execute('''INSERT INTO {0} (device_id, type_id, {1})
+                        SELECT devices.id, sensor_types.id, {2} FROM {0}_text_keyed AS text_keyed
+                        JOIN devices ON devices.device_uuid = text_keyed.device_uuid JOIN sensor_types ON sensor_types.name = text_keyed.type'''.format(
+                     name, ', '.join(columns), ', '.join('text_keyed.' + column for column in columns)))
+        conn.execute('DROP TABLE {}_text_keyed'.format(name))
+
+def reset_db(database_path, layout=HEAP):
+    """
+    Drop every table and view and recreate the schema, used to start the tests from
+    a clean database.
+    """
+    conn = sqlite3.connect(database_path)
+    try:
+        objects = conn.execute("select type, name from sqlite_master where type IN ('view', 'table') AND name NOT LIKE 'sqlite_%' order by type desc").fetchall()
+        for object_type, name in objects:
+            conn.execute('DROP {} IF EXISTS "{}"'.format(object_type.upper(), name))
+        conn.commit()
+    finally:
+        conn.close()
+    init_db(database_path, layout)
@@ -0,0 +1,82 @@
+import json
+
+# Ids of the sensor types in the sensor_types table, every reading stores
+# them so an id must never change once assigned
+TYPE_IDS = {'temperature': 1, 'humidity': 2}
+TYPE_NAMES = {type_id: name for name, type_id in TYPE_IDS.items()}
+
+# Id that matches no reading, given to devices and types that were never stored
+UNKNOWN_ID = -1
+
+def encode_type(sensor_type):
+    """
+    Id of a sensor type, None (any type) stays None
+    """
+    if sensor_type is None:
+        return None
+    return TYPE_IDS.get(sensor_type, UNKNOWN_ID)
+
+class DeviceRegistry:
+    """
+    In-process cache of the devices table, device uuid to id and back.
+    Only committed ids are cached: ids are never reassigned so an entry never
+    goes stale, and a device registered by another process is still found.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._uuids = {}
+
+    def _remember(self, device_uuid, device_id):
+        self._ids[device_uuid] = device_id
+        self._uuids[device_id] = device_uuid
+
+    def device_id(self, conn, device_uuid):
+        """
+        Id of a device, None if it was never stored
+        """
+        device_id = self._ids.get(device_uuid)
+        if device_id is None:
+            row = conn.execute('select id from devices where device_uuid=?1', [device_uuid]).fetchone()
+            if row is None:
+                return None
+            device_id = row[0]
+            self._remember(device_uuid, device_id)
+        return device_id
+
+    def register_device(self, conn, device_uuid):
+        """
+        Id of a device, added to the devices table when new. A new id is not
+        cached until it is committed, the transaction could still roll back.
+        """
+        device_id = self.device_id(conn, device_uuid)
+        if device_id is None:
+            device_id = conn.execute('insert into devices (device_uuid) VALUES (?1)', [device_uuid]).lastrowid
+        return device_id
+
+    def device_ids(self, conn, device_uuids):
+        """
+        Map of uuid to id for the stored devices among device_uuids
+        """
+        missing = [device_uuid for device_uuid in set(device_uuids) if device_uuid not in self._ids]
+        if missing:
+            rows = conn.execute('select id, device_uuid from devices where device_uuid IN (select value from json_each(?1))', [json.dumps(missing)])
+            for device_id, device_uuid in rows:
+                self._remember(device_uuid, device_id)
+        return {device_uuid: self._ids[device_uuid] for device_uuid in device_uuids if device_uuid in self._ids}
+
+    def device_uuids(self, conn, device_ids):
+        """
+        Map of id to uuid for ids read from the readings
+        """
+        missing = [device_id for device_id in set(device_ids) if device_id not in self._uuids]
+        if missing:
+            rows = conn.execute('select id, device_uuid from devices where id IN (select value from json_each(?1))', [json.dumps(missing)])
+            for device_id, device_uuid in rows:
+                self._remember(device_uuid, device_id)
+        return {device_id: self._uuids[device_id] for device_id in device_ids}
+
+    def clear(self):
+        # Needed when the database is recreated, the ids start over
+        self._ids.clear()
+        self._uuids.clear()
@@ -0,0 +1,70 @@
+import queue
+import threading
+
+from utils.metrics import STREAM_EVENTS_DROPPED, STREAM_SUBSCRIBERS
+
+class Subscription:
+    """
+    Bounded queue of the events of one topic for one consumer. A consumer that
+    falls behind is marked as overflowed instead of slowing down the publisher,
+    it is expected to stop and resume from the last event it handled.
+    """
+
+    def __init__(self, topic, max_queue):
+        self.topic = topic
+        self.queue = queue.Queue(max_queue)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.overflowed = True
+            STREAM_EVENTS_DROPPED.inc()
+            return False
+
+    def get(self, timeout=None):
+        """
+        Next event, raises queue.Empty when none arrives within timeout
+        """
+        return self.queue.get(timeout=timeout)
+
+class EventBus:
+    """
+    In-process fan-out: every event published on a topic is put on the queue
+    of each subscription to that topic, publishing never blocks.
+    """
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, topic):
+        subscription = Subscription(topic, self.max_queue)
+        with self._lock:
+            self._subscriptions.setdefault(topic, set()).add(subscription)
+        STREAM_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic)
+            if subscriptions is None or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.topic]
+        STREAM_SUBSCRIBERS.dec()
+
+    def has_subscribers(self, topic):
+        return topic in self._subscriptions
+
+    def publish(self, topic, event):
+        """
+        Returns the number of subscriptions the event was queued for
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(topic, ()))
+        return sum(1 for subscription in subscriptions if subscription.put(event))
@@ -0,0 +1,91 @@
+import math
+
+def histogram_quantile(histogram, q):
+    """
+    Quantile of the readings described by a histogram, a list of (value, count)
+    sorted by value. Uses linear interpolation between neighbours like pandas.
+    """
+    total = sum(count for _, count in histogram)
+    if total == 0:
+        return None
+
+    rank = q * (total - 1)
+    lower_rank = int(math.floor(rank))
+    lower = upper = None
+    seen = 0
+    for value, count in histogram:
+        if lower is None and lower_rank < seen + count:
+            lower = value
+        if lower_rank + 1 < seen + count:
+            upper = value
+            break
+        seen += count
+
+    if rank == lower_rank or upper is None:
+        return float(lower)
+    return lower + (rank - lower_rank) * (upper - lower)
+
+def histogram_stats(histogram):
+    """
+    Count, min, max, mean, median and quartiles of a histogram in the same keys
+    the summary endpoint uses. Values are None when the histogram is empty.
+    """
+    total = sum(count for _, count in histogram)
+    if total == 0:
+        return {
+            'number_of_readings': 0,
+            'min_reading_value': None,
+            'max_reading_value': None,
+            'mean_reading_value': None,
+            'median_reading_value': None,
+            'quartile_1_value': None,
+            'quartile_3_value': None
+        }
+
+    return {
+        'number_of_readings': total,
+        'min_reading_value': histogram[0][0],
+        'max_reading_value': histogram[-1][0],
+        'mean_reading_value': sum(value * count for value, count in histogram) / total,
+        'median_reading_value': histogram_quantile(histogram, 0.5),
+        'quartile_1_value': histogram_quantile(histogram, 0.25),
+        'quartile_3_value': histogram_quantile(histogram, 0.75)
+    }
+
+# Metrics the stats endpoints can compute from a single histogram
+STATS_METRICS = ['count', 'min', 'max', 'mean', 'median', 'quartiles']
+
+def parse_metrics(metrics):
+    """
+    Validate a list of metric names (or a comma separated string), all of them when empty
+    """
+    if not metrics:
+        return list(STATS_METRICS)
+    if isinstance(metrics, str):
+        metrics = [metric.strip() for metric in metrics.split(',') if metric.strip()]
+    unknown = [metric for metric in metrics if metric not in STATS_METRICS]
+    if unknown or not metrics:
+        raise ValueError('metrics must be some of: {}'.format(', '.join(STATS_METRICS)))
+    return metrics
+
+def histogram_metrics(histogram, metrics):
+    """
+    The requested metrics of a histogram, quartiles adds quartile_1 and quartile_3
+    """
+    stats = histogram_stats(histogram)
+    result = {}
+    for metric in metrics:
+        if metric == 'count':
+            result['count'] = stats['number_of_readings']
+        elif metric == 'min':
+            result['min'] = stats['min_reading_value']
+        elif metric == 'max':
+            result['max'] = stats['max_reading_value']
+        elif metric == 'mean':
+            result['mean'] = stats['mean_reading_value']
+        elif metric == 'median':
+            result['median'] = stats['median_reading_value']
+        elif metric == 'quartiles':
+            result['quartile_1'] = stats['quartile_1_value']
+            result['quartile_3'] = stats['quartile_3_value']
+    return result
@@ -0,0 +1,46 @@
+import hashlib
+import math
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+class HyperLogLog:
+    """
+    Approximate distinct counter (Flajolet et al.) using 2^precision one byte
+    registers, the relative standard error is 1.04 / sqrt(2^precision).
+    """
+
+    def __init__(self, precision=14):
+        if precision < MIN_PRECISION or precision > MAX_PRECISION:
+            raise ValueError('precision must be between {} and {}'.format(MIN_PRECISION, MAX_PRECISION))
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item):
+        hashed = int.from_bytes(hashlib.blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in what is left of the hash
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Only sketches with the same precision can be merged')
+        self.registers = bytearray(max(pair) for pair in zip(self.registers, other.registers))
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def count(self):
+        registers = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / registers)
+        estimate = alpha * registers * registers / sum(2.0 ** -register for register in self.registers)
+
+        # Linear counting is more accurate while many registers are still empty
+        empty = self.registers.count(0)
+        if estimate <= 2.5 * registers and empty:
+            estimate = registers * math.log(registers / empty)
+        return int(round(estimate))
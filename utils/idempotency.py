@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+def natural_key(sensor_type, date_created, value):
+    return 'natural:{}:{}:{}'.format(sensor_type, date_created, value)
+
+class RecentKeys:
+    """
+    The ingest keys committed lately, in insertion order, so most retries are
+    answered without going to the database. Keys expire after ttl seconds and
+    at most max_keys are kept, the ingest_keys table stays the authority.
+    """
+
+    def __init__(self, max_keys=100000, ttl=86400):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        added = self._keys.get(key)
+        return added is not None and now - added < self.ttl
+
+    def add(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = now
+            while self._keys:
+                oldest, added = next(iter(self._keys.items()))
+                if len(self._keys) <= self.max_keys and now - added < self.ttl:
+                    break
+                del self._keys[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+def claim_ingest_key(conn, device_id, key, now=None):
+    """
+    Record the key of a reading in the current transaction, False when it
+    was already there (the reading is a retry and must not be stored)
+    """
+    now = int(time.time()) if now is None else now
+    cur = conn.execute('insert or ignore into ingest_keys (device_id, key, created_at) VALUES (?,?,?)', (device_id, key, now))
+    return cur.rowcount == 1
+
+def purge_ingest_keys(conn, ttl, now=None, chunk_size=5000):
+    """
+    Delete the keys older than ttl seconds, chunk by chunk. Returns the number deleted.
+    """
+    now = int(time.time()) if now is None else now
+    removed = 0
+    while True:
+        cur = conn.execute('''delete from ingest_keys where (device_id, key) IN
+                              (select device_id, key from ingest_keys where created_at < ?1 limit ?2)''', [now - ttl, chunk_size])
+        conn.commit()
+        removed += cur.rowcount
+        if cur.rowcount < chunk_size:
+            return removed
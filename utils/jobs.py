@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.serializer import encode_default
+
+# Job statuses, the same names rq uses
+QUEUED = 'queued'
+STARTED = 'started'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+class InProcessJobQueue:
+    """
+    Job queue backed by a thread pool of the web process. Jobs enqueued with the
+    same key while one is still queued or running share it instead of running
+    twice. Results are kept for result_ttl seconds after the job ends.
+    """
+
+    def __init__(self, workers=2, result_ttl=3600):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active_keys = {}
+
+    def _expire(self, now):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['ended_at'] is not None and now - job['ended_at'] > self.result_ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self, job, func, args):
+        job['status'] = STARTED
+        try:
+            job['result'] = func(*args)
+            job['status'] = FINISHED
+        except Exception as error:
+            job['error'] = '{}: {}'.format(type(error).__name__, error)
+            job['status'] = FAILED
+        with self._lock:
+            job['ended_at'] = time.time()
+            self._active_keys.pop(job['key'], None)
+            job['done'].set()
+
+    def register(self, name, func):
+        # Functions run in this process directly, only SQLiteJobQueue needs their names
+        pass
+
+    def enqueue(self, key, func, *args):
+        """
+        Run func(*args) in the background and return the job dict,
+        or the job already running for the same key.
+        """
+        with self._lock:
+            self._expire(time.time())
+            if key in self._active_keys:
+                return self._jobs[self._active_keys[key]]
+
+            job = {'id': uuid.uuid4().hex, 'key': key, 'status': QUEUED, 'result': None, 'error': None,
+                   'created_at': time.time(), 'ended_at': None, 'done': threading.Event()}
+            self._jobs[job['id']] = job
+            self._active_keys[key] = job['id']
+
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        job = self.get(job_id)
+        if job is not None:
+            job['done'].wait(timeout)
+        return job
+
+JOB_FIELDS = ('id', 'key', 'status', 'result', 'error', 'created_at', 'ended_at')
+
+class SQLiteJobQueue:
+    """
+    Job queue kept in the jobs table, so every process sees the same jobs: any
+    of them can poll a job enqueued by another, and the jobs are run by whichever
+    process having their function registered claims them first. Each process runs workers polling threads (0 to
+    leave the jobs to dedicated processes calling work()). Functions are stored
+    by the name they were registered with, every process registers the same ones.
+    A job started more than timeout seconds ago is considered abandoned by a
+    worker that died and is marked failed.
+    """
+
+    def __init__(self, database_path, workers=2, result_ttl=3600, poll_interval=0.5, timeout=3600, busy_timeout_ms=5000):
+        self.database_path = database_path
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self._functions = {}
+        self._names = {}
+        self._wake = threading.Event()
+        self._workers = [threading.Thread(target=self.work, name='job-{}'.format(index), daemon=True) for index in range(workers)]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.database_path, timeout=self.busy_timeout_ms / 1000.0, isolation_level=None)
+
+    def _start_workers(self):
+        with self._start_lock:
+            if not self._started:
+                self._started = True
+                for worker in self._workers:
+                    worker.start()
+
+    def register(self, name, func):
+        self._functions[name] = func
+        self._names[func] = name
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        job['result'] = None if job['result'] is None else json.loads(job['result'])
+        return job
+
+    def _select(self, conn, where, parameters):
+        return conn.execute('select {} from jobs where {}'.format(', '.join(JOB_FIELDS), where), parameters).fetchone()
+
+    def _expire(self, conn, now):
+        conn.execute('delete from jobs where ended_at < ?1', [now - self.result_ttl])
+        conn.execute("update jobs set status=?1, error='Abandoned by its worker', ended_at=?2 where status=?3 AND started_at < ?4",
+                     [FAILED, now, STARTED, now - self.timeout])
+
+    def enqueue(self, key, func, *args):
+        """
+        Store a job running func(*args) and return the job dict, or the job
+        still queued or running for the same key.
+        """
+        name = self._names[func]
+        self._start_workers()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                self._expire(conn, now)
+                row = self._select(conn, 'key=?1 AND status IN (?2, ?3)', [key, QUEUED, STARTED])
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    conn.execute('insert into jobs (id, key, function, args, status, created_at) VALUES (?,?,?,?,?,?)',
+                                 (job_id, key, name, json.dumps(args), QUEUED, now))
+                    row = self._select(conn, 'id=?1', [job_id])
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        self._wake.set()
+        return self._job(row)
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            return self._job(self._select(conn, 'id=?1', [job_id]))
+        finally:
+            conn.close()
+
+    def wait(self, job_id, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['ended_at'] is not None or (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(min(self.poll_interval, 0.05))
+
+    def run_next(self):
+        """
+        Claim the oldest queued job of a function registered here and run it,
+        False when there was none
+        """
+        conn = self._connect()
+        try:
+            # An idle poll is a plain read, the write lock is only taken to claim a job
+            names = sorted(self._functions)
+            while True:
+                row = conn.execute('select id, function, args from jobs where status=? AND function IN ({}) order by created_at limit 1'
+                                   .format(', '.join('?' * len(names))), [QUEUED] + names).fetchone()
+                if row is None:
+                    return False
+                # Another worker may have claimed it since the read
+                claimed = conn.execute('update jobs set status=?1, started_at=?2 where id=?3 AND status=?4',
+                                       [STARTED, time.time(), row[0], QUEUED]).rowcount
+                if claimed:
+                    break
+
+            job_id, name, args = row
+            try:
+                result = json.dumps(self._functions[name](*json.loads(args)), default=encode_default)
+                update = ('status=?1, result=?2', [FINISHED, result])
+            except Exception as error:
+                update = ('status=?1, error=?2', [FAILED, '{}: {}'.format(type(error).__name__, error)])
+            conn.execute('update jobs set {}, ended_at=?3 where id=?4'.format(update[0]), update[1] + [time.time(), job_id])
+            return True
+        finally:
+            conn.close()
+
+    def work(self, burst=False):
+        """
+        Run jobs as they are queued, until there are none left when burst is set
+        """
+        while True:
+            try:
+                ran = self.run_next()
+            except sqlite3.Error:
+                # The table can be missing while the database is recreated
+                ran = False
+            if not ran:
+                if burst:
+                    return
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
@@ -0,0 +1,39 @@
+import sys
+import timeit
+
+from utils.serializer import available_serializers, get_serializer
+
+def sample_payloads(readings):
+    """
+    Readings GET bodies of one device, in the objects and columnar formats
+    """
+    start = 1600000000
+    objects = [{'device_uuid': 'b21ad0676f26439482cc9b1c7e827de4', 'type': 'temperature', 'value': index % 101, 'date_created': start + index}
+               for index in range(readings)]
+    columnar = {'device_uuid': 'b21ad0676f26439482cc9b1c7e827de4', 'type': 'temperature',
+                'date_created': [start + index for index in range(readings)], 'value': [index % 101 for index in range(readings)]}
+    return {'objects': objects, 'columnar': columnar}
+
+def benchmark_serializers(readings=100000, repeat=5):
+    """
+    Best time in seconds to encode each payload with every installed serializer
+    """
+    results = []
+    for payload_name, payload in sample_payloads(readings).items():
+        for name in available_serializers():
+            serializer = get_serializer(name)
+            seconds = min(timeit.repeat(lambda: serializer.dumps(payload), number=1, repeat=repeat))
+            results.append({'payload': payload_name, 'serializer': name, 'seconds': seconds, 'bytes': len(serializer.dumps(payload))})
+    return results
+
+def format_results(results):
+    lines = []
+    baselines = {result['payload']: result['seconds'] for result in results if result['serializer'] == 'json'}
+    for result in results:
+        lines.append('{:<9} {:<7} {:>9.2f} ms {:>10} bytes  x{:.1f}'.format(
+            result['payload'], result['serializer'], result['seconds'] * 1000, result['bytes'],
+            baselines[result['payload']] / result['seconds']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    print(format_results(benchmark_serializers(*[int(argument) for argument in sys.argv[1:2]])))
@@ -0,0 +1,98 @@
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from utils.metrics import LOG_RECORDS_DROPPED
+
+# Fields of the access records, they travel as a tuple and only become a dict in the listener
+ACCESS_FIELDS = ('endpoint', 'method', 'status', 'duration_ms', 'path', 'sample_rate')
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands the records to the listener thread untouched: formatting happens there,
+    and when the queue is full the record is dropped instead of blocking the request.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line. Access records are expanded into their fields
+    and any other extra (like the slow query plan) is kept as is.
+    """
+    EXTRA_FIELDS = ('sql', 'params', 'elapsed_ms', 'plan', 'access')
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is None:
+                continue
+            if field == 'access' and isinstance(value, tuple):
+                data.update(zip(ACCESS_FIELDS, value))
+            else:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+class LogPipeline:
+    """
+    Queue plus background listener that formats and writes the records of the
+    attached loggers, so a log call only costs building the record.
+    """
+
+    def __init__(self, stream=None, max_queue=10000):
+        self.queue = queue.Queue(max_queue)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        stream_handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+        stream_handler.setFormatter(JsonFormatter())
+        self.listener = QueueListener(self.queue, stream_handler)
+
+    def attach(self, logger_name, level=logging.INFO):
+        logger = logging.getLogger(logger_name)
+        logger.addHandler(self.handler)
+        logger.setLevel(level)
+        logger.propagate = False
+        return logger
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        # Writes whatever is still queued before returning
+        self.listener.stop()
+
+class AccessLogger:
+    """
+    Request log with sampling per route, sample_rates maps '<endpoint>:<method>'
+    to the fraction of requests logged. Server errors are always logged.
+    """
+
+    def __init__(self, logger, sample_rates=None, default_rate=1.0):
+        self.logger = logger
+        self.sample_rates = sample_rates or {}
+        self.default_rate = default_rate
+
+    def log(self, endpoint, method, status, duration, path):
+        rate = self.sample_rates.get('{}:{}'.format(endpoint, method), self.default_rate)
+        if status < 500 and rate < 1.0 and random.random() >= rate:
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        self.logger.info('access', extra={'access': (endpoint, method, status, round(duration * 1000, 3), path, rate)})
@@ -0,0 +1,186 @@
+import bisect
+import threading
+import time
+import weakref
+
+# Latency buckets in seconds, from 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _ShardOwner:
+    """
+    Held in the thread local storage of a metric, collected when its thread ends
+    """
+    __slots__ = ('__weakref__',)
+
+class Metric:
+    """
+    Base of the metrics. Every thread updates its own shard (a dict keyed by the
+    label values) so the hot path never takes a lock, shards are only summed
+    when the metrics are scraped. The shard of a thread that ended is folded
+    into a base total, so short lived request threads don't pile up shards.
+    """
+    kind = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = []
+        self._base = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._local.owner = _ShardOwner()
+            weakref.finalize(self._local.owner, self._retire, shard)
+            # Only taken once per thread
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._shards_lock:
+            self._shards.remove(shard)
+            for labels, value in shard.items():
+                self._merge(self._base, labels, value)
+
+    def _format_labels(self, label_values, extra=()):
+        pairs = list(zip(self.label_names, label_values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+    def _collect(self):
+        with self._shards_lock:
+            return list(self._shards) + [dict(self._base)]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self._render_samples())
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    @staticmethod
+    def _merge(totals, labels, value):
+        totals[labels] = totals.get(labels, 0) + value
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return sum(shard.get(labels, 0) for shard in self._collect())
+
+    def _totals(self):
+        totals = {}
+        for shard in self._collect():
+            for labels, value in list(shard.items()):
+                self._merge(totals, labels, value)
+        return totals
+
+    def _render_samples(self):
+        return ['{}{} {}'.format(self.name, self._format_labels(labels), value) for labels, value in sorted(self._totals().items())]
+
+class Gauge(Counter):
+    """
+    A gauge that goes up and down, like a counter its shards are summed so a
+    thread must dec() what it inc()
+    """
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    @staticmethod
+    def _merge(totals, labels, state):
+        total = totals.setdefault(labels, [0] * len(state))
+        for index, value in enumerate(state):
+            total[index] += value
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # One counter per bucket plus +Inf, then the sum
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def time(self, labels=()):
+        return _Timer(self, labels)
+
+    def count(self, labels=()):
+        return sum(sum(shard[labels][:-1]) for shard in self._collect() if labels in shard)
+
+    def _render_samples(self):
+        totals = {}
+        for shard in self._collect():
+            for labels, state in list(shard.items()):
+                self._merge(totals, labels, state)
+
+        lines = []
+        for labels, state in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self._format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._format_labels(labels), state[-1]))
+            lines.append('{}_count{} {}'.format(self.name, self._format_labels(labels), cumulative))
+        return lines
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+REQUESTS_TOTAL = REGISTRY.register(Counter('http_requests_total', 'HTTP requests by route, method and status', ['endpoint', 'method', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram('http_request_duration_seconds', 'HTTP request latency by route', ['endpoint', 'method']))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram('db_query_duration_seconds', 'Time spent executing statements, aggregates and sorts run here'))
+DB_SLOW_QUERIES = REGISTRY.register(Counter('db_slow_queries_total', 'Statements over the slow query threshold by access (SCAN or SEARCH)', ['access']))
+DB_FETCH_SECONDS = REGISTRY.register(Counter('db_fetch_seconds_total', 'Time spent fetching rows from SQLite'))
+DB_ROWS_RETURNED = REGISTRY.register(Counter('db_rows_returned_total', 'Rows fetched from SQLite'))
+DB_VM_STEPS = REGISTRY.register(Counter('db_vm_steps_total', 'Thousands of SQLite virtual machine steps, the proxy of rows scanned that SQLite exposes'))
+DATAFRAME_BUILD_SECONDS = REGISTRY.register(Histogram('dataframe_build_duration_seconds', 'Time spent building pandas DataFrames'))
+INGEST_QUEUE_DEPTH = REGISTRY.register(Gauge('ingest_queue_depth', 'POST readings requests waiting for or holding the database'))
+LOG_RECORDS_DROPPED = REGISTRY.register(Counter('log_records_dropped_total', 'Log records dropped because the log queue was full'))
+STREAM_SUBSCRIBERS = REGISTRY.register(Gauge('stream_subscribers', 'Open readings streams'))
+STREAM_EVENTS_DROPPED = REGISTRY.register(Counter('stream_events_dropped_total', 'Stream events dropped because the subscriber queue was full'))
+INGEST_REJECTED = REGISTRY.register(Counter('ingest_rejected_total', 'POST readings requests rejected by reason (rate_limited, backlog or latency)', ['reason']))
+INGEST_DUPLICATES = REGISTRY.register(Counter('ingest_duplicates_total', 'POST readings requests not stored again, by where the key was found (memory or database)', ['source']))
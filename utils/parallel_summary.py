@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+def describe_values(values):
+    """
+    Count, max, mean, median and quartiles of the readings of one device, the
+    quantiles interpolated like pandas describe()
+    """
+    quartile_1, median, quartile_3 = numpy.percentile(values, [25, 50, 75])
+    return {
+        'number_of_readings': int(values.size),
+        'max_reading_value': float(values.max()),
+        'median_reading_value': float(median),
+        'mean_reading_value': float(values.mean()),
+        'quartile_1_value': float(quartile_1),
+        'quartile_3_value': float(quartile_3)
+    }
+
+def describe_shard(shard):
+    """
+    Statistics of a list of (device_id, values), run in the pool workers
+    """
+    return [(device_id, describe_values(values)) for device_id, values in shard]
+
+def device_runs(cur, batch_size=10000):
+    """
+    (device_id, values array) of each device from a cursor of (device_id, value)
+    rows ordered by device_id, read in batches. A device is yielded as soon as its
+    run ends, so only the values of one device are held at a time.
+    """
+    device_id = None
+    values = []
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for row_device_id, value in rows:
+            if row_device_id != device_id:
+                if values:
+                    yield device_id, numpy.array(values, dtype=numpy.int64)
+                device_id = row_device_id
+                values = []
+            values.append(value)
+    if values:
+        yield device_id, numpy.array(values, dtype=numpy.int64)
+
+def shards(devices, chunk_size):
+    shard = []
+    for device in devices:
+        shard.append(device)
+        if len(shard) == chunk_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+def create_summary_pool(workers):
+    # Spawned rather than forked, the web process has threads holding locks and connections
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+def describe_devices(devices, pool=None, chunk_size=256, min_parallel_readings=100000, max_pending=None):
+    """
+    Statistics of every (device_id, values) pair as a {device_id: stats} dict,
+    devices can be a generator and is consumed as it goes. The first
+    min_parallel_readings readings are described in this process since shipping
+    them to the workers would cost more, past that the devices are split in
+    shards of chunk_size that the pool describes in parallel. At most
+    max_pending shards (two per core by default) are in flight, so a generator
+    is never read further ahead.
+    """
+    if pool is None:
+        return dict(describe_shard(devices))
+
+    described = {}
+    devices = iter(devices)
+    readings = 0
+    for device_id, values in devices:
+        described[device_id] = describe_values(values)
+        readings += values.size
+        if readings >= min_parallel_readings:
+            break
+
+    max_pending = max_pending or 2 * (os.cpu_count() or 1)
+    pending = deque()
+    for shard in shards(devices, chunk_size):
+        pending.append(pool.submit(describe_shard, shard))
+        if len(pending) >= max_pending:
+            described.update(pending.popleft().result())
+    while pending:
+        described.update(pending.popleft().result())
+    return described
@@ -0,0 +1,174 @@
+import bisect
+import math
+import random
+import struct
+from itertools import chain
+
+# Capacity decay between compactor levels, as in the KLL paper
+CAPACITY_DECAY = 2.0 / 3.0
+MIN_CAPACITY = 2
+MIN_K = 8
+
+# Binary layout, little endian: k, error_k, count, sum, min, max, the number of levels and
+# the struct code of the items, then the length of every level and all their items
+HEADER = struct.Struct('<IIQqqqHc')
+# Integer struct codes from the narrowest
+ITEM_CODES = ('b', 'h', 'i', 'q')
+
+def item_code(minimum, maximum):
+    for code in ITEM_CODES:
+        bits = 8 * struct.calcsize(code) - 1
+        if -2 ** bits <= minimum and maximum < 2 ** bits:
+            return code
+    raise ValueError('sketch items must fit in 64 bits')
+
+def normalized_rank_error(k):
+    """
+    Rank error (as a fraction of the readings) of a KLL sketch with
+    parameter k, with 99% confidence. Same approximation DataSketches uses.
+    """
+    return 2.296 / (k ** 0.9723)
+
+class KLLSketch:
+    """
+    Mergeable quantile sketch (Karnin, Lang, Liberty). It keeps a few levels of
+    compactors, every item of level h stands for 2^h readings. Count, sum, min
+    and max are tracked exactly next to it so mean and max are never approximate.
+    """
+
+    def __init__(self, k=200):
+        if k < MIN_K:
+            raise ValueError('k must be at least {}'.format(MIN_K))
+        self.k = k
+        # Smallest k of any compacted sketch merged in, it drives the error
+        self.error_k = k
+        self.compactors = [[]]
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return max(int(math.ceil(self.k * CAPACITY_DECAY ** depth)), MIN_CAPACITY)
+
+    def _max_size(self):
+        return sum(self._capacity(height) for height in range(len(self.compactors)))
+
+    def _size(self):
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for height, compactor in enumerate(self.compactors):
+                if len(compactor) < self._capacity(height):
+                    continue
+                if height + 1 == len(self.compactors):
+                    self.compactors.append([])
+                compactor.sort()
+                # An odd item out stays in this level so the total weight is preserved
+                leftover = [compactor.pop()] if len(compactor) % 2 else []
+                self.compactors[height + 1].extend(compactor[random.randint(0, 1)::2])
+                self.compactors[height] = leftover
+                break
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self._compress()
+
+    def merge(self, other):
+        if not other.is_exact:
+            self.error_k = min(self.error_k, other.error_k)
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+
+    @property
+    def is_exact(self):
+        # Nothing was ever compacted, every reading is still in level 0
+        return len(self.compactors) == 1
+
+    @property
+    def error_bound(self):
+        return 0.0 if self.is_exact else normalized_rank_error(min(self.k, self.error_k))
+
+    def quantile(self, q):
+        """
+        Quantile with linear interpolation between neighbours, the same
+        definition pandas uses, applied over the weighted items.
+        """
+        if self.count == 0:
+            return None
+
+        weighted = sorted((value, 2 ** height) for height, compactor in enumerate(self.compactors) for value in compactor)
+        values = []
+        starts = []
+        position = 0
+        for value, weight in weighted:
+            values.append(value)
+            starts.append(position)
+            position += weight
+
+        rank = q * (self.count - 1)
+        lower_rank = int(math.floor(rank))
+        lower = values[bisect.bisect_right(starts, lower_rank) - 1]
+        if rank == lower_rank:
+            return float(lower)
+        upper = values[bisect.bisect_right(starts, lower_rank + 1) - 1]
+        return lower + (rank - lower_rank) * (upper - lower)
+
+    def to_dict(self):
+        return {'k': self.k, 'error_k': self.error_k, 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'compactors': self.compactors}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['k'])
+        sketch.error_k = data['error_k']
+        sketch.compactors = data['compactors']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        return sketch
+
+    def to_bytes(self):
+        """
+        Compact encoding of the sketch: a header, the level lengths and the items in
+        the narrowest integer type holding min and max, readings of 0 to 100 take a byte
+        """
+        code = item_code(self.min, self.max) if self.count else 'b'
+        lengths = [len(compactor) for compactor in self.compactors]
+        header = HEADER.pack(self.k, self.error_k, self.count, self.sum, self.min or 0, self.max or 0, len(lengths), code.encode())
+        return header + struct.pack('<{}I{}{}'.format(len(lengths), sum(lengths), code), *lengths, *chain.from_iterable(self.compactors))
+
+    @classmethod
+    def from_bytes(cls, data):
+        k, error_k, count, total, minimum, maximum, levels, code = HEADER.unpack_from(data)
+        lengths = struct.unpack_from('<{}I'.format(levels), data, HEADER.size)
+        offset = HEADER.size + 4 * levels
+        items = struct.unpack_from('<{}{}'.format((len(data) - offset) // struct.calcsize(code), code.decode()), data, offset)
+        sketch = cls(k)
+        sketch.error_k = error_k
+        sketch.compactors = []
+        start = 0
+        for length in lengths:
+            sketch.compactors.append(list(items[start:start + length]))
+            start += length
+        sketch.count = count
+        sketch.sum = total
+        if count:
+            sketch.min = minimum
+            sketch.max = maximum
+        return sketch
@@ -0,0 +1,35 @@
+import logging
+import sqlite3
+
+from utils.metrics import DB_SLOW_QUERIES
+
+logger = logging.getLogger('sensor_api.slow_query')
+
+def explain_query_plan(conn, sql, parameters=()):
+    """
+    EXPLAIN QUERY PLAN of a statement with its parameters. Returns the plan
+    lines and SCAN when any table is read in full, SEARCH otherwise.
+    """
+    cur = conn.cursor(sqlite3.Cursor)
+    try:
+        cur.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+        plan = [row[3] for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+    # Scanning a virtual table such as json_each only reads the bound parameter
+    scans = [detail for detail in plan if detail.startswith('SCAN ') and 'VIRTUAL TABLE' not in detail]
+    return plan, 'SCAN' if scans else 'SEARCH'
+
+def log_slow_query(conn, sql, parameters, elapsed):
+    """
+    Log a statement that went over the threshold with its parameters and plan
+    """
+    try:
+        plan, access = explain_query_plan(conn, sql, parameters)
+    except sqlite3.Error as error:
+        plan, access = ['EXPLAIN failed: {}'.format(error)], 'UNKNOWN'
+
+    DB_SLOW_QUERIES.inc((access,))
+    logger.warning('Slow query (%.1f ms, %s): %s params=%r plan=%s', elapsed * 1000, access, sql, parameters, ' | '.join(plan),
+                   extra={'sql': sql, 'params': parameters, 'elapsed_ms': elapsed * 1000, 'plan': plan, 'access': access})
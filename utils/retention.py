@@ -0,0 +1,165 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from utils.dictionary import encode_type
+from utils.idempotency import purge_ingest_keys
+from utils.sketch_store import expire_sketches
+from utils.summary_state import remove_from_summary_state
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 86400
+
+# No reading is ever deleted unless a policy is configured. This one keeps raw
+# readings 30 days, then only hourly aggregates. A type without a policy is kept
+# forever, an aggregate_seconds of None just deletes old readings.
+DEFAULT_RETENTION_POLICIES = {}
+EXAMPLE_RETENTION_POLICIES = {
+    'temperature': {'raw_seconds': 30 * DAY_SECONDS, 'aggregate_seconds': 3600},
+    'humidity': {'raw_seconds': 30 * DAY_SECONDS, 'aggregate_seconds': 3600},
+}
+
+# Readings of one type past a date, with the device id the aggregates are keyed by
+SELECT_READINGS = 'select device_id, value, date_created from reading_rows where type_id=?1 '
+
+def compact_chunk(conn, sensor_type, policy, now, chunk_size, sketch_bucket_seconds=None):
+    """
+    Fold the oldest chunk_size readings of a type that are past the raw retention
+    into readings_aggregates and delete them, in one short transaction. The summary
+    state loses them in the same transaction, and so do the sketches of the buckets
+    they fully covered. Returns the number of readings removed, 0 once there is
+    nothing left to do.
+    """
+    cutoff = now - policy['raw_seconds']
+    type_id = encode_type(sensor_type)
+    # The write lock is held from the read to the delete, a reading stored in
+    # between would be deleted without being folded
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        cur = conn.cursor()
+        cur.execute(SELECT_READINGS + 'AND date_created < ?2 order by date_created limit ?3',
+                    [type_id, cutoff, chunk_size])
+        rows = cur.fetchall()
+
+        # Readings are deleted by date range, which works on both layouts, so a full
+        # chunk stops before its last second unless that second is the whole chunk
+        end = cutoff
+        if len(rows) == chunk_size:
+            end = rows[-1][2]
+            rows = [row for row in rows if row[2] < end]
+            if not rows:
+                cur.execute(SELECT_READINGS + 'AND date_created = ?2', [type_id, end])
+                rows = cur.fetchall()
+                end += 1
+
+        aggregate_seconds = policy.get('aggregate_seconds')
+        if rows and aggregate_seconds:
+            aggregates = {}
+            for device_id, value, date_created in rows:
+                key = (device_id, date_created // aggregate_seconds * aggregate_seconds)
+                count, total, minimum, maximum = aggregates.get(key, (0, 0, value, value))
+                aggregates[key] = (count + 1, total + value, min(minimum, value), max(maximum, value))
+
+            cur.executemany('''insert into readings_aggregates (device_id, type_id, bucket_seconds, bucket_start, count, sum, min, max) VALUES (?,?,?,?,?,?,?,?)
+                               ON CONFLICT (device_id, type_id, bucket_seconds, bucket_start) DO UPDATE SET count = count + excluded.count,
+                               sum = sum + excluded.sum, min = MIN(min, excluded.min), max = MAX(max, excluded.max)''',
+                            [(device_id, type_id, aggregate_seconds, bucket_start) + values
+                             for (device_id, bucket_start), values in aggregates.items()])
+
+        if rows:
+            cur.execute('delete from reading_rows where type_id=?1 AND date_created < ?2', [type_id, end])
+            remove_from_summary_state(cur, sensor_type, [(device_id, value) for device_id, value, _ in rows])
+            if sketch_bucket_seconds:
+                expire_sketches(cur, sensor_type, end, None, sketch_bucket_seconds)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(rows)
+
+def run_retention(conn, policies, now=None, chunk_size=500, time_budget=None, pause=0, progress=None, sketch_k=None, sketch_bucket_seconds=None):
+    """
+    Apply the retention policies chunk by chunk so writers only ever wait for a
+    single small transaction. Stops early once time_budget seconds are spent,
+    calling progress(report) after every chunk. Once a type is done the sketch
+    of the bucket its cutoff falls in is rebuilt from the readings left in it.
+    Returns the report.
+    """
+    now = int(time.time()) if now is None else now
+    started = time.monotonic()
+    report = {'removed': {sensor_type: 0 for sensor_type in policies}, 'finished': False}
+
+    for sensor_type, policy in policies.items():
+        while True:
+            if time_budget is not None and time.monotonic() - started >= time_budget:
+                return report
+            removed = compact_chunk(conn, sensor_type, policy, now, chunk_size, sketch_bucket_seconds)
+            if removed == 0:
+                break
+            report['removed'][sensor_type] += removed
+            if progress is not None:
+                progress(report)
+            if pause:
+                time.sleep(pause)
+
+        if report['removed'][sensor_type] and sketch_bucket_seconds:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                expire_sketches(conn.cursor(), sensor_type, now - policy['raw_seconds'], sketch_k, sketch_bucket_seconds)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    report['finished'] = True
+    return report
+
+class RetentionCompactor(threading.Thread):
+    """
+    Background thread that applies the retention policies every interval seconds,
+    and expires the ingest keys older than ingest_key_ttl seconds.
+    The report of the last run is kept in status.
+    """
+
+    def __init__(self, database_path, policies, interval=3600, chunk_size=500, pause=0.05, ingest_key_ttl=None,
+                 sketch_k=None, sketch_bucket_seconds=None):
+        super().__init__(name='retention-compactor', daemon=True)
+        self.database_path = database_path
+        self.policies = policies
+        self.sketch_k = sketch_k
+        self.sketch_bucket_seconds = sketch_bucket_seconds
+        self.ingest_key_ttl = ingest_key_ttl
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.status = {'running': False, 'last_run': None, 'report': None}
+        self._stop_event = threading.Event()
+
+    def _update_progress(self, report):
+        self.status['report'] = report
+
+    def run(self):
+        conn = sqlite3.connect(self.database_path)
+        try:
+            while not self._stop_event.is_set():
+                self.status['running'] = True
+                try:
+                    report = run_retention(conn, self.policies, chunk_size=self.chunk_size,
+                                           time_budget=self.interval, pause=self.pause, progress=self._update_progress,
+                                           sketch_k=self.sketch_k, sketch_bucket_seconds=self.sketch_bucket_seconds)
+                    self.status['report'] = report
+                    logger.info('Retention removed %s readings', report['removed'])
+                    if self.ingest_key_ttl is not None:
+                        logger.info('Retention removed %s ingest keys', purge_ingest_keys(conn, self.ingest_key_ttl))
+                except Exception:
+                    logger.exception('Retention run failed')
+                self.status['running'] = False
+                self.status['last_run'] = int(time.time())
+                self._stop_event.wait(self.interval)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
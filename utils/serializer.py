@@ -0,0 +1,59 @@
+import json
+import logging
+import sqlite3
+
+# orjson is optional, the stdlib encoder is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+def encode_default(obj):
+    """
+    Values the encoders do not know: sqlite3.Row, sets and NumPy scalars or
+    arrays (pandas results), tuples are already encoded as arrays
+    """
+    if isinstance(obj, sqlite3.Row):
+        return dict(zip(obj.keys(), obj))
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    # NumPy scalars and arrays, without importing NumPy here
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+class StdlibSerializer:
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data, default=encode_default, separators=(',', ':')).encode('utf-8')
+
+class OrjsonSerializer:
+    """
+    Encodes NumPy values natively and writes NaN as null where the stdlib writes NaN
+    """
+    name = 'orjson'
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=encode_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+SERIALIZERS = {'json': StdlibSerializer, 'orjson': OrjsonSerializer}
+
+def available_serializers():
+    return [name for name in SERIALIZERS if name != 'orjson' or orjson is not None]
+
+def get_serializer(name='auto'):
+    """
+    The serializer called name, auto is the fastest installed one.
+    A backend that is not installed falls back to the stdlib.
+    """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name not in SERIALIZERS:
+        raise ValueError('serializer must be auto or one of: {}'.format(', '.join(SERIALIZERS)))
+    if name not in available_serializers():
+        logger.warning('The %s serializer is not installed, using json', name)
+        name = 'json'
+    return SERIALIZERS[name]()
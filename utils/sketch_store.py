@@ -0,0 +1,139 @@
+import json
+
+from utils.dictionary import encode_type
+from utils.quantile_sketch import KLLSketch
+
+def bucket_start_for(date_created, bucket_seconds):
+    return int(date_created) // bucket_seconds * bucket_seconds
+
+def load_sketch(serialized):
+    # Sketches stored before the binary encoding are JSON text
+    if isinstance(serialized, str):
+        return KLLSketch.from_dict(json.loads(serialized))
+    return KLLSketch.from_bytes(serialized)
+
+def add_reading_to_sketch(cur, device_id, sensor_type, value, date_created, k, bucket_seconds):
+    """
+    Fold a new reading into the sketch of its bucket. It must run in the same
+    transaction as the insert of the reading so both stay consistent.
+    """
+    type_id = encode_type(sensor_type)
+    bucket_start = bucket_start_for(date_created, bucket_seconds)
+    cur.execute('select sketch from reading_sketches where device_id=?1 AND type_id=?2 AND bucket_start=?3',
+                [device_id, type_id, bucket_start])
+    row = cur.fetchone()
+    sketch = KLLSketch(k) if row is None else load_sketch(row[0])
+    sketch.update(value)
+    cur.execute('insert or replace into reading_sketches (device_id,type_id,bucket_start,sketch) VALUES (?,?,?,?)',
+                (device_id, type_id, bucket_start, sketch.to_bytes()))
+
+def build_sketches(rows, k):
+    """
+    (device_id, type_id, bucket_start, encoded sketch) for each key of rows
+    ordered by device_id, type_id and bucket_start
+    """
+    key = None
+    sketch = None
+    for device_id, type_id, bucket_start, value in rows:
+        if (device_id, type_id, bucket_start) != key:
+            if sketch is not None:
+                yield key + (sketch.to_bytes(),)
+            key = (device_id, type_id, bucket_start)
+            sketch = KLLSketch(k)
+        sketch.update(value)
+    if sketch is not None:
+        yield key + (sketch.to_bytes(),)
+
+def write_sketches(cur, rows, k):
+    cur.executemany('insert into reading_sketches (device_id,type_id,bucket_start,sketch) VALUES (?,?,?,?)', build_sketches(rows, k))
+
+def rebuild_sketches(conn, k, bucket_seconds):
+    """
+    Recompute every sketch from the raw readings, needed once for readings
+    stored before the sketches existed.
+    """
+    cur = conn.cursor()
+    cur.execute('delete from reading_sketches')
+    cur.execute('select device_id, type_id, date_created / ?1 * ?1 as bucket_start, value from reading_rows order by 1, 2, 3',
+                [bucket_seconds])
+    write_sketches(conn.cursor(), cur, k)
+    conn.commit()
+
+def expire_sketches(cur, sensor_type, end, k, bucket_seconds):
+    """
+    Drop the sketches of a type whose bucket ends by end, once the readings
+    before end are deleted. The bucket end falls in is rebuilt from the
+    readings left in it when k is given.
+    """
+    type_id = encode_type(sensor_type)
+    # The bare bucket_start lets the reading_sketches_type_bucket index bound the delete
+    cur.execute('delete from reading_sketches where type_id=?1 AND bucket_start <= ?3 - ?2', [type_id, bucket_seconds, end])
+    bucket_start = bucket_start_for(end, bucket_seconds)
+    if k is None or bucket_start == end:
+        return
+    cur.execute('delete from reading_sketches where type_id=?1 AND bucket_start=?2', [type_id, bucket_start])
+    rows = cur.execute('''select device_id, type_id, ?3 as bucket_start, value from reading_rows
+                          where type_id=?1 AND date_created BETWEEN ?2 AND ?3 + ?4 - 1 order by device_id''',
+                       [type_id, end, bucket_start, bucket_seconds]).fetchall()
+    write_sketches(cur, rows, k)
+
+def split_range(start, end, bucket_seconds):
+    """
+    Split an inclusive [start, end] range into the buckets it fully covers
+    ([first_bucket, last_bucket) as bucket starts) and the raw edges around them.
+    """
+    start = int(start)
+    end = int(end)
+    first_bucket = -(-start // bucket_seconds) * bucket_seconds
+    last_bucket = (end + 1) // bucket_seconds * bucket_seconds
+    if first_bucket >= last_bucket:
+        return None, [(start, end)]
+
+    edges = []
+    if start < first_bucket:
+        edges.append((start, first_bucket - 1))
+    if last_bucket <= end:
+        edges.append((last_bucket, end))
+    return (first_bucket, last_bucket), edges
+
+def device_sketch(cur, device_id, sensor_type, start, end, k, bucket_seconds):
+    """
+    Sketch of one device readings in range: whole buckets come from the stored
+    sketches and only the partial buckets at the edges are read raw.
+    """
+    type_id = encode_type(sensor_type)
+    sketch = KLLSketch(k)
+    buckets, edges = split_range(start, end, bucket_seconds)
+    if buckets is not None:
+        cur.execute('select sketch from reading_sketches where device_id=?1 AND type_id=?2 AND bucket_start >= ?3 AND bucket_start < ?4',
+                    [device_id, type_id, buckets[0], buckets[1]])
+        for row in cur:
+            sketch.merge(load_sketch(row[0]))
+
+    for edge_start, edge_end in edges:
+        cur.execute('select value from reading_rows where device_id=?1 AND type_id=?2 AND date_created BETWEEN ?3 AND ?4',
+                    [device_id, type_id, edge_start, edge_end])
+        for row in cur:
+            sketch.update(row[0])
+    return sketch
+
+def devices_sketches(cur, sensor_type, start, end, k, bucket_seconds):
+    """
+    Sketch per device for every device with readings in range, any type when
+    sensor_type is None. Returns a dict keyed by device_id.
+    """
+    type_id = encode_type(sensor_type)
+    sketches = {}
+    buckets, edges = split_range(start, end, bucket_seconds)
+    if buckets is not None:
+        cur.execute('select device_id, sketch from reading_sketches where (?1 IS NULL OR type_id=?1) AND bucket_start >= ?2 AND bucket_start < ?3',
+                    [type_id, buckets[0], buckets[1]])
+        for device_id, serialized in cur:
+            sketches.setdefault(device_id, KLLSketch(k)).merge(load_sketch(serialized))
+
+    for edge_start, edge_end in edges:
+        cur.execute('select device_id, value from reading_rows where (?1 IS NULL OR type_id=?1) AND date_created BETWEEN ?2 AND ?3',
+                    [type_id, edge_start, edge_end])
+        for device_id, value in cur:
+            sketches.setdefault(device_id, KLLSketch(k)).update(value)
+    return sketches
@@ -0,0 +1,45 @@
+import re
+import subprocess
+import sys
+
+# Lines look like: "import time:       245 |       1234 |   flask.json"
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+def profile_import(module='app', top=15):
+    """
+    Import a module in a fresh interpreter with -X importtime and return
+    the total cold import time plus its slowest direct imports (in microseconds).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Importing {} failed:\n{}'.format(module, result.stderr))
+
+    # Children are printed before their parent, so keep the direct imports
+    # seen since the last top level line until we reach the profiled module
+    children = []
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        if len(indent) == 1:
+            if name == module:
+                total_us = int(cumulative_us)
+                break
+            children = []
+        elif len(indent) == 3:
+            children.append({'module': name, 'self_us': int(self_us), 'cumulative_us': int(cumulative_us)})
+
+    children.sort(key=lambda entry: entry['cumulative_us'], reverse=True)
+    return {'module': module, 'total_us': total_us, 'slowest': children[:top]}
+
+def format_report(report):
+    lines = ['{} cold import: {:.1f} ms'.format(report['module'], report['total_us'] / 1000.0)]
+    for entry in report['slowest']:
+        lines.append('  {:>10.1f} ms  {}'.format(entry['cumulative_us'] / 1000.0, entry['module']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    print(format_report(profile_import(*sys.argv[1:2])))
@@ -0,0 +1,103 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from utils.alerts import AlertRuleIndex
+from utils.db_utils import connect
+from utils.dictionary import DeviceRegistry
+
+class Storage:
+    """
+    Access to one database file: a single writer connection, serialized by a
+    lock, and a pool of read-only connections (mode=ro and query_only). The
+    database runs in WAL mode, so every read runs in a snapshot transaction
+    that never blocks the writer, and the writer never stalls a reader.
+    The device ids of the file are cached in devices and its alert rules in alert_rules.
+    """
+
+    def __init__(self, database_path, readers=8, slow_query_threshold=None, busy_timeout_ms=5000, acquire_timeout=30):
+        self.database_path = database_path
+        self.slow_query_threshold = slow_query_threshold
+        self.busy_timeout_ms = busy_timeout_ms
+        self.acquire_timeout = acquire_timeout
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._readers_left = readers
+        self._readers_lock = threading.Lock()
+        self.devices = DeviceRegistry()
+        self.alert_rules = AlertRuleIndex()
+
+    def _open(self, database, uri=False):
+        conn = connect(database, self.slow_query_threshold, uri=uri, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout = {}'.format(int(self.busy_timeout_ms)))
+        return conn
+
+    def _open_reader(self):
+        uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.database_path)))
+        conn = self._open(uri, uri=True)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """
+        The writer connection, committed when the block ends and rolled back on errors
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._open(self.database_path)
+                # Durable on checkpoints, WAL keeps the database consistent on a crash
+                self._writer.execute('PRAGMA synchronous = NORMAL')
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def acquire_reader(self):
+        """
+        A read-only connection from the pool, inside a snapshot transaction.
+        It must be given back with release_reader().
+        """
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._readers_lock:
+                if self._readers_left > 0:
+                    conn = self._open_reader()
+                    self._readers_left -= 1
+            if conn is None:
+                conn = self._readers.get(timeout=self.acquire_timeout)
+        conn.execute('BEGIN')
+        return conn
+
+    def release_reader(self, conn):
+        conn.rollback()
+        self._readers.put(conn)
+
+    @contextmanager
+    def reader(self):
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    def close(self):
+        """
+        Close the writer and the idle readers
+        """
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
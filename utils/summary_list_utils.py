@@ -1,4 +1,19 @@
+import heapq
+
+# Keys of a device summary that clients can sort by
+SUMMARY_SORT_KEYS = ['device_uuid', 'number_of_readings', 'max_reading_value', 'median_reading_value',
+                     'mean_reading_value', 'quartile_1_value', 'quartile_3_value']
 
 def sort_summary_by_key(summary_list, objProperty, reverse=False):
     return sorted(summary_list, key=lambda device_summary: device_summary[objProperty], reverse=reverse)
 
+def top_summary_by_key(summary_list, objProperty, reverse=False, limit=None, offset=0):
+    """
+    Page of the summary list sorted by objProperty. When a limit is given only
+    the first offset + limit items are selected with a heap instead of sorting it all.
+    """
+    if limit is None:
+        return sort_summary_by_key(summary_list, objProperty, reverse)[offset:]
+
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    return select(offset + limit, summary_list, key=lambda device_summary: device_summary[objProperty])[offset:]
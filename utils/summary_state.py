@@ -0,0 +1,106 @@
+import json
+from itertools import groupby
+
+from utils.dictionary import encode_type
+from utils.histogram_utils import histogram_stats
+from utils.summary_list_utils import top_summary_by_key
+
+# Summary keys that device_summaries can order by, so a top K is an ORDER BY/LIMIT in SQLite
+SQL_SORT_COLUMNS = {
+    'device_uuid': 'devices.device_uuid',
+    'number_of_readings': 'sum(count)',
+    'max_reading_value': 'max(max)',
+    'mean_reading_value': 'sum(sum) * 1.0 / sum(count)',
+}
+
+def summary_from_state(cur, devices, device_type=None, sort_key='number_of_readings', reverse=True, limit=None, offset=0):
+    """
+    Per device summary over every reading ever stored, read from the state
+    kept by the readings trigger. It costs O(devices) whatever the number of readings,
+    and only O(limit) when a page is sorted by a column device_summaries has.
+    The device ids of the state are turned into uuids through the devices registry.
+    """
+    type_id = encode_type(device_type)
+    if limit is not None and sort_key in SQL_SORT_COLUMNS:
+        cur.execute('''select device_summaries.device_id from device_summaries JOIN devices ON devices.id = device_summaries.device_id
+                       where (?1 IS NULL OR type_id=?1) group by device_summaries.device_id order by {} {}, devices.device_uuid limit ?2 offset ?3'''.format(
+                    SQL_SORT_COLUMNS[sort_key], 'desc' if reverse else 'asc'), [type_id, limit, offset])
+        page = [row[0] for row in cur.fetchall()]
+        cur.execute('select device_id, value, sum(count) from device_summary_histograms where device_id IN (select value from json_each(?2)) AND (?1 IS NULL OR type_id=?1) group by device_id, value order by device_id, value',
+                    [type_id, json.dumps(page)])
+        summary = summary_from_histograms(cur.fetchall())
+        position = {device_id: index for index, device_id in enumerate(page)}
+        summary.sort(key=lambda device_summary: position[device_summary['device_uuid']])
+        return with_device_uuids(cur.connection, devices, summary)
+
+    cur.execute('select device_id, value, sum(count) from device_summary_histograms where (?1 IS NULL OR type_id=?1) group by device_id, value order by device_id, value',
+                [type_id])
+    summary = with_device_uuids(cur.connection, devices, summary_from_histograms(cur))
+    # Equal keys keep the uuid order once paged
+    summary.sort(key=lambda device_summary: device_summary['device_uuid'])
+    return top_summary_by_key(summary, sort_key, reverse, limit, offset)
+
+def with_device_uuids(conn, devices, summary):
+    """
+    The summary built from device ids with their uuids in place
+    """
+    device_uuids = devices.device_uuids(conn, [device_summary['device_uuid'] for device_summary in summary])
+    for device_summary in summary:
+        device_summary['device_uuid'] = device_uuids[device_summary['device_uuid']]
+    return summary
+
+def summary_from_histograms(histogram_rows):
+    """
+    Build the device summaries from (device, value, count) rows ordered by device,
+    device_uuid is whatever the rows identify the device with
+    """
+    summary = []
+    for device_uuid, rows in groupby(histogram_rows, key=lambda row: row[0]):
+        device_stats = histogram_stats([(row[1], row[2]) for row in rows])
+        summary.append({
+            'device_uuid': device_uuid,
+            'number_of_readings': device_stats['number_of_readings'],
+            'max_reading_value': device_stats['max_reading_value'],
+            'median_reading_value': device_stats['median_reading_value'],
+            'mean_reading_value': device_stats['mean_reading_value'],
+            'quartile_1_value': device_stats['quartile_1_value'],
+            'quartile_3_value': device_stats['quartile_3_value']
+        })
+    return summary
+
+def remove_from_summary_state(cur, sensor_type, readings):
+    """
+    Take deleted (device_id, value) readings of a type out of the summary
+    state, in the transaction that deletes them. The max of a device is read
+    back from what is left of its histogram.
+    """
+    type_id = encode_type(sensor_type)
+    values = {}
+    devices = {}
+    for device_id, value in readings:
+        values[(device_id, value)] = values.get((device_id, value), 0) + 1
+        count, total = devices.get(device_id, (0, 0))
+        devices[device_id] = (count + 1, total + value)
+
+    cur.executemany('update device_summary_histograms set count = count - ?1 where device_id=?2 AND type_id=?3 AND value=?4',
+                    [(count, device_id, type_id, value) for (device_id, value), count in values.items()])
+    # Only the keys just decremented can have reached 0, a scan of the type would hold the writer
+    cur.executemany('delete from device_summary_histograms where device_id=?1 AND type_id=?2 AND value=?3 AND count <= 0',
+                    [(device_id, type_id, value) for device_id, value in values])
+    cur.executemany('''update device_summaries set count = count - ?1, sum = sum - ?2,
+                       max = (select max(value) from device_summary_histograms where device_id=?3 AND type_id=?4) where device_id=?3 AND type_id=?4''',
+                    [(count, total, device_id, type_id) for device_id, (count, total) in devices.items()])
+    cur.executemany('delete from device_summaries where device_id=?1 AND type_id=?2 AND count <= 0',
+                    [(device_id, type_id) for device_id in devices])
+
+def rebuild_summary_state(conn):
+    """
+    Recompute the summary state from the raw readings, needed once for
+    readings stored before the trigger existed.
+    """
+    cur = conn.cursor()
+    cur.execute('delete from device_summaries')
+    cur.execute('delete from device_summary_histograms')
+    cur.execute('insert into device_summaries (device_id, type_id, count, sum, max) select device_id, type_id, count(*), sum(value), max(value) from reading_rows group by device_id, type_id')
+    cur.execute('insert into device_summary_histograms (device_id, type_id, value, count) select device_id, type_id, value, count(*) from reading_rows group by device_id, type_id, value')
+    conn.commit()
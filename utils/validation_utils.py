@@ -1,7 +1,35 @@
 from marshmallow import Schema, fields, validate
+from utils.alerts import OPERATORS
+from utils.histogram_utils import STATS_METRICS
+from utils.summary_list_utils import SUMMARY_SORT_KEYS
 
 sensor_types = ['temperature', 'humidity']
 
 class DeviceReadingsSchema(Schema):
     type = fields.Str(required=True, validate=[validate.OneOf(sensor_types)])
-    value = fields.Int(required=True, validate=[validate.Range(min=0, max=100)])
\ No newline at end of file
+    value = fields.Int(required=True, validate=[validate.Range(min=0, max=100)])
+    date_created = fields.Int()
+
+class StatsQuerySchema(Schema):
+    device_uuids = fields.List(fields.Str(), required=True, validate=[validate.Length(min=1, max=1000)])
+    type = fields.Str(required=True, validate=[validate.OneOf(sensor_types)])
+    start = fields.Int()
+    end = fields.Int()
+    metrics = fields.List(fields.Str(validate=[validate.OneOf(STATS_METRICS)]))
+
+class SummaryJobSchema(Schema):
+    type = fields.Str(allow_none=True, validate=[validate.OneOf(sensor_types)])
+    start = fields.Int(allow_none=True)
+    end = fields.Int(allow_none=True)
+    sort_by = fields.Str(validate=[validate.OneOf(SUMMARY_SORT_KEYS)])
+    order = fields.Str(validate=[validate.OneOf(['asc', 'desc'])])
+    limit = fields.Int(allow_none=True, validate=[validate.Range(min=0)])
+    offset = fields.Int(validate=[validate.Range(min=0)])
+    approx = fields.Bool()
+    accuracy = fields.Int()
+
+class AlertRuleSchema(Schema):
+    device_uuid = fields.Str(allow_none=True)
+    type = fields.Str(required=True, validate=[validate.OneOf(sensor_types)])
+    operator = fields.Str(required=True, validate=[validate.OneOf(list(OPERATORS))])
+    threshold = fields.Int(required=True)